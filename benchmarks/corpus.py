@@ -0,0 +1,231 @@
+"""
+Generates statuses for the benchmarks, each as the plain text, the toot
+(as given by the Mastodon API) and the tweet (as given by the Twitter API)
+carrying it.
+
+The statuses come in several kinds, stressing different parts of the
+processing:
+
+- short: a few words;
+- long: several paragraphs, to be split in threads;
+- url-heavy: many links, which have a fixed length on Twitter;
+- emoji-heavy: many emojis (including sequences), counted twice on Twitter;
+- cw-tagged: statuses with a content warning.
+"""
+import html
+import random
+
+KINDS = ('short', 'long', 'url-heavy', 'emoji-heavy', 'cw-tagged')
+
+MASTODON_URL = 'https://mastodon.example'
+
+# The accounts posting the statuses.
+MASTODON_ACCOUNT = {'id': 1, 'username': 'alice', 'acct': 'alice', 'url': f'{MASTODON_URL}/@alice'}
+TWITTER_USER = {'id': 42, 'id_str': '42', 'screen_name': 'alice'}
+
+_WORDS = ['the', 'toot', 'about', 'a', 'long', 'thread', 'with', 'some', 'words', 'in', 'it', 'café', 'naïve',
+          'don\'t', '"quoted"', 'this & that', '<3', 'e.g.', 'v1.2.3', 'mail@example.com', 'end.']
+_URLS = ['https://example.com/some/path?query=1&other=2', 'https://en.wikipedia.org/wiki/Fediverse',
+         'http://www.python.org/', 'https://docs.example.org/a/very/long/path/to/some/article/somewhere#anchor',
+         'https://bit.ly/abc']
+_EMOJIS = ['🎉', '😀', '🐘', '🐦', '❤️', '👍🏽', '👩‍💻', '🏳️‍🌈', '🇫🇷', '✨', '☕']
+_NAMES = ['alice', 'bob', 'bobby', 'carol_1', 'Dave']
+_TAGS = ['mtt', 'Fediverse', 'python']
+_WARNINGS = ['spoilers', 'politics', 'food & drinks', 'eye contact']
+
+# For each kind: the range of tokens, and the weights of the tokens kinds.
+_PROFILES = {
+    'short': ((3, 15), {'word': 20, 'url': 1, 'mention': 1, 'hashtag': 1, 'emoji': 1}),
+    'long': ((80, 250), {'word': 40, 'url': 2, 'mention': 1, 'hashtag': 1, 'emoji': 1, 'break': 1, 'paragraph': 2}),
+    'url-heavy': ((15, 50), {'word': 5, 'url': 4, 'mention': 1, 'hashtag': 1, 'break': 1}),
+    'emoji-heavy': ((15, 60), {'word': 5, 'emoji': 5, 'mention': 1, 'paragraph': 1}),
+    'cw-tagged': ((10, 60), {'word': 20, 'url': 1, 'mention': 1, 'hashtag': 1, 'emoji': 1, 'paragraph': 1}),
+}
+
+
+def _generate_tokens(rng, kind):
+    (min_tokens, max_tokens), weights = _PROFILES[kind]
+    kinds, kinds_weights = list(weights), list(weights.values())
+
+    tokens = []
+    for _ in range(rng.randint(min_tokens, max_tokens)):
+        token_kind = rng.choices(kinds, kinds_weights)[0]
+
+        if token_kind == 'word':
+            tokens.append(('word', rng.choice(_WORDS)))
+        elif token_kind == 'url':
+            tokens.append(('url', rng.choice(_URLS)))
+        elif token_kind == 'mention':
+            tokens.append(('mention', rng.choice(_NAMES)))
+        elif token_kind == 'hashtag':
+            tokens.append(('hashtag', rng.choice(_TAGS)))
+        elif token_kind == 'emoji':
+            tokens.append(('word', ''.join(rng.choice(_EMOJIS) for _ in range(rng.randint(1, 3)))))
+        elif tokens and tokens[-1][0] not in ('break', 'paragraph'):
+            tokens.append((token_kind, None))
+
+    if not tokens or tokens[0][0] in ('mention', 'break', 'paragraph'):
+        # Statuses starting with a mention are replies.
+        tokens.insert(0, ('word', rng.choice(_WORDS)))
+
+    if tokens[-1][0] in ('break', 'paragraph'):
+        tokens.pop()
+
+    return tokens
+
+
+def _text(tokens):
+    pieces = []
+    for kind, value in tokens:
+        if kind == 'break':
+            pieces.append('\n')
+        elif kind == 'paragraph':
+            pieces.append('\n\n')
+        else:
+            if pieces and not pieces[-1].endswith('\n'):
+                pieces.append(' ')
+            pieces.append({'mention': '@', 'hashtag': '#'}.get(kind, '') + value)
+
+    return ''.join(pieces)
+
+
+def _toot_content(tokens):
+    """
+    :return: The toot HTML content, formatted like Mastodon does.
+    """
+    pieces = ['<p>']
+    line_start = True
+    for kind, value in tokens:
+        if kind in ('break', 'paragraph'):
+            pieces.append('<br />' if kind == 'break' else '</p><p>')
+            line_start = True
+            continue
+
+        if not line_start:
+            pieces.append(' ')
+        line_start = False
+
+        if kind == 'url':
+            scheme, rest = value.split('://', 1)
+            value = html.escape(value)
+            pieces.append(f'<a href="{value}" rel="nofollow noopener noreferrer" target="_blank">'
+                          f'<span class="invisible">{scheme}://</span><span class="ellipsis">{html.escape(rest[:30])}'
+                          f'</span><span class="invisible">{html.escape(rest[30:])}</span></a>')
+        elif kind == 'mention':
+            pieces.append(f'<span class="h-card"><a href="{MASTODON_URL}/@{value}" class="u-url mention">'
+                          f'@<span>{value}</span></a></span>')
+        elif kind == 'hashtag':
+            pieces.append(f'<a href="{MASTODON_URL}/tags/{value}" class="mention hashtag" rel="tag">'
+                          f'#<span>{value}</span></a>')
+        else:
+            pieces.append(html.escape(value))
+
+    pieces.append('</p>')
+    return ''.join(pieces)
+
+
+def _tweet_text(tokens):
+    """
+    :return: The tweet text, escaped like Twitter does, with its mentions and
+             urls entities.
+    """
+    text = ''
+    mentions = []
+    urls = []
+
+    for kind, value in tokens:
+        if kind == 'break':
+            text += '\n'
+            continue
+        elif kind == 'paragraph':
+            text += '\n\n'
+            continue
+
+        if text and not text.endswith('\n'):
+            text += ' '
+
+        if kind == 'url':
+            short_url = f'https://t.co/{len(urls):010d}'
+            urls.append({'url': short_url, 'expanded_url': value, 'display_url': value.split('://', 1)[1][:20],
+                         'indices': [len(text), len(text) + len(short_url)]})
+            text += short_url
+        elif kind == 'mention':
+            mentions.append({'screen_name': value, 'indices': [len(text), len(text) + len(value) + 1]})
+            text += '@' + value
+        elif kind == 'hashtag':
+            text += '#' + value
+        else:
+            text += value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+    return text, mentions, urls
+
+
+def generate_status(rng, kind, status_id, media_rate=0.2):
+    """
+    Generates a status.
+    :param rng: The random generator.
+    :param kind: The status kind (see KINDS).
+    :param status_id: The status ID.
+    :param media_rate: The probability for the status to have a media.
+    :return: A dict with the status `kind`, `text`, `toot` and `tweet`.
+    """
+    tokens = _generate_tokens(rng, kind)
+    warning = rng.choice(_WARNINGS) if kind == 'cw-tagged' else ''
+
+    tweet_text, mentions, urls = _tweet_text(tokens)
+    medias = []
+    attachments = []
+
+    if warning:
+        prefix = f'[CW: {html.escape(warning, quote=False)}] '
+        tweet_text = prefix + tweet_text
+        for entity in mentions + urls:
+            entity['indices'] = [index + len(prefix) for index in entity['indices']]
+
+    if rng.random() < media_rate:
+        attachments.append({'id': status_id, 'type': 'image',
+                            'url': f'{MASTODON_URL}/system/media_attachments/files/{status_id}/original/media.png'})
+
+        media_url = f'https://t.co/m{status_id:09d}'
+        medias.append({'url': media_url, 'media_url_https': f'https://pbs.twimg.com/media/{status_id}.jpg',
+                       'indices': [len(tweet_text) + 1, len(tweet_text) + 1 + len(media_url)]})
+        tweet_text += ' ' + media_url
+
+    toot = {
+        'id': status_id,
+        'uri': f'{MASTODON_URL}/users/alice/statuses/{status_id}',
+        'url': f'{MASTODON_URL}/@alice/{status_id}',
+        'account': dict(MASTODON_ACCOUNT),
+        'content': _toot_content(tokens),
+        'spoiler_text': warning,
+        'sensitive': bool(warning),
+        'media_attachments': attachments,
+        'reblogged': False,
+        'in_reply_to_id': None,
+    }
+
+    tweet = {
+        'id': status_id,
+        'id_str': str(status_id),
+        'user': dict(TWITTER_USER),
+        'full_text': tweet_text,
+        'entities': {'user_mentions': mentions, 'urls': urls, 'hashtags': [], 'media': medias},
+        'in_reply_to_user_id': None,
+        'in_reply_to_status_id': None,
+        'possibly_sensitive': False,
+    }
+
+    return {'kind': kind, 'text': _text(tokens), 'toot': toot, 'tweet': tweet}
+
+
+def generate_corpus(count, seed=0, kinds=KINDS):
+    """
+    Generates statuses of each kind.
+    :param count: The number of statuses of each kind.
+    :param seed: The random seed, so the corpus is the same between runs.
+    :param kinds: The statuses kinds.
+    :return: A dict mapping each kind to its statuses (see generate_status).
+    """
+    rng = random.Random(seed)
+    return {kind: [generate_status(rng, kind, i * len(kinds) + k + 1) for i in range(count)]
+            for k, kind in enumerate(kinds)}
@@ -0,0 +1,628 @@
+"""
+Stand-ins for the Mastodon and Twitter APIs, and for the servers of their
+medias, served over HTTP on the loopback interface. The crossposter uses
+its real API clients (Mastodon.py and python-twitter) against them,
+through its requests session and rate limiter, without reaching the real
+networks.
+
+Every request takes some time, may fail (with a 500 response), and counts
+against a rate limit, as configured: the responses carry the rate limit
+headers of the platform (`X-RateLimit-*` for Mastodon, `x-rate-limit-*`
+for Twitter), and the requests above the limit are rejected with a 429.
+Statuses posted (through the API, or by `inject` as if posted by the
+user) are listed in the account timeline and delivered to the open
+streams.
+"""
+import hashlib
+import html
+import itertools
+import json
+import math
+import random
+import re
+import threading
+import time
+
+from collections import Counter
+from datetime import datetime, timezone
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from queue import Queue
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+
+import twitter
+
+from benchmarks.corpus import MASTODON_ACCOUNT, MASTODON_URL, TWITTER_USER
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    """
+    The HTTP server of a fake network, answering each request from its own thread.
+    """
+    daemon_threads = True
+
+    def __init__(self, network):
+        super(FakeServer, self).__init__(('127.0.0.1', 0), FakeRequestHandler)
+        self.network = network
+
+
+class FakeRequestHandler(BaseHTTPRequestHandler):
+    """
+    Parses the requests to a fake network, and writes its responses.
+    """
+    # Keeps the connections alive, as the real APIs do.
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def handle_request(self):
+        url = urlsplit(self.path)
+        self.route = url.path
+        self.params = parse_qs(url.query)
+        self.params.update(self._read_params())
+
+        self.server.network.handle(self)
+
+    def param(self, name, default=None):
+        """
+        :return: The last value of a parameter (from the query string or the body), or the default.
+        """
+        values = self.params.get(name)
+        return values[-1] if values else default
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    return bytes(body)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _read_params(self):
+        body = self._read_body()
+        content_type = self.headers.get('Content-Type', '')
+
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            return parse_qs(body.decode())
+
+        if content_type.startswith('application/json'):
+            return {name: value if isinstance(value, list) else [value] for name, value in json.loads(body).items()}
+
+        if content_type.startswith('multipart/form-data'):
+            # Only the text fields are kept, not the files.
+            message = BytesParser().parsebytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+            return {part.get_param('name', header='Content-Disposition'): [part.get_payload(decode=True).decode()]
+                    for part in message.get_payload()
+                    if part.get_param('filename', header='Content-Disposition') is None}
+
+        return {}
+
+    def reply(self, status, body=b'', content_type='application/json; charset=utf-8', headers=None):
+        """
+        Writes a response.
+        :param body: The body, as bytes, or as a value to be encoded to JSON.
+        """
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        self.wfile.write(body)
+
+    def reply_stream(self, chunks, content_type, headers=None):
+        """
+        Writes a response streamed by chunks, until there are no more chunks or the client disconnects.
+        :param chunks: An iterator of chunks (str).
+        """
+        self.send_response(200)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        try:
+            for chunk in chunks:
+                data = chunk.encode()
+                self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+                self.wfile.flush()
+
+            self.wfile.write(b'0\r\n\r\n')
+        except OSError:
+            pass
+        finally:
+            chunks.close()
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeNetwork:
+    """
+    The behaviour shared by the fake networks.
+
+    Each request takes `latency` seconds on average (uniformly between half
+    and one and a half of it) and fails with a probability of `error_rate`.
+    Each rate limit bucket accepts `rate_limit` requests per window of
+    `rate_limit_window` seconds, and rejects the other ones.
+
+    The requests, failures and rejections are counted per endpoint in
+    `calls`, `errors` and `rejected`.
+
+    The endpoints are listed in `routes`, as (method, path regular expression,
+    endpoint name, handler method name) tuples; the handlers are called with
+    the request and the rate limit headers, and the groups of the path.
+    """
+    routes = []
+
+    # The endpoints not counting against the rate limits, nor failing.
+    unlimited = set()
+
+    def __init__(self, latency=0.0, error_rate=0.0, rate_limit=None, rate_limit_window=60.0, seed=None):
+        """
+        :param latency: The mean duration of the requests (seconds).
+        :param error_rate: The probability for a request to fail.
+        :param rate_limit: The number of requests accepted per bucket and window, or None for no limit.
+        :param rate_limit_window: The duration of the rate limit windows (seconds).
+        :param seed: The random seed.
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+
+        self.calls = Counter()
+        self.errors = Counter()
+        self.rejected = Counter()
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._windows = {}
+
+        self._ids = itertools.count(1)
+        self._statuses = []
+        self._streams = []
+
+        self._server = None
+        self.url = None
+
+    def start(self):
+        """
+        Starts serving, on a free port of the loopback interface (see `url`).
+        """
+        self._server = FakeServer(self)
+        self.url = f'http://127.0.0.1:{self._server.server_port}'
+
+        threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    def handle(self, request):
+        """
+        Answers a request: waits, then rejects it, fails it, or passes it to the handler of its endpoint.
+        :param request: The request (a FakeRequestHandler).
+        """
+        for method, path, endpoint, handler in self.routes:
+            match = re.fullmatch(path, request.route)
+            if method == request.command and match:
+                break
+        else:
+            request.reply(404, self.error_body('Not found'))
+            return
+
+        rejected, failed, delay, headers = self.check(endpoint)
+
+        time.sleep(delay)
+
+        if rejected:
+            request.reply(429, self.error_body('Rate limit exceeded'), headers=headers)
+        elif failed:
+            request.reply(500, self.error_body('Simulated failure'), headers=headers)
+        else:
+            getattr(self, handler)(request, headers, *match.groups())
+
+    def check(self, endpoint):
+        """
+        Counts a request, and decides its fate.
+        :param endpoint: The endpoint requested.
+        :return: A tuple (rejected, failed, delay, rate limit headers).
+        """
+        with self._lock:
+            self.calls[endpoint] += 1
+
+            if endpoint in self.unlimited:
+                return False, False, 0, {}
+
+            rejected = False
+            headers = {}
+            if self.rate_limit is not None:
+                now = time.time()
+                bucket = self.bucket(endpoint)
+                window_start, count = self._windows.get(bucket, (now, 0))
+                if now - window_start >= self.rate_limit_window:
+                    window_start, count = now, 0
+
+                rejected = count >= self.rate_limit
+                self._windows[bucket] = (window_start, count + 1)
+
+                headers = self.rate_limit_headers(self.rate_limit, max(0, self.rate_limit - count - 1),
+                                                  window_start + self.rate_limit_window)
+
+            delay = self.latency * self._random.uniform(0.5, 1.5)
+            failed = not rejected and self._random.random() < self.error_rate
+
+            if rejected:
+                self.rejected[endpoint] += 1
+            elif failed:
+                self.errors[endpoint] += 1
+
+        return rejected, failed, delay, headers
+
+    def bucket(self, endpoint):
+        """
+        :return: The rate limit bucket of an endpoint.
+        """
+        return endpoint
+
+    def rate_limit_headers(self, limit, remaining, reset):
+        """
+        :param reset: The end of the window (timestamp).
+        :return: The rate limit headers of a response.
+        """
+        return {}
+
+    def error_body(self, message):
+        """
+        :return: The body of an error response.
+        """
+        return {'error': message}
+
+    def next_id(self):
+        with self._lock:
+            return next(self._ids)
+
+    def inject(self, status):
+        """
+        Publishes a status, as if posted by the user.
+        :param status: The status (as returned by the API).
+        """
+        with self._lock:
+            self._statuses.append(status)
+            streams = list(self._streams)
+
+        for stream in streams:
+            stream.put(status)
+
+    def timeline(self, since_id=None, max_id=None, limit=None):
+        """
+        :return: The statuses posted, the newest first.
+        """
+        with self._lock:
+            statuses = [status for status in reversed(self._statuses)
+                        if (since_id is None or status['id'] > int(since_id))
+                        and (max_id is None or status['id'] <= int(max_id))]
+
+        return statuses[:int(limit)] if limit else statuses
+
+    def stream(self):
+        """
+        Yields the statuses posted from now on, until the network is closed.
+        """
+        stream = Queue()
+
+        with self._lock:
+            self._streams.append(stream)
+
+        try:
+            while True:
+                status = stream.get()
+                if status is None:
+                    return
+
+                yield status
+        finally:
+            with self._lock:
+                self._streams.remove(stream)
+
+    @property
+    def open_streams(self):
+        with self._lock:
+            return len(self._streams)
+
+    def close(self):
+        """
+        Ends the open streams, and stops serving.
+        """
+        with self._lock:
+            streams = list(self._streams)
+
+        for stream in streams:
+            stream.put(None)
+
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def _mastodon_json(value):
+    """
+    :return: The value, with its IDs as strings, as the Mastodon API returns them.
+    """
+    if isinstance(value, list):
+        return [_mastodon_json(item) for item in value]
+
+    if isinstance(value, dict):
+        return {key: str(item) if key.endswith('id') and isinstance(item, int) else _mastodon_json(item)
+                for key, item in value.items()}
+
+    return value
+
+
+class FakeMastodon(FakeNetwork):
+    """
+    A Mastodon instance, where `MASTODON_ACCOUNT` is logged in.
+
+    The rate limit is global to the account, except for the medias uploads.
+    """
+    routes = [
+        ('GET', r'/api/v1/instance/?', 'instance', 'instance'),
+        ('GET', r'/api/v2/instance/?', 'instance (v2)', 'instance_v2'),
+        ('GET', r'/api/v1/accounts/verify_credentials', 'accounts/verify_credentials', 'verify_credentials'),
+        ('GET', r'/api/v1/accounts/\d+', 'accounts', 'account'),
+        ('GET', r'/api/v1/accounts/\d+/statuses', 'accounts/statuses', 'account_statuses'),
+        ('POST', r'/api/v[12]/media', 'media', 'media_post'),
+        ('POST', r'/api/v1/statuses', 'statuses', 'status_post'),
+        ('GET', r'/api/v1/streaming/user', 'streaming/user', 'stream_user'),
+    ]
+
+    unlimited = {'streaming/user'}
+
+    def client(self, session=None):
+        """
+        :param session: The requests session to use.
+        :return: A Mastodon.py client of this instance, as MTT logs in.
+        """
+        from mastodon import Mastodon
+
+        return Mastodon(access_token='benchmark', api_base_url=self.url, ratelimit_method='throw', session=session)
+
+    def bucket(self, endpoint):
+        return 'media' if endpoint == 'media' else '*'
+
+    def rate_limit_headers(self, limit, remaining, reset):
+        return {
+            'X-RateLimit-Limit': str(limit),
+            'X-RateLimit-Remaining': str(remaining),
+            'X-RateLimit-Reset': datetime.fromtimestamp(reset, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+        }
+
+    # Asked by Mastodon.py, for the features available and the streaming API location.
+    version = '4.3.0'
+
+    def instance(self, request, headers):
+        request.reply(200, {'uri': MASTODON_URL, 'version': self.version,
+                            'urls': {'streaming_api': self.url.replace('http://', 'ws://')}}, headers=headers)
+
+    def instance_v2(self, request, headers):
+        request.reply(200, {'domain': MASTODON_URL, 'version': self.version, 'api_versions': {'mastodon': 2},
+                            'configuration': {'urls': {'streaming': self.url.replace('http://', 'ws://')}}},
+                      headers=headers)
+
+    def verify_credentials(self, request, headers):
+        request.reply(200, _mastodon_json(MASTODON_ACCOUNT), headers=headers)
+
+    def account(self, request, headers):
+        request.reply(200, _mastodon_json(MASTODON_ACCOUNT), headers=headers)
+
+    def account_statuses(self, request, headers):
+        toots = self.timeline(since_id=request.param('since_id'), max_id=request.param('max_id'),
+                              limit=request.param('limit', 20))
+        request.reply(200, _mastodon_json(toots), headers=headers)
+
+    def media_post(self, request, headers):
+        media_id = self.next_id()
+        request.reply(200, _mastodon_json({
+            'id': media_id,
+            'type': 'image',
+            'url': f'{MASTODON_URL}/system/media_attachments/files/{media_id}/original/media.png'
+        }), headers=headers)
+
+    def status_post(self, request, headers):
+        toot_id = self.next_id()
+        paragraphs = html.escape(request.param('status', '')).split('\n\n')
+        in_reply_to_id = request.param('in_reply_to_id')
+
+        toot = {
+            'id': toot_id,
+            'uri': f'{MASTODON_URL}/users/alice/statuses/{toot_id}',
+            'url': f'{MASTODON_URL}/@alice/{toot_id}',
+            'account': dict(MASTODON_ACCOUNT),
+            'content': '<p>' + '</p><p>'.join(paragraph.replace('\n', '<br />') for paragraph in paragraphs) + '</p>',
+            'spoiler_text': request.param('spoiler_text', ''),
+            'sensitive': request.param('sensitive', 'false').lower() in ('true', '1'),
+            'visibility': request.param('visibility'),
+            'media_attachments': [{'id': int(media_id), 'type': 'image'}
+                                  for media_id in request.params.get('media_ids[]', [])],
+            'reblogged': False,
+            'in_reply_to_id': int(in_reply_to_id) if in_reply_to_id else None,
+        }
+
+        self.inject(toot)
+        request.reply(200, _mastodon_json(toot), headers=headers)
+
+    def stream_user(self, request, headers):
+        events = (f'event: update\ndata: {json.dumps(_mastodon_json(toot))}\n\n' for toot in self.stream())
+        request.reply_stream(events, 'text/event-stream', headers=headers)
+
+
+class StreamingTwitterApi(twitter.Api):
+    """
+    python-twitter, reading the user stream from `stream_url` (python-twitter
+    always reads it from userstream.twitter.com).
+    """
+    def _RequestStream(self, url, verb, data=None, session=None):
+        url = url.replace('https://userstream.twitter.com/1.1', self.stream_url)
+        return super(StreamingTwitterApi, self)._RequestStream(url, verb, data=data, session=session)
+
+
+class FakeTwitter(FakeNetwork):
+    """
+    The Twitter API, where `TWITTER_USER` is logged in.
+
+    The rate limits are per endpoint.
+    """
+    routes = [
+        ('GET', r'/1\.1/account/verify_credentials\.json', 'account/verify_credentials', 'verify_credentials'),
+        ('GET', r'/1\.1/help/configuration\.json', 'help/configuration', 'configuration'),
+        ('GET', r'/1\.1/statuses/user_timeline\.json', 'statuses/user_timeline', 'user_timeline'),
+        ('POST', r'/1\.1/media/upload\.json#INIT', 'media/upload (INIT)', 'media_upload'),
+        ('POST', r'/1\.1/media/upload\.json#APPEND', 'media/upload (APPEND)', 'media_upload'),
+        ('POST', r'/1\.1/media/upload\.json#FINALIZE', 'media/upload (FINALIZE)', 'media_upload'),
+        ('POST', r'/1\.1/statuses/update\.json', 'statuses/update', 'post_update'),
+        ('POST', r'/1\.1/user\.json', 'user stream', 'user_stream'),
+    ]
+
+    unlimited = {'user stream'}
+
+    short_url_length = 23
+
+    def client(self, session=None):
+        """
+        :param session: The requests session to use (except for the streams and medias chunks, as python-twitter
+                        does not use its session for them).
+        :return: A python-twitter client of this API, as MTT logs in.
+        """
+        api = StreamingTwitterApi(
+            consumer_key='benchmark',
+            consumer_secret='benchmark',
+            access_token_key='benchmark',
+            access_token_secret='benchmark',
+            tweet_mode='extended',
+            base_url=f'{self.url}/1.1',
+            upload_url=f'{self.url}/1.1',
+            stream_url=f'{self.url}/1.1'
+        )
+
+        if session is not None:
+            api._session = session
+
+        return api
+
+    def handle(self, request):
+        # The media upload commands are counted apart, but share their rate limit.
+        if request.route.endswith('/media/upload.json'):
+            request.route = f'{request.route}#{request.param("command")}'
+
+        super(FakeTwitter, self).handle(request)
+
+    def bucket(self, endpoint):
+        return endpoint.split(' (')[0]
+
+    def rate_limit_headers(self, limit, remaining, reset):
+        return {
+            'x-rate-limit-limit': str(limit),
+            'x-rate-limit-remaining': str(remaining),
+            'x-rate-limit-reset': str(math.ceil(reset)),
+        }
+
+    def error_body(self, message):
+        return {'errors': [{'code': 88 if message == 'Rate limit exceeded' else 131, 'message': message}]}
+
+    def verify_credentials(self, request, headers):
+        request.reply(200, TWITTER_USER, headers=headers)
+
+    def configuration(self, request, headers):
+        request.reply(200, {'short_url_length': self.short_url_length,
+                            'short_url_length_https': self.short_url_length}, headers=headers)
+
+    def user_timeline(self, request, headers):
+        tweets = self.timeline(since_id=request.param('since_id'), max_id=request.param('max_id'),
+                               limit=request.param('count', 20))
+        request.reply(200, tweets, headers=headers)
+
+    def media_upload(self, request, headers):
+        command = request.param('command')
+
+        if command == 'INIT':
+            media_id = self.next_id()
+            request.reply(202, {'media_id': media_id, 'media_id_string': str(media_id)}, headers=headers)
+        elif command == 'APPEND':
+            request.reply(204, headers=headers)
+        else:
+            media_id = int(request.param('media_id'))
+            request.reply(201, {'media_id': media_id, 'media_id_string': str(media_id)}, headers=headers)
+
+    def post_update(self, request, headers):
+        tweet_id = self.next_id()
+        in_reply_to_status_id = request.param('in_reply_to_status_id')
+        media_ids = [int(media_id) for media_id in request.param('media_ids', '').split(',') if media_id]
+
+        tweet = {
+            'id': tweet_id,
+            'id_str': str(tweet_id),
+            'user': dict(TWITTER_USER),
+            'full_text': request.param('status', '').replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'),
+            'entities': {'user_mentions': [], 'urls': [], 'hashtags': [],
+                         'media': [{'id': media_id, 'url': f'https://t.co/m{media_id:09d}',
+                                    'media_url_https': f'https://pbs.twimg.com/media/{media_id}.jpg'}
+                                   for media_id in media_ids]},
+            'in_reply_to_user_id': TWITTER_USER['id'] if in_reply_to_status_id else None,
+            'in_reply_to_status_id': int(in_reply_to_status_id) if in_reply_to_status_id else None,
+            'possibly_sensitive': False,
+        }
+
+        self.inject(tweet)
+        request.reply(200, tweet, headers=headers)
+
+    def user_stream(self, request, headers):
+        request.reply_stream((json.dumps(tweet) + '\r\n' for tweet in self.stream()), 'application/json',
+                             headers=headers)
+
+
+class FakeMedias(FakeNetwork):
+    """
+    The servers of the medias of both networks: each media is `media_size`
+    bytes of content derived from its path.
+    """
+    routes = [
+        ('GET', r'/.*', 'medias', 'media'),
+    ]
+
+    def __init__(self, media_size=256 * 1024, **kwargs):
+        super(FakeMedias, self).__init__(**kwargs)
+        self.media_size = media_size
+
+    def rehost(self, status):
+        """
+        Moves the medias of a status (a toot or a tweet) to this server.
+        :return: The status.
+        """
+        for attachment in status.get('media_attachments', []):
+            attachment['url'] = self.url + urlsplit(attachment['url']).path
+
+        for media in status.get('entities', {}).get('media', []):
+            media['media_url_https'] = self.url + urlsplit(media['media_url_https']).path
+
+        return status
+
+    def media(self, request, headers):
+        block = hashlib.sha256(request.route.encode()).digest()
+        content = (block * (self.media_size // len(block) + 1))[:self.media_size]
+
+        request.reply(200, content, content_type='image/png', headers=headers)
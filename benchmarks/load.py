@@ -0,0 +1,340 @@
+"""
+Drives statuses through the crossposter, against the fake APIs of
+`benchmarks.fakes` (served over HTTP, and used through the real API
+clients), and reports how long they took to be mirrored.
+
+Statuses from the corpus (see `benchmarks.corpus`) are posted on Mastodon
+and/or Twitter at the given rate (on average, with random intervals), for
+the given duration. Each status is timed from its posting until all its
+parts are published on the other network. The percentiles of these mirror
+latencies, the throughput and the API calls are then reported.
+
+The API calls take `--latency` seconds on average, fail with a probability
+of `--error-rate`, and are rejected above `--rate-limit` calls per
+`--rate-limit-window` (per endpoint on Twitter, per account on Mastodon),
+as reported in their rate limit headers. With `--followed`, toots of other
+accounts are received too, as on the Mastodon home timeline.
+
+Run from the project directory, e.g.:
+
+    python -m benchmarks.load --rate 5 --duration 30 --latency 0.2 --error-rate 0.05
+"""
+import argparse
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from path import Path
+
+from benchmarks.corpus import KINDS, generate_status
+from benchmarks.fakes import FakeMastodon, FakeMedias, FakeTwitter
+from mtt import config, metrics
+from mtt.accounts import Account
+from mtt.async_engine import AsyncEngine
+from mtt.sessions import PooledSession
+
+
+class MirrorTimer:
+    """
+    Records when statuses are posted, when they are mirrored, and when
+    their processing is done (mirrored, or given up). Statuses are
+    identified by their ID as a string, as the API clients may decode it
+    either way.
+    """
+    def __init__(self):
+        self.posted = {}
+        self.latencies = {}
+        self.done = set()
+        self.first_posted = None
+        self.last_mirrored = None
+
+        self._lock = threading.Lock()
+
+    def post(self, direction, status_id):
+        status_id = str(status_id)
+        with self._lock:
+            now = time.monotonic()
+            self.posted[(direction, status_id)] = now
+            self.first_posted = self.first_posted or now
+
+    def mirrored(self, direction, status_id):
+        status_id = str(status_id)
+        with self._lock:
+            now = time.monotonic()
+            posted = self.posted.get((direction, status_id))
+            if posted is not None and (direction, status_id) not in self.latencies:
+                self.latencies[(direction, status_id)] = now - posted
+                self.last_mirrored = now
+
+    def processed(self, direction, status_id):
+        status_id = str(status_id)
+        with self._lock:
+            if (direction, status_id) in self.posted:
+                self.done.add((direction, status_id))
+
+    @property
+    def pending(self):
+        with self._lock:
+            return len(self.posted) - len(self.done)
+
+
+# The direction of the statuses, from the kind of statuses mirrored.
+DIRECTIONS = {'toot': 'm2t', 'tweet': 't2m'}
+
+
+def instrument(publishers, timer):
+    """
+    Times the statuses mirrored by the publishers of an account: they are associated once all their parts
+    are published, and removed from the (shared) outbox once mirrored or given up.
+    """
+    def timed_associate_post(associate_post, direction):
+        def associate(post, posted_id):
+            associate_post(post, posted_id)
+            timer.mirrored(direction, post['status_id'])
+
+        return associate
+
+    for publisher in publishers:
+        publisher.associate_post = timed_associate_post(publisher.associate_post,
+                                                        DIRECTIONS[publisher.source_status])
+
+    outbox = publishers[0].outbox
+    outbox_done = outbox.done
+
+    def timed_outbox_done(source_status, post):
+        outbox_done(source_status, post)
+        timer.processed(DIRECTIONS[source_status], post['status_id'])
+
+    outbox.done = timed_outbox_done
+
+
+def post_statuses(network, medias, direction, timer, rate, duration, kinds, media_rate, seed, followed=0):
+    """
+    Posts statuses on a network, as the user would.
+    :param network: The fake network.
+    :param medias: The fake medias server, hosting the medias of the statuses.
+    :param direction: 'm2t' to post toots, 't2m' to post tweets.
+    :param followed: How many toots of followed accounts are received along with each toot of the user
+                     (on the Mastodon home timeline), on average.
+    """
+    rng = random.Random(seed)
+    end = time.monotonic() + duration
+
+    while True:
+        time.sleep(rng.expovariate(rate))
+        if time.monotonic() >= end:
+            return
+
+        status = generate_status(rng, rng.choice(kinds), network.next_id(), media_rate=media_rate)
+        status = status['toot'] if direction == 'm2t' else status['tweet']
+
+        timer.post(direction, status['id'])
+        network.inject(medias.rehost(status))
+
+        if direction == 'm2t':
+            for _ in range(round(rng.expovariate(1 / followed)) if followed else 0):
+                toot = generate_status(rng, rng.choice(kinds), network.next_id(), media_rate=media_rate)['toot']
+                number = rng.randrange(1000)
+                toot['account'] = {'id': 1000 + number, 'username': f'friend{number}', 'acct': f'friend{number}',
+                                   'url': f'https://elsewhere.example/@friend{number}'}
+                network.inject(medias.rehost(toot))
+
+
+def percentile(values, fraction):
+    """
+    :return: The percentile of the values (nearest rank), or None if there is no value.
+    """
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(fraction * len(values)) - 1))]
+
+
+def histogram_quantile(buckets, fraction):
+    """
+    :param buckets: The cumulated counts of a histogram, as (upper bound, count) tuples.
+    :return: The upper bound of the bucket containing the quantile.
+    """
+    total = buckets[-1][1]
+    for bound, count in buckets:
+        if count >= fraction * total:
+            return bound
+
+
+def stages_report():
+    """
+    Prints the time spent in each stage of the mirroring (see `mtt.metrics.timed`).
+    """
+    stages = {}
+    for name, labels, value in metrics.STAGE_DURATION.samples():
+        key = (labels['direction'], labels['stage'], labels['outcome'])
+        stage = stages.setdefault(key, {'buckets': []})
+
+        if name.endswith('_bucket'):
+            stage['buckets'].append((float(labels['le']), value))
+        else:
+            stage[name.rsplit('_', 1)[1]] = value
+
+    print(f'\n{"direction":<10} {"stage":<15} {"outcome":<10} {"count":>6} {"mean (s)":>9} {"p50 (s) ≤":>10} '
+          f'{"p99 (s) ≤":>10}')
+    for (direction, stage_name, outcome), stage in sorted(stages.items()):
+        print(f'{direction:<10} {stage_name:<15} {outcome:<10} {stage["count"]:>6} '
+              f'{stage["sum"] / stage["count"]:>9.4f} {histogram_quantile(stage["buckets"], 0.5):>10} '
+              f'{histogram_quantile(stage["buckets"], 0.99):>10}')
+
+    filtered = sorted((labels['direction'], labels['stage'], labels['outcome'], value)
+                      for _, labels, value in metrics.STREAM_FILTER.samples())
+    if filtered:
+        print('\nStreams pre-filter: ' + ', '.join(f'{direction} {stage} {outcome} {value}'
+                                                  for direction, stage, outcome, value in filtered))
+
+
+def report(timer, networks, duration):
+    print(f'{"direction":<10} {"posted":>7} {"mirrored":>9} {"dropped":>8} '
+          f'{"p50 (s)":>8} {"p90 (s)":>8} {"p99 (s)":>8} {"max (s)":>8}')
+
+    for direction in ('m2t', 't2m'):
+        posted = sum(1 for posted_direction, _ in timer.posted if posted_direction == direction)
+        if not posted:
+            continue
+
+        latencies = [latency for (latency_direction, _), latency in timer.latencies.items()
+                     if latency_direction == direction]
+        dropped = sum(1 for key in timer.done if key[0] == direction and key not in timer.latencies)
+        measures = [percentile(latencies, fraction) for fraction in (0.5, 0.9, 0.99)] + \
+                   [max(latencies) if latencies else None]
+
+        print(f'{direction:<10} {posted:>7} {len(latencies):>9} {dropped:>8} '
+              + ' '.join(f'{measure:>8.3f}' if measure is not None else f'{"-":>8}' for measure in measures))
+
+    if timer.latencies:
+        elapsed = timer.last_mirrored - timer.first_posted
+        print(f'\nThroughput: {len(timer.latencies) / elapsed:.2f} statuses/s '
+              f'({len(timer.latencies)} statuses mirrored in {elapsed:.1f} s, posted during {duration:.0f} s)')
+
+    print(f'\n{"API":<10} {"endpoint":<32} {"calls":>7} {"errors":>7} {"rejected":>9}')
+    for name, network in networks.items():
+        for endpoint, calls in sorted(network.calls.items()):
+            print(f'{name:<10} {endpoint:<32} {calls:>7} {network.errors[endpoint]:>7} '
+                  f'{network.rejected[endpoint]:>9}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the mirror latency against fake APIs.')
+    parser.add_argument('--direction', choices=['m2t', 't2m', 'both'], default='both',
+                        help='Mastodon to Twitter, Twitter to Mastodon, or both.')
+    parser.add_argument('--rate', type=float, default=2, help='The statuses posted per second, in each direction.')
+    parser.add_argument('--duration', type=float, default=20, help='How long statuses are posted (seconds).')
+    parser.add_argument('--drain', type=float, default=30,
+                        help='How long to wait for the statuses to be mirrored, after the last one (seconds).')
+    parser.add_argument('--kind', action='append', dest='kinds', choices=KINDS, help='A kind of statuses to post.')
+    parser.add_argument('--followed', type=float, default=0,
+                        help='How many toots of followed accounts are received along with each toot, on average.')
+    parser.add_argument('--media-rate', type=float, default=0.2, help='The fraction of statuses with a media.')
+    parser.add_argument('--media-size', type=int, default=256 * 1024, help='The size of the medias (bytes).')
+    parser.add_argument('--latency', type=float, default=0.1, help='The mean duration of the API calls (seconds).')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='The probability for an API call to fail.')
+    parser.add_argument('--rate-limit', type=int, help='The API calls accepted per endpoint and window.')
+    parser.add_argument('--rate-limit-window', type=float, default=60, help='The rate limits window (seconds).')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default=config.ENGINE, help='The engine.')
+    parser.add_argument('--workers', type=int, default=config.STATUS_WORKERS,
+                        help='The statuses processed at once, in each direction.')
+    parser.add_argument('--process-delay', type=float, default=config.STATUS_PROCESS_DELAY,
+                        help='The delay before a status is processed (seconds).')
+    parser.add_argument('--retry-delay', type=float, default=1, help='The delay before the first retry (seconds).')
+    parser.add_argument('--seed', type=int, default=0, help='The random seed.')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='The port of the metrics endpoint (a free one by default).')
+    parser.add_argument('--log-level', choices=('debug', 'info', 'warning', 'error'),
+                        help='Shows the crossposter logs of this level and above (none by default).')
+    args = parser.parse_args()
+
+    directions = ['m2t', 't2m'] if args.direction == 'both' else [args.direction]
+
+    with tempfile.TemporaryDirectory() as directory:
+        config.update({
+            'POST_ON_TWITTER': 'm2t' in directions,
+            'POST_ON_MASTODON': 't2m' in directions,
+            'ENGINE': args.engine,
+            'STATUS_WORKERS': args.workers,
+            'ASYNC_STATUS_CONCURRENCY': args.workers,
+            'STATUS_PROCESS_DELAY': args.process_delay,
+            'STREAM_HANDOFF_DELAY': 0.1,
+            'MASTODON_RETRY_DELAY': args.retry_delay,
+            'TWITTER_RETRY_DELAY': args.retry_delay,
+            'MEDIA_CACHE_ENABLED': False,
+            'METRICS_PORT': args.metrics_port,
+            'LOG_LEVEL': args.log_level,
+        })
+
+        network_options = dict(latency=args.latency, error_rate=args.error_rate, rate_limit=args.rate_limit,
+                               rate_limit_window=args.rate_limit_window)
+        networks = {
+            'Mastodon': FakeMastodon(seed=args.seed, **network_options).start(),
+            'Twitter': FakeTwitter(seed=args.seed + 1, **network_options).start(),
+            'Medias': FakeMedias(media_size=args.media_size, seed=args.seed + 2, **network_options).start(),
+        }
+
+        # Logged in as MTT does (see Account.login), but on the fake networks.
+        http_session = PooledSession()
+
+        account = Account(files={key: Path(directory) / file.name for key, file in config.FILES.items()})
+        account.mastodon_api = networks['Mastodon'].client(http_session)
+        account.twitter_api = networks['Twitter'].client(http_session)
+        mastodon_account = account.mastodon_api.account_verify_credentials()
+        account.mastodon_account = {key: mastodon_account[key] for key in ('id', 'username', 'acct', 'url')}
+        account.ma_account_id = account.mastodon_account['id']
+        account.tw_account_id = account.twitter_api.VerifyCredentials().id
+
+        timer = MirrorTimer()
+        publishers = account.create_publishers(
+            http_session=http_session,
+            media_executor=ThreadPoolExecutor(max_workers=config.MEDIA_TRANSFER_WORKERS)
+        )
+
+        instrument(publishers, timer)
+
+        metrics.collect_resources(publishers=publishers, http_session=http_session)
+        metrics_server = metrics.start_server()
+        print(f'Metrics available on http://{config.METRICS_ADDRESS}:{metrics_server.server_port}/metrics',
+              file=sys.stderr)
+
+        if args.engine == 'asyncio':
+            threading.Thread(target=AsyncEngine(publishers).run, daemon=True).start()
+        else:
+            for publisher in publishers:
+                publisher.daemon = True
+                publisher.start()
+
+        # Statuses are posted once the streams are connected, and the catch up is done.
+        while any(networks[name].open_streams == 0 for name, direction in (('Mastodon', 'm2t'),
+                                                                           ('Twitter', 't2m'))
+                  if direction in directions):
+            time.sleep(0.1)
+        time.sleep(2 * config.STREAM_HANDOFF_DELAY + args.latency * 5)
+
+        posters = [threading.Thread(target=post_statuses, args=(
+            networks['Mastodon' if direction == 'm2t' else 'Twitter'], networks['Medias'], direction, timer, args.rate,
+            args.duration, args.kinds or KINDS, args.media_rate, args.seed + i, args.followed
+        )) for i, direction in enumerate(directions)]
+
+        for poster in posters:
+            poster.start()
+        for poster in posters:
+            poster.join()
+
+        drain_end = time.monotonic() + args.drain
+        while timer.pending and time.monotonic() < drain_end:
+            time.sleep(0.1)
+
+    report(timer, networks, args.duration)
+    stages_report()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Measures the outbox throughput with concurrent writers, with fsyncs shared
+between writers and with one fsync per record, and checks that the journal
+replays to an empty outbox.
+
+Run from the project directory:
+
+    python -m benchmarks.outbox
+"""
+import os
+import tempfile
+import time
+
+from threading import Thread
+
+from mtt.outbox import Outbox
+
+
+class UnbatchedOutbox(Outbox):
+    """
+    An outbox syncing every record on its own, as a reference.
+    """
+    def _write(self, record):
+        written = super(UnbatchedOutbox, self)._write(record)
+        if written:
+            os.fsync(self._journal.fileno())
+            self._synced = written
+            self.stats['fsyncs'] += 1
+        return written
+
+
+def send(outbox, writer, count):
+    for i in range(count):
+        post = {'status_id': writer * count + i, 'parts': ['part 1/2', 'part 2/2'], 'media_urls': [],
+                'reply_to': None}
+
+        outbox.plan('toot', post)
+        outbox.sent('toot', post, 2 * i)
+        outbox.sent('toot', post, 2 * i + 1)
+        outbox.done('toot', post)
+
+
+def measure(outbox_class, directory, writers, count):
+    path = os.path.join(directory, f'{outbox_class.__name__}-{writers}.jsonl')
+    outbox = outbox_class(path).load()
+
+    threads = [Thread(target=send, args=(outbox, writer, count)) for writer in range(writers)]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+
+    outbox.close()
+    assert len(Outbox(path).load()) == 0, 'Statuses left in the outbox'
+
+    return writers * count / duration, outbox.stats['fsyncs']
+
+
+def main():
+    count = 100
+
+    with tempfile.TemporaryDirectory() as directory:
+        for writers in (1, 4, 16):
+            batched, batched_fsyncs = measure(Outbox, directory, writers, count)
+            unbatched, unbatched_fsyncs = measure(UnbatchedOutbox, directory, writers, count)
+
+            print(f'{writers:>2} writer(s): {batched:>8.0f} statuses/s with {batched_fsyncs} fsyncs, '
+                  f'{unbatched:>8.0f} statuses/s with one fsync per record ({unbatched_fsyncs} fsyncs)')
+
+
+if __name__ == '__main__':
+    main()
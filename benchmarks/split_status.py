@@ -0,0 +1,110 @@
+"""
+Compares `mtt.utils.split_status` with its previous implementation, which
+re-computed the expected length of the whole current part for each word.
+
+Run from the project directory:
+
+    python -m benchmarks.split_status
+"""
+import random
+import timeit
+import twitter
+
+from mtt import utils
+from mtt.utils import calc_expected_status_length
+
+
+def split_status_reference(status, max_length, split=True, url=None, url_length=None):
+    """
+    The previous, quadratic, implementation of `mtt.utils.split_status`,
+    kept here as a reference.
+
+    status:     The status text to split
+    max_length: The maximal length of each sub status
+    split:      If true (default), will split in multiple status; else,
+                will append the URL.
+    url:        If split=False, the URL to append.
+    url_length: The length of a Twitter URL (after some reduction).
+    """
+    content_parts = []
+
+    if not url_length:
+        url_length = 24
+
+    max_length -= 6
+
+    if calc_expected_status_length(status, short_url_length=url_length) > max_length:
+        current_part = ''
+        for next_word in status.split(' '):
+            # Need to split here?
+            if calc_expected_status_length(current_part + ' ' + next_word, short_url_length=url_length) > max_length:
+                space_left = max_length - 5 - calc_expected_status_length(current_part, short_url_length=url_length) - 1
+
+                if split:
+                    # Want to split word?
+                    if len(next_word) > 30 and space_left > 5 and not twitter.twitter_utils.is_url(next_word):
+                        current_part = current_part + " " + next_word[:space_left]
+                        content_parts.append(current_part)
+                        current_part = next_word[space_left:]
+                    else:
+                        content_parts.append(current_part)
+                        current_part = next_word
+
+                    # Split potential overlong word in current_part
+                    while len(current_part) > max_length - 5:
+                        content_parts.append(current_part[:max_length - 5])
+                        current_part = current_part[max_length - 5:]
+                else:
+                    space_for_suffix = len('… ') + url_length
+                    content_parts.append(current_part[:-space_for_suffix] + '… ' + url)
+                    current_part = ''
+                    break
+            else:
+                # Just plop next word on
+                current_part = current_part + ' ' + next_word
+
+        # Insert last part
+        if len(current_part.strip()) != 0 or len(content_parts) == 0:
+            content_parts.append(current_part.strip())
+
+    else:
+        content_parts.append(status)
+
+    parts = len(content_parts)
+    if split and parts > 1:
+        for i in range(parts):
+            content_parts[i] += f' — {i + 1}/{parts}'
+
+    return content_parts
+
+
+def generate_toot(words, seed=0):
+    """
+    Generates a long toot full of URLs.
+    :param words: The number of words in the toot.
+    :param seed: The random seed.
+    """
+    rng = random.Random(seed)
+    vocabulary = ['the', 'toot', 'about', 'a', 'long', 'thread', 'with', 'some', 'links', 'in', 'it', '\n\nso',
+                  'https://example.com/some/path?query=1', 'www.python.org', 'mastodon.social/@user/1234',
+                  'https://en.wikipedia.org/wiki/Fediverse', 'bit.ly/abc']
+    return ' '.join(rng.choice(vocabulary) for _ in range(words))
+
+
+def main():
+    for words in (50, 200, 800):
+        toot = generate_toot(words)
+        assert utils.split_status(toot, 280) == split_status_reference(toot, 280)
+
+        number = max(1, 2000 // words)
+        current = timeit.timeit(lambda: utils.split_status(toot, 280), number=number) / number
+        reference = timeit.timeit(lambda: split_status_reference(toot, 280), number=number) / number
+
+        print(f'{words:>4} words, {len(toot):>6} chars: '
+              f'split_status {current * 1000:8.2f} ms, '
+              f'reference {reference * 1000:8.2f} ms '
+              f'(x{reference / current:.1f})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+Measures the text processing of statuses on a generated corpus (see
+`benchmarks.corpus`), for each kind of statuses:
+
+- calc_expected_status_length: the length of a status on Twitter;
+- split_status: the split of a toot in tweets;
+- toot_html: the conversion of a toot to the text to tweet;
+- tweet_text: the conversion of a tweet to the text to toot.
+
+For each, it reports the throughput and the memory allocated while
+processing a status (the peak traced by tracemalloc, on average and at
+most).
+
+The results can be saved, and compared to results saved before (e.g. on
+another revision):
+
+    python -m benchmarks.suite --save
+    git checkout other-revision
+    python -m benchmarks.suite --compare benchmarks/results/<revision>.json
+
+Run from the project directory:
+
+    python -m benchmarks.suite [--count N] [--repeat N] [--case NAME]... [--save [PATH]] [--compare PATH]
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import timeit
+import tracemalloc
+
+from datetime import datetime, timezone
+
+from benchmarks.corpus import KINDS, MASTODON_URL, generate_corpus
+from mtt.converters import TootConverter, TweetConverter
+from mtt.utils import calc_expected_status_length, split_status
+
+RESULTS_PATH = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def cases():
+    """
+    :return: A dict mapping the name of each case to a function processing a
+             status (see `benchmarks.corpus.generate_status`).
+    """
+    toot_converter = TootConverter(MASTODON_URL)
+    tweet_converter = TweetConverter()
+
+    return {
+        'calc_expected_status_length': lambda status: calc_expected_status_length(status['text']),
+        'split_status': lambda status: split_status(status['text'], 280),
+        'toot_html': lambda status: toot_converter.convert_toot(status['toot']),
+        'tweet_text': lambda status: tweet_converter.convert_tweet(status['tweet']),
+    }
+
+
+def measure_time(function, statuses, repeat):
+    """
+    :return: The best time to process all the statuses (seconds).
+    """
+    def run():
+        for status in statuses:
+            function(status)
+
+    number = max(1, 1000 // len(statuses))
+    return min(timeit.repeat(run, number=number, repeat=repeat)) / number
+
+
+def measure_allocations(function, statuses):
+    """
+    :return: The mean and maximal peaks of memory allocated while processing
+             a status (bytes).
+    """
+    peaks = []
+
+    # Tracing is started for each status, for its peak to be fresh
+    # (`tracemalloc.reset_peak` only exists from Python 3.9).
+    for status in statuses:
+        tracemalloc.start()
+        try:
+            function(status)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        peaks.append(peak)
+
+    return sum(peaks) / len(peaks), max(peaks)
+
+
+def run(count, repeat, names=None):
+    """
+    Runs the benchmarks.
+    :param count: The number of statuses of each kind.
+    :param repeat: The number of times to measure each case (the best time is kept).
+    :param names: The cases to run (all by default).
+    :return: The results, as a dict mapping each case to a dict mapping each kind of statuses
+             to the measures.
+    """
+    corpus = generate_corpus(count)
+    results = {}
+
+    for name, function in cases().items():
+        if names and name not in names:
+            continue
+
+        results[name] = {}
+        for kind in KINDS:
+            statuses = corpus[kind]
+            duration = measure_time(function, statuses, repeat)
+            mean_peak, max_peak = measure_allocations(function, statuses)
+
+            results[name][kind] = {
+                'statuses_per_second': len(statuses) / duration,
+                'us_per_status': duration / len(statuses) * 1e6,
+                'peak_bytes_mean': mean_peak,
+                'peak_bytes_max': max_peak,
+            }
+
+    return results
+
+
+def revision():
+    """
+    :return: The current git revision (with a `-dirty` suffix if there are local changes), or None.
+    """
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True, check=True,
+                              cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, reference=None):
+    """
+    Prints the results, compared to the reference results if given.
+    """
+    print(f'{"case":<28} {"kind":<12} {"statuses/s":>12} {"µs/status":>10} {"peak KiB":>9} {"max KiB":>8}'
+          + (f' {"speed":>8} {"peak":>8}' if reference else ''))
+
+    for name, kinds in results.items():
+        for kind, measures in kinds.items():
+            line = f'{name:<28} {kind:<12} {measures["statuses_per_second"]:>12.0f} ' \
+                   f'{measures["us_per_status"]:>10.2f} {measures["peak_bytes_mean"] / 1024:>9.1f} ' \
+                   f'{measures["peak_bytes_max"] / 1024:>8.1f}'
+
+            previous = (reference or {}).get(name, {}).get(kind)
+            if previous:
+                speed = measures['statuses_per_second'] / previous['statuses_per_second'] - 1
+                peak = measures['peak_bytes_mean'] / previous['peak_bytes_mean'] - 1 \
+                    if previous['peak_bytes_mean'] else 0
+                line += f' {speed:>+8.1%} {peak:>+8.1%}'
+
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the text processing of statuses.')
+    parser.add_argument('--count', type=int, default=200, help='The number of statuses of each kind.')
+    parser.add_argument('--repeat', type=int, default=5, help='The number of measures of each case.')
+    parser.add_argument('--case', action='append', dest='cases', choices=list(cases()), help='A case to run.')
+    parser.add_argument('--save', nargs='?', const='', metavar='PATH',
+                        help=f'Saves the results (in {RESULTS_PATH}/<revision>.json by default).')
+    parser.add_argument('--compare', metavar='PATH', help='Compares to results saved before.')
+    args = parser.parse_args()
+
+    reference = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as reference_file:
+            saved = json.load(reference_file)
+        reference = saved['results']
+        print(f'Compared to {saved["revision"]} ({saved["date"]}, Python {saved["python"]}).')
+
+    results = run(args.count, args.repeat, args.cases)
+    print_results(results, reference)
+
+    if args.save is not None:
+        current_revision = revision()
+        path = args.save or os.path.join(RESULTS_PATH, f'{current_revision or "unknown"}.json')
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as results_file:
+            json.dump({
+                'revision': current_revision,
+                'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'count': args.count,
+                'results': results,
+            }, results_file, indent=2)
+
+        print(f'Results saved in {path}.', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
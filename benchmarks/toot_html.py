@@ -0,0 +1,85 @@
+"""
+Checks that `mtt.converters.TootConverter` converts toots like the previous
+chain of regular expressions, and compares their speed. The only difference
+allowed is the whitespace left by the chain at the end of the text, before a
+media URL it removed.
+
+Run from the project directory:
+
+    python -m benchmarks.toot_html
+"""
+import html
+import random
+import re
+import string
+import timeit
+
+from mtt.converters import TootConverter
+
+BASE_URL = 'https://mastodon.example/'
+
+
+def legacy_toot_to_text(content, media_regexp):
+    content_clean = re.sub(r'<a [^>]*href="([^"]+)">[^<]*</a>', r'\g<1>', content)
+    content_clean = "\n".join(re.compile(r'<br ?/?>', re.IGNORECASE).split(content_clean))
+    content_clean = "\n\n".join(re.compile(r'</p><p>', re.IGNORECASE).split(content_clean))
+    content_clean = html.unescape(str(re.compile(r'<.*?>').sub("", content_clean).strip()))
+    return re.sub(media_regexp, "", content_clean)
+
+
+def generate_toot(rng, max_paragraphs=4, max_words=40):
+    """
+    Generates a toot content, as formatted by Mastodon.
+    :param rng: The random generator.
+    :param max_paragraphs: The maximal number of paragraphs.
+    :param max_words: The maximal number of words (or links, mentions…) per paragraph.
+    """
+    def link(url):
+        scheme, rest = url.split('://', 1)
+        return f'<a href="{url}" rel="nofollow noopener" target="_blank"><span class="invisible">{scheme}://</span>' \
+               f'<span class="ellipsis">{rest[:30]}</span><span class="invisible">{rest[30:]}</span></a>'
+
+    words = [
+        'hello', 'world', 'toot', 'lorem', 'ipsum', '&amp;', '&lt;3', '&quot;quoted&quot;', '&#39;', 'café', '🎉',
+        '<span class="h-card"><a href="https://mastodon.example/@alice" class="u-url mention">@<span>alice</span></a>'
+        '</span>',
+        '<a href="https://mastodon.example/tags/mtt" class="mention hashtag" rel="tag">#<span>mtt</span></a>',
+        link('https://example.com/a/very/long/path/to/some/article?with=query&amp;and=more'),
+        link('https://mastodon.example/media/AbCdEf123'),
+        '<a href="https://short.example">short.example</a>',
+        '<a href="https://mastodon.example/media/XyZ987">https://mastodon.example/media/XyZ987</a>',
+        '<br />', '<br>', '<BR/>', '&nbsp;', '  ',
+    ]
+
+    paragraphs = [' '.join(rng.choice(words) for _ in range(rng.randint(1, max_words)))
+                  for _ in range(rng.randint(1, max_paragraphs))]
+    return '<p>' + '</p><p>'.join(paragraphs) + '</p>'
+
+
+def main():
+    rng = random.Random(0)
+    corpora = {
+        'short toots': [generate_toot(rng, max_paragraphs=2, max_words=15) for _ in range(5000)],
+        'long toots': [generate_toot(rng) for _ in range(5000)]
+    }
+
+    converter = TootConverter(BASE_URL)
+    media_regexp = re.compile(re.escape(BASE_URL.rstrip('/')) + r'/media/(\w)+(\s|$)+')
+
+    for name, corpus in corpora.items():
+        for content in corpus:
+            # The chain strips the text before removing the media URLs.
+            expected = legacy_toot_to_text(content, media_regexp).rstrip(string.whitespace)
+            converted = converter.convert(content)
+            assert expected == converted, f'Conversion mismatch for {content!r}: {expected!r} != {converted!r}'
+
+        current = timeit.timeit(lambda: [converter.convert(content) for content in corpus], number=5) / 5
+        reference = timeit.timeit(lambda: [legacy_toot_to_text(content, media_regexp) for content in corpus],
+                                  number=5) / 5
+
+        print(f'{name} (same text for {len(corpus)} toots): TootConverter {current / len(corpus) * 1e6:.1f} µs/toot, '
+              f'legacy {reference / len(corpus) * 1e6:.1f} µs/toot (x{reference / current:.1f})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Checks that `mtt.urls.find_urls` finds exactly the same URLs as the
+previous `URL_REGEXP` (an alternation of all TLDs), and compares their
+construction and matching times.
+
+Run from the project directory:
+
+    python -m benchmarks.url_detection
+"""
+import random
+import re
+import time
+import timeit
+import twitter
+
+from mtt import urls
+
+
+def legacy_url_regexp():
+    return re.compile((
+        r'('
+        r'(?!(https?://|www\.)?\.|ftps?://|([0-9]+\.){{1,3}}\d+)'  # exclude urls that start with "."
+        r'(?:https?://|www\.)*(?!.*@)(?:[\w+-_]+[.])'              # beginning of url
+        r'(?:{0}\b|'                                               # all tlds
+        r'(?:[:0-9]))'                                             # port numbers & close off TLDs
+        r'(?:[\w+\/]?[a-z0-9!\*\'\(\);:&=\+\$/%#\[\]\-_\.,~?])*'   # path/query params
+        r')').format(r'\b|'.join(twitter.twitter_utils.TLDS)), re.U | re.I | re.X)
+
+
+def generate_corpus(count, seed=0):
+    """
+    Generates statuses mixing words, URLs, e-mails, IPs and lookalikes.
+    :param count: The number of statuses.
+    :param seed: The random seed.
+    """
+    rng = random.Random(seed)
+    tlds = rng.sample(twitter.twitter_utils.TLDS, 50)
+    vocabulary = ['hello', 'world', 'it.s', 'e.g.', 'v1.2.3', '10.0.0.1', '192.168.1.1:8080', '.net', 'a.b',
+                  'mail@example.com', '@user@mastodon.social', 'https://t.co/AbC', 'http://foo.bar/baz?x=1#y',
+                  'www.example.org', 'example.com:8080/path', 'ftp://files.example.com', 'EXAMPLE.COM', 'x.c',
+                  'foo.community', 'foo.co.uk/', '(see: example.io)', '"quoted.fr"', 'émoji.🎉.com', '\n', 'a.123']
+    vocabulary += ['site.' + tld for tld in tlds] + ['https://sub.site.' + tld + '/p' for tld in tlds]
+
+    return [' '.join(rng.choice(vocabulary) for _ in range(rng.randint(1, 60))) for _ in range(count)]
+
+
+def main():
+    start = time.perf_counter()
+    legacy = legacy_url_regexp()
+    legacy_build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    urls._load_tlds()
+    current_build = time.perf_counter() - start
+
+    corpus = generate_corpus(2000)
+
+    for status in corpus:
+        expected = [match.span() for match in legacy.finditer(status)]
+        found = [match.span() for match in urls.find_urls(status)]
+        assert expected == found, f'URLs mismatch in {status!r}: {expected} != {found}'
+
+    print(f'Same URLs found in {len(corpus)} statuses.')
+    print(f'Construction: find_urls {current_build * 1000:.1f} ms, legacy {legacy_build * 1000:.1f} ms')
+
+    current = timeit.timeit(lambda: [list(urls.find_urls(status)) for status in corpus], number=3) / 3
+    reference = timeit.timeit(lambda: [list(legacy.finditer(status)) for status in corpus], number=3) / 3
+    print(f'Matching: find_urls {current * 1000:.1f} ms, legacy {reference * 1000:.1f} ms (x{reference / current:.1f})')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,122 +1,89 @@
-import json
-import twitter
+from concurrent.futures import ThreadPoolExecutor
 
-from mastodon import Mastodon
-
-from mtt import config
+from mtt import config, metrics, profiling
 
+from mtt.accounts import load_accounts
+from mtt.async_engine import AsyncEngine
 from mtt.credentials import check_credentials, setup_credentials
-from mtt.mastodon_to_twitter import TwitterPublisher
-from mtt.twitter_to_mastodon import MastodonPublisher
+from mtt.media_cache import MediaCache
+from mtt.sessions import PooledSession
+from mtt.startup import StartupTimer
 from mtt.utils import lgt
 
+startup = StartupTimer()
+
 
 #
 # First step: check credentials
 #
 
-if not check_credentials():
-    setup_credentials()
+# Each account is a Mastodon account and a Twitter account mirrored to each
+# other. There is only one, unless ACCOUNTS_DIRECTORY contains accounts.
+with startup.phase('credentials'):
+    accounts = load_accounts()
+
+    for account in accounts:
+        if not check_credentials(account.files):
+            if account.name:
+                lgt(f'Setting up credentials for account {account.name}.')
+            setup_credentials(account.files)
 
 lgt('Everything looks good; starting…')
 
 
 #
-# Read in credentials
+# Shared resources
 #
 
-with config.FILES['credentials_twitter'].open('r') as secret_file:
-    TWITTER_CONSUMER_KEY = secret_file.readline().rstrip()
-    TWITTER_CONSUMER_SECRET = secret_file.readline().rstrip()
-    TWITTER_ACCESS_KEY = secret_file.readline().rstrip()
-    TWITTER_ACCESS_SECRET = secret_file.readline().rstrip()
+with startup.phase('resources'):
+    # All HTTP traffic (APIs and medias) goes through the same connections pools.
+    http_session = PooledSession()
 
-with config.FILES['credentials_mastodon_server'].open('r') as secret_file:
-    MASTODON_BASE_URL = secret_file.readline().rstrip()
+    # Downloaded medias are kept for some time, so the same media transferred
+    # more than once (re-posted, retried…) is not downloaded or uploaded again.
+    media_cache = MediaCache().load() if config.MEDIA_CACHE_ENABLED else None
+
+    # Medias of all accounts are transferred by the same threads.
+    media_executor = ThreadPoolExecutor(max_workers=config.MEDIA_TRANSFER_WORKERS, thread_name_prefix='Medias')
 
 
 #
-# Log in
+# Log in and startup
 #
 
-mastodon_api = Mastodon(
-    client_id=config.FILES['credentials_mastodon_client'],
-    access_token=config.FILES['credentials_mastodon_user'],
-    ratelimit_method='wait',
-    api_base_url=MASTODON_BASE_URL
-)
-twitter_api = twitter.Api(
-    consumer_key=TWITTER_CONSUMER_KEY,
-    consumer_secret=TWITTER_CONSUMER_SECRET,
-    access_token_key=TWITTER_ACCESS_KEY,
-    access_token_secret=TWITTER_ACCESS_SECRET,
-    tweet_mode='extended'  # Allows tweets longer than 140/280 raw characters
-)
-
-ma_account_id = mastodon_api.account_verify_credentials()["id"]
-tw_account_id = twitter_api.VerifyCredentials().id
+# All accounts are logged in concurrently.
+with startup.phase('login'), ThreadPoolExecutor(max_workers=len(accounts), thread_name_prefix='Login') as executor:
+    for login in [executor.submit(account.login, http_session=http_session) for account in accounts]:
+        login.result()
 
-#
-# Tweets / toots association
-#
+publishers = []
 
-# Loads tweets/toots associations to be able to mirror threads
-# This links the toots and tweets. For links from Mastodon to
-# Twitter, the toot listed is the last one of the generated thread
-# if the toot is too long to fit into a single tweet.
-status_associations = {'m2t': {}, 't2m': {}}
-try:
-    with open('mtt_status_associations.json', 'r') as f:
-        status_associations['m2t'] = json.load(f, object_hook=lambda d: {int(k): v for k, v in d.items()})
-        status_associations['t2m'] = {tweet_id: toot_id for toot_id, tweet_id in status_associations['m2t'].items()}
-except IOError:
-    pass
+with startup.phase('publishers'):
+    for account in accounts:
+        publishers += account.create_publishers(
+            media_cache=media_cache,
+            http_session=http_session,
+            media_executor=media_executor
+        )
 
+if config.METRICS_PORT is not None:
+    metrics.collect_resources(publishers=publishers, http_session=http_session, media_cache=media_cache)
+    metrics_server = metrics.start_server()
+    lgt(f'Metrics available on http://{config.METRICS_ADDRESS}:{metrics_server.server_port}/metrics')
 
-#
-# Sent toots/tweets list
-#
+# Profiles can be taken on demand, by sending a signal to the process.
+profiling.profiler.configure()
+profiling.profiler.install_signal_handler()
 
-# To avoid bouncing toots or tweets, we keep the ID of the status we sent to
-# avoid re-sending them indefinitely.
-# Unlike status_associations, this contains _every_ status sent including
-# intermediate tweets if toots are too long.
-sent_status = {'toots': [], 'tweets': []}
+# The publishers then fetch their timelines to start from, and catch up, on their own.
+startup.report()
 
+if config.ENGINE == 'asyncio':
+    AsyncEngine(publishers).run()
 
-#
-# Startup
-#
+else:
+    for publisher in publishers:
+        publisher.start()
 
-if config.POST_ON_TWITTER:
-    twitter_publisher = TwitterPublisher(
-        name='Mastodon -> Twitter',
-        mastodon_api=mastodon_api,
-        twitter_api=twitter_api,
-        ma_account_id=ma_account_id,
-        tw_account_id=tw_account_id,
-        status_associations=status_associations,
-        sent_status=sent_status
-    )
-
-    twitter_publisher.start()
-
-if config.POST_ON_MASTODON:
-    mastodon_publisher = MastodonPublisher(
-        name='Twitter -> Mastodon',
-        mastodon_api=mastodon_api,
-        twitter_api=twitter_api,
-        ma_account_id=ma_account_id,
-        tw_account_id=tw_account_id,
-        status_associations=status_associations,
-        sent_status=sent_status
-    )
-
-    mastodon_publisher.start()
-
-
-if config.POST_ON_TWITTER:
-    twitter_publisher.join()
-
-if config.POST_ON_MASTODON:
-    mastodon_publisher.join()
+    for publisher in publishers:
+        publisher.join()
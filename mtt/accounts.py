@@ -0,0 +1,212 @@
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from path import Path
+
+from mtt import config
+from mtt.associations import StatusAssociations
+from mtt.checkpoints import Checkpoints
+from mtt.outbox import Outbox
+from mtt.startup import StartupCache, credentials_fingerprint
+from mtt.utils import ExpiringSet
+
+# The files shared by all accounts; the other ones are stored per account.
+SHARED_FILES = ['media_cache']
+
+
+class Account:
+    """
+    A Mastodon account and a Twitter account, mirrored to each other.
+
+    Each account has its own credentials, status associations, checkpoints, outbox and startup
+    cache files.
+    """
+    def __init__(self, name=None, files=None):
+        """
+        :param name: The account name, used to namespace logs; None for the only account.
+        :param files: The account files (same keys as `config.FILES`).
+        """
+        self.name = name
+        self.files = files or config.FILES
+
+        self.mastodon_api = None
+        self.twitter_api = None
+        self.ma_account_id = None
+        self.tw_account_id = None
+        self.mastodon_account = None
+        self.startup_cache = None
+
+    @classmethod
+    def from_directory(cls, directory):
+        """
+        :param directory: A directory containing the account files, named as in `config.FILES`.
+        :return: The account, named after the directory.
+        """
+        directory = Path(directory)
+        files = {key: file if key in SHARED_FILES else directory / file.name for key, file in config.FILES.items()}
+
+        return cls(name=directory.name, files=files)
+
+    def login(self, http_session=None):
+        """
+        Reads the credentials, logs in on both networks and retrieves the accounts identities.
+
+        Both networks are logged in concurrently. The identities are kept in
+        the startup cache, so they are only retrieved again when they expire
+        or when the credentials change.
+        :param http_session: The requests session to use for both APIs.
+        """
+        self.startup_cache = StartupCache(
+            self.files['startup_cache'],
+            fingerprint=credentials_fingerprint(self.files)
+        ).load()
+
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix=f'{self.name or "MTT"} (login)') as executor:
+            logins = [executor.submit(self.login_mastodon, http_session),
+                      executor.submit(self.login_twitter, http_session)]
+
+            for login in logins:
+                login.result()
+
+    def login_mastodon(self, http_session=None):
+        # Imported here, as it is slow to import: meanwhile, Twitter is logged in.
+        from mastodon import Mastodon
+
+        with self.files['credentials_mastodon_server'].open('r') as secret_file:
+            mastodon_base_url = secret_file.readline().rstrip()
+
+        self.mastodon_api = Mastodon(
+            client_id=self.files['credentials_mastodon_client'],
+            access_token=self.files['credentials_mastodon_user'],
+            ratelimit_method='throw' if config.RATE_LIMIT_PACING else 'wait',  # Paced by the HTTP session
+            api_base_url=mastodon_base_url,
+            session=http_session
+        )
+
+        def verify_credentials():
+            account = self.mastodon_api.account_verify_credentials()
+            return {key: account[key] for key in ('id', 'username', 'acct', 'url')}
+
+        self.mastodon_account = self.startup_cache.fetch('mastodon_account', verify_credentials)
+        self.ma_account_id = self.mastodon_account['id']
+
+    def login_twitter(self, http_session=None):
+        # Imported here, as it is slow to import: meanwhile, Mastodon is logged in.
+        import twitter
+
+        with self.files['credentials_twitter'].open('r') as secret_file:
+            twitter_consumer_key = secret_file.readline().rstrip()
+            twitter_consumer_secret = secret_file.readline().rstrip()
+            twitter_access_key = secret_file.readline().rstrip()
+            twitter_access_secret = secret_file.readline().rstrip()
+
+        self.twitter_api = twitter.Api(
+            consumer_key=twitter_consumer_key,
+            consumer_secret=twitter_consumer_secret,
+            access_token_key=twitter_access_key,
+            access_token_secret=twitter_access_secret,
+            tweet_mode='extended'  # Allows tweets longer than 140/280 raw characters
+        )
+
+        if http_session is not None:
+            self.twitter_api._session = http_session
+
+        self.tw_account_id = self.startup_cache.fetch('twitter_user_id',
+                                                      lambda: self.twitter_api.VerifyCredentials().id)
+
+    def create_publishers(self, media_cache=None, http_session=None, media_executor=None):
+        """
+        Creates the publishers for this account, depending on `POST_ON_TWITTER`
+        and `POST_ON_MASTODON`.
+
+        :param media_cache: The media cache, shared by all accounts.
+        :param http_session: The requests session, shared by all accounts.
+        :param media_executor: The executor transferring medias, shared by all accounts.
+        :return: The publishers (not started).
+        """
+        # Imported here, as they import the (slow to import) APIs clients.
+        from mtt.mastodon_to_twitter import TwitterPublisher
+        from mtt.twitter_to_mastodon import MastodonPublisher
+
+        # Loads tweets/toots associations to be able to mirror threads
+        # This links the toots and tweets. For links from Mastodon to
+        # Twitter, the tweet listed for a toot is the last one of the
+        # generated thread if the toot is too long to fit into a single
+        # tweet; all the tweets of the thread are linked to the toot.
+        status_associations = StatusAssociations(
+            journal_path=self.files['status_associations_journal'],
+            legacy_path=self.files['status_associations']
+        ).load()
+
+        # To avoid bouncing toots or tweets, we keep the ID of the status we sent to
+        # avoid re-sending them indefinitely.
+        # Unlike status_associations, which is only updated once all the parts of
+        # a status are sent, this contains _every_ status as soon as it is sent.
+        # Statuses are only kept for a few minutes, the time for the streams to
+        # deliver them back to us.
+        sent_status = {
+            'toots': ExpiringSet(ttl=config.SENT_STATUS_TTL, max_size=config.SENT_STATUS_MAX_SIZE),
+            'tweets': ExpiringSet(ttl=config.SENT_STATUS_TTL, max_size=config.SENT_STATUS_MAX_SIZE)
+        }
+
+        # The last status processed in each direction, to catch up on the
+        # statuses posted while we were not listening.
+        checkpoints = Checkpoints(self.files['checkpoints']).load()
+
+        # The statuses being sent, to resume them if the process stops.
+        outbox = Outbox(self.files['outbox']).load()
+
+        prefix = f'{self.name}: ' if self.name else ''
+        publishers = []
+
+        if config.POST_ON_TWITTER:
+            publishers.append(TwitterPublisher(
+                name=f'{prefix}Mastodon -> Twitter',
+                mastodon_api=self.mastodon_api,
+                twitter_api=self.twitter_api,
+                ma_account_id=self.ma_account_id,
+                tw_account_id=self.tw_account_id,
+                status_associations=status_associations,
+                sent_status=sent_status,
+                media_cache=media_cache,
+                http_session=http_session,
+                media_executor=media_executor,
+                checkpoints=checkpoints,
+                outbox=outbox,
+                mastodon_account=self.mastodon_account,
+                startup_cache=self.startup_cache
+            ))
+
+        if config.POST_ON_MASTODON:
+            publishers.append(MastodonPublisher(
+                name=f'{prefix}Twitter -> Mastodon',
+                mastodon_api=self.mastodon_api,
+                twitter_api=self.twitter_api,
+                ma_account_id=self.ma_account_id,
+                tw_account_id=self.tw_account_id,
+                status_associations=status_associations,
+                sent_status=sent_status,
+                media_cache=media_cache,
+                http_session=http_session,
+                media_executor=media_executor,
+                checkpoints=checkpoints,
+                outbox=outbox
+            ))
+
+        return publishers
+
+
+def load_accounts():
+    """
+    Lists the accounts to mirror: one per sub-directory of `ACCOUNTS_DIRECTORY`
+    if there is any, else the single account configured in `config.FILES`.
+    """
+    directory = config.ACCOUNTS_DIRECTORY
+
+    if directory and os.path.isdir(directory):
+        accounts = [Account.from_directory(os.path.join(directory, name)) for name in sorted(os.listdir(directory))
+                    if os.path.isdir(os.path.join(directory, name))]
+        if accounts:
+            return accounts
+
+    return [Account()]
@@ -0,0 +1,168 @@
+import json
+import os
+
+from threading import Lock
+
+from mtt import config
+
+
+class StatusAssociations:
+    """
+    Stores the tweets/toots associations in an append-only journal.
+
+    Each association is written as a single JSON line and synced to disk,
+    so saving an association costs the same regardless of the account
+    history. A torn last line (e.g. after a crash) is ignored on load.
+    The journal is compacted at startup when it holds too many stale
+    entries.
+
+    The legacy `mtt_status_associations.json` file is imported on first
+    load, and left untouched.
+
+    Associations are available through the `m2t` and `t2m` dicts, also
+    accessible as `associations['m2t']` and `associations['t2m']`. A toot
+    can be associated with several tweets (the parts of a thread): they are
+    all in `t2m`, and the last one associated is the one in `m2t`.
+    """
+    def __init__(self, journal_path=None, legacy_path=None):
+        self.journal_path = journal_path or config.FILES['status_associations_journal']
+        self.legacy_path = legacy_path or config.FILES['status_associations']
+
+        self.m2t = {}
+        self.t2m = {}
+
+        self._journal = None
+        self._journal_entries = 0
+        self._journal_torn = False
+        self._write_lock = Lock()
+
+    def __getitem__(self, item):
+        if item == 'm2t':
+            return self.m2t
+        elif item == 't2m':
+            return self.t2m
+
+        raise KeyError(item)
+
+    def __len__(self):
+        return len(self.m2t)
+
+    def load(self):
+        """
+        Loads the associations from the journal (or the legacy JSON file if
+        there is no journal yet), and opens the journal for appending.
+        """
+        if os.path.exists(self.journal_path):
+            self._load_journal()
+        else:
+            self._load_legacy()
+            self.compact()
+
+        # A torn line must be dropped before appending to the journal again.
+        if self._journal_torn or \
+                self._journal_entries > len(self.t2m) * config.STATUS_ASSOCIATIONS_COMPACTION_RATIO:
+            self.compact()
+
+        self._open_journal()
+        return self
+
+    def _load_journal(self):
+        with open(self.journal_path, 'r') as f:
+            for line in f:
+                try:
+                    toot_id, tweet_id = json.loads(line)
+                except ValueError:
+                    # Torn write: the process died while appending this line.
+                    self._journal_torn = True
+                    continue
+
+                self._set(toot_id, tweet_id)
+                self._journal_entries += 1
+
+    def _load_legacy(self):
+        try:
+            with open(self.legacy_path, 'r') as f:
+                associations = json.load(f, object_hook=lambda d: {int(k): v for k, v in d.items()})
+        except (IOError, ValueError):
+            return
+
+        for toot_id, tweet_id in associations.items():
+            self._set(toot_id, tweet_id)
+
+    def _open_journal(self):
+        self._journal = open(self.journal_path, 'a')
+
+    def _set(self, toot_id, tweet_id):
+        self.m2t[toot_id] = tweet_id
+        self.t2m[tweet_id] = toot_id
+
+    def associate(self, toot_id, tweet_id):
+        """
+        Associates a tweet and a toot, and appends the association to the journal.
+        :param toot_id: The toot ID
+        :param tweet_id: The tweet ID
+        """
+        self.add([(toot_id, tweet_id)])
+        self.append([(toot_id, tweet_id)])
+
+    def add(self, associations):
+        """
+        Associates tweets and toots in memory only (see `append`).
+        :param associations: The (toot ID, tweet ID) pairs, in order.
+        """
+        for toot_id, tweet_id in associations:
+            self._set(toot_id, tweet_id)
+
+    def append(self, associations):
+        """
+        Appends associations to the journal, and syncs it to disk once. This
+        does not need the associations to be added yet, so it can be done
+        outside of the locks guarding the dicts.
+        :param associations: The (toot ID, tweet ID) pairs, in order.
+        """
+        with self._write_lock:
+            if self._journal is None:
+                return
+
+            for toot_id, tweet_id in associations:
+                self._journal.write(json.dumps([toot_id, tweet_id]) + '\n')
+                self._journal_entries += 1
+
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+
+    def compact(self):
+        """
+        Rewrites the journal with only the current associations. The new
+        journal is written aside and atomically swapped in.
+        """
+        with self._write_lock:
+            temp_path = str(self.journal_path) + '.tmp'
+
+            with open(temp_path, 'w') as f:
+                # The tweets not in m2t (intermediate parts of threads) first, so
+                # the ones in m2t are the last associated when the journal is loaded.
+                for tweet_id, toot_id in self.t2m.items():
+                    if self.m2t.get(toot_id) != tweet_id:
+                        f.write(json.dumps([toot_id, tweet_id]) + '\n')
+                for toot_id, tweet_id in self.m2t.items():
+                    f.write(json.dumps([toot_id, tweet_id]) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+            reopen = self._journal is not None
+            if reopen:
+                self._journal.close()
+
+            os.replace(temp_path, self.journal_path)
+            self._journal_entries = len(self.t2m)
+            self._journal_torn = False
+
+            if reopen:
+                self._open_journal()
+
+    def close(self):
+        with self._write_lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
@@ -0,0 +1,282 @@
+import asyncio
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Thread
+
+from mtt import config, logs, metrics, profiling
+from mtt.logs import DEBUG, ERROR, WARNING
+from mtt.utils import MediaTransferError, lg
+
+
+def _call_as(name, function, *args):
+    # Executor threads take the name of the publisher they work for, so logs
+    # are namespaced the same way as with the threads engine; and get their
+    # own back after, for the next tasks.
+    thread = threading.current_thread()
+    thread_name = thread.name
+
+    thread.name = name
+    try:
+        return function(*args)
+    finally:
+        thread.name = thread_name
+
+
+def _profiled(direction, status_id, function, *args):
+    # Only the blocking part of the processing runs in a single thread, to be profiled.
+    with profiling.profiler.profiled(direction, status_id):
+        return function(*args)
+
+
+class AsyncEngine:
+    """
+    Runs publishers on a single asyncio event loop, instead of in their own
+    threads.
+
+    The Mastodon and Twitter clients are synchronous, so their calls are run
+    in an executor, with at most `ASYNC_PLATFORM_CONCURRENCY` calls at once to
+    each platform. Everything else is a coroutine: waiting before processing
+    a status, transferring its medias concurrently, and waiting between
+    retries (on the loop timers). The streams are read from dedicated
+    threads, as they never return, and received statuses are handed over to
+    the loop.
+    """
+    def __init__(self, publishers):
+        self.publishers = publishers
+
+        self.loop = None
+        self.executor = ThreadPoolExecutor(
+            max_workers=sum(config.ASYNC_PLATFORM_CONCURRENCY.values()) + 2 * len(publishers),
+            thread_name_prefix='MTT (async)'
+        )
+        self.semaphores = {}
+        self.queues = {}
+        self.tasks = set()
+
+    def run(self):
+        """
+        Runs the publishers, forever (their streams reconnect when they fail).
+        """
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        try:
+            self.loop.run_until_complete(self.main())
+        finally:
+            self.loop.close()
+            self.executor.shutdown(wait=False)
+
+    async def call(self, publisher, platform, function, *args):
+        """
+        Calls a blocking function in the executor.
+        :param publisher: The publisher the call is made for.
+        :param platform: The platform called ('twitter' or 'mastodon'), to bound concurrent
+                         calls; or None if the function does not call any platform.
+        :param function: The function.
+        :param args: The function arguments.
+        :return: The function return value.
+        """
+        call = partial(_call_as, publisher.name, function, *args)
+
+        if platform is None:
+            return await self.loop.run_in_executor(self.executor, call)
+
+        async with self.semaphores[platform]:
+            return await self.loop.run_in_executor(self.executor, call)
+
+    async def main(self):
+        self.semaphores = {platform: asyncio.Semaphore(concurrency)
+                           for platform, concurrency in config.ASYNC_PLATFORM_CONCURRENCY.items()}
+
+        streams = []
+        consumers = []
+
+        await asyncio.gather(*[self.call(publisher, None, publisher.init_process) for publisher in self.publishers])
+
+        for publisher in self.publishers:
+            statuses = self.queues[publisher] = asyncio.Queue()
+
+            # See MTTThread.resume_pending
+            for post in publisher.outbox.pending(publisher.source_status):
+                lg(publisher.name, f'Resuming the {publisher.destination_status}s of {publisher.source_status} '
+                                   f'{post["status_id"]} ({len(post["sent"])}/{len(post["parts"])} sent).')
+                publisher.mark_parts_sent(post)
+                self.queue(publisher, self.send_post, post)
+
+            stream_end = self.loop.create_future()
+
+            Thread(
+                target=self.read_stream,
+                args=(publisher, stream_end),
+                name=publisher.name,
+                daemon=True
+            ).start()
+
+            consumers.append(self.loop.create_task(self.consume(publisher, statuses)))
+            streams.append(stream_end)
+
+        await asyncio.gather(*streams)
+
+        # The streams ended: we finish processing the statuses we started with.
+        for consumer in consumers:
+            consumer.cancel()
+
+        await asyncio.gather(*consumers, *self.tasks, return_exceptions=True)
+
+    def queue(self, publisher, process, item, delay=0):
+        """
+        Queues an item to be processed, as MTTThread.queue.
+        :param publisher: The publisher.
+        :param process: The coroutine function processing the item.
+        :param item: The item.
+        :param delay: How long to wait before processing it (seconds).
+        """
+        now = time.monotonic()
+        self.queues[publisher].put_nowait((now + delay, now, process, item))
+
+    def read_stream(self, publisher, stream_end):
+        def enqueue(status):
+            # See MTTThread.enqueue_status
+            self.loop.call_soon_threadsafe(self.queue, publisher, self.process_status, status,
+                                           config.STATUS_PROCESS_DELAY)
+
+        try:
+            publisher.listen(enqueue)
+        finally:
+            self.loop.call_soon_threadsafe(stream_end.set_result, None)
+
+    async def consume(self, publisher, statuses):
+        slots = asyncio.Semaphore(config.ASYNC_STATUS_CONCURRENCY)
+
+        while True:
+            ready_at, queued_at, process, item = await statuses.get()
+
+            delay = ready_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            await slots.acquire()
+            metrics.observe('wait', publisher.direction, time.monotonic() - queued_at)
+            task = self.loop.create_task(process(publisher, item))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            task.add_done_callback(lambda _: slots.release())
+
+    async def process_status(self, publisher, status):
+        """
+        Processes a status received from the stream, as MTTThread.process_status.
+        """
+        try:
+            with metrics.timed('filter', publisher.direction) as stage:
+                post = await self.call(publisher, None, _profiled, publisher.direction, status['id'],
+                                       publisher.prepare_status, status)
+                stage.outcome = 'skipped' if post is None else 'accepted'
+
+            if post is None:
+                return
+
+            planned = await self.call(publisher, None, publisher.outbox.plan, publisher.source_status, post)
+            if not planned:
+                return
+
+            await self.send_post(publisher, post)
+
+        # Broad exception to avoid stopping the engine in case of network problems or anything else.
+        except Exception as e:
+            lg(publisher.name, f'Unhandled exception while processing a status: {e!r}', level=ERROR)
+
+        finally:
+            await self.call(publisher, None, publisher.status_processed, status)
+
+    async def send_post(self, publisher, post):
+        """
+        Sends a planned status, as MTTThread.send_post.
+        """
+        try:
+            try:
+                media_ids = await self.transfer_medias(publisher, post['media_urls'])
+            except MediaTransferError as e:
+                await self.call(publisher, None, publisher.media_transfer_failed, e)
+                await self.call(publisher, None, publisher.outbox.done, publisher.source_status, post)
+                return
+
+            await self.retry_post(publisher, (post, media_ids, 0))
+
+        # Broad exception to avoid stopping the engine in case of network problems or anything else.
+        except Exception as e:
+            lg(publisher.name, f'Unhandled exception while sending a status: {e!r}', level=ERROR)
+
+    async def retry_post(self, publisher, retry):
+        """
+        Publishes a planned status, as MTTThread.retry_post: if it fails, it is
+        queued again after a delay (on the loop timers), without holding a slot.
+        """
+        post, media_ids, attempt = retry
+
+        try:
+            try:
+                await self.publish_status(publisher, post, media_ids)
+            except publisher.publish_errors as e:
+                if attempt < publisher.retries:
+                    delay = publisher.retry_delay(attempt)
+                    lg(publisher.name, f'We were unable to send the {publisher.destination_status}. '
+                                       f'Retrying in {delay:.0f} seconds… ({attempt + 1}/{publisher.retries})',
+                       level=WARNING)
+
+                    self.loop.call_later(delay, self.queue, publisher, self.retry_post, (post, media_ids, attempt + 1))
+                    metrics.retried(publisher.direction)
+                    return
+
+                await self.call(publisher, None, publisher.publish_failed, e)
+
+            await self.call(publisher, None, publisher.outbox.done, publisher.source_status, post)
+            await self.call(publisher, publisher.destination, publisher.after_status)
+
+        # Broad exception to avoid stopping the engine in case of network problems or anything else.
+        except Exception as e:
+            lg(publisher.name, f'Unhandled exception while sending a status: {e!r}', level=ERROR)
+
+    async def transfer_medias(self, publisher, media_urls):
+        """
+        Transfers medias concurrently, as MTTThread.transfer_medias.
+        """
+        results = await asyncio.gather(
+            *[self.call(publisher, publisher.destination, publisher.transfer_media, media_url, publisher.destination)
+              for media_url in media_urls],
+            return_exceptions=True
+        )
+
+        failures = [(media_url, result) for media_url, result in zip(media_urls, results)
+                    if isinstance(result, Exception)]
+        if failures:
+            raise MediaTransferError(failures)
+
+        return results
+
+    async def publish_status(self, publisher, post, media_ids):
+        """
+        Sends all the parts of a prepared status, as MTTThread.publish_status.
+        """
+        posted_id = post['sent'][-1] if post['sent'] else post['reply_to']
+
+        for i, text in enumerate(post['parts']):
+            if i < len(post['sent']):
+                continue
+
+            last = i == len(post['parts']) - 1
+
+            lg(publisher.name, f'Sending {publisher.destination_status} {i + 1}/{len(post["parts"])} of '
+                               f'{publisher.source_status} {post["status_id"]}…')
+            if logs.enabled(DEBUG):
+                lg(publisher.name, f'Text of the {publisher.destination_status}', level=DEBUG, text=text)
+            with metrics.timed('post', publisher.direction):
+                posted_id = await self.call(publisher, publisher.destination, publisher.post_status,
+                                            post, text, media_ids if last else [], posted_id)
+
+            await self.call(publisher, None, publisher.outbox.sent, publisher.source_status, post, posted_id)
+            lg(publisher.name, f'{publisher.destination_status.capitalize()} sent successfully.')
+
+        await self.call(publisher, None, publisher.associate_post, post, posted_id)
@@ -0,0 +1,85 @@
+import json
+import os
+
+from threading import Lock
+
+from mtt.logs import ERROR, lgt
+
+
+class Checkpoints:
+    """
+    The ID of the last status processed in each direction, so the statuses
+    posted while we were not listening can be caught up on.
+
+    Checkpoints are saved, if a path is given, after each update (by
+    writing a new file and atomically swapping it in).
+    """
+    def __init__(self, path=None):
+        self.path = path
+
+        self._checkpoints = {}
+        self._lock = Lock()
+
+    def load(self):
+        if self.path is None:
+            return self
+
+        try:
+            with open(self.path, 'r') as f:
+                self._checkpoints = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+        return self
+
+    def get(self, direction):
+        """
+        :param direction: The direction (the source status type, 'toot' or 'tweet').
+        :return: The last processed status ID, or None if there is none.
+        """
+        with self._lock:
+            return self._checkpoints.get(direction)
+
+    def setdefault(self, direction, status_id):
+        """
+        Sets the checkpoint of a direction if there is none yet.
+        :param direction: The direction.
+        :param status_id: The status ID.
+        """
+        with self._lock:
+            if direction in self._checkpoints:
+                return
+
+            self._checkpoints[direction] = status_id
+            self._save()
+
+    def update(self, direction, status_id):
+        """
+        Moves the checkpoint of a direction forward, if this status is newer.
+        :param direction: The direction.
+        :param status_id: The processed status ID.
+        """
+        with self._lock:
+            current = self._checkpoints.get(direction)
+            if current is not None and int(current) >= int(status_id):
+                return
+
+            self._checkpoints[direction] = status_id
+            self._save()
+
+    def _save(self):
+        if self.path is None:
+            return
+
+        try:
+            temp_path = str(self.path) + '.tmp'
+
+            with open(temp_path, 'w') as f:
+                json.dump(self._checkpoints, f)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(temp_path, self.path)
+        except OSError:
+            lgt('Encountered error while saving checkpoints file. Statuses posted while MTT is not running '
+                'might not be mirrored. Check files permissions.', level=ERROR)
@@ -9,7 +9,6 @@
 
 import os
 import re
-import twitter
 
 from path import Path
 
@@ -26,13 +25,20 @@ SPLIT_ON_TWITTER = True
 # Manage visibility of your toot. Value are "private", "unlisted" or "public"
 TOOT_VISIBILITY = "public"
 
-# How often to retry when posting fails
+# How often to retry when posting fails, on Mastodon and on Twitter
 MASTODON_RETRIES = 3
 TWITTER_RETRIES = 3
 
-# How long to wait between retries, in seconds
-MASTODON_RETRY_DELAY = 20
-TWITTER_RETRY_DELAY = 20
+# How long to wait before the first retry, in seconds. The delay is then
+# multiplied by RETRY_BACKOFF_FACTOR at each retry, up to the maximal delay,
+# and randomly shortened by up to RETRY_JITTER (a fraction of it).
+# Statuses waiting to be retried do not block the other ones.
+MASTODON_RETRY_DELAY = 10
+TWITTER_RETRY_DELAY = 10
+MASTODON_RETRY_MAX_DELAY = 300
+TWITTER_RETRY_MAX_DELAY = 300
+RETRY_BACKOFF_FACTOR = 2
+RETRY_JITTER = 0.5
 
 # The text to prepend to tweets, if the corresponding toot has a
 # content warning. {} is the spoiler text.
@@ -52,15 +58,16 @@ TWEET_CW_REGEXP = re.compile(r'(?:[\[(])(?:(?:(?:C|T)W)|SPOIL(?:ER)?)(?:[\s\-\.
 TWEET_CW_ALLOW_MULTI = True
 TWEET_CW_SEPARATOR = ', '
 
-# Some helpers copied out from python-twitter, because they're broken there
-URL_REGEXP = re.compile((
-    r'('
-    r'(?!(https?://|www\.)?\.|ftps?://|([0-9]+\.){{1,3}}\d+)'  # exclude urls that start with "."
-    r'(?:https?://|www\.)*(?!.*@)(?:[\w+-_]+[.])'              # beginning of url
-    r'(?:{0}\b|'                                               # all tlds
-    r'(?:[:0-9]))'                                             # port numbers & close off TLDs
-    r'(?:[\w+\/]?[a-z0-9!\*\'\(\);:&=\+\$/%#\[\]\-_\.,~?])*'   # path/query params
-    r')').format(r'\b|'.join(twitter.twitter_utils.TLDS)), re.U | re.I | re.X)
+# The regex used to find URLs in statuses, to compute their length on
+# Twitter. If None, the URLs with any known TLD are found.
+URL_REGEXP = None
+
+# To mirror more than one pair of accounts, create a sub-directory for each
+# pair in this directory, containing its credentials files (named as below).
+# Status associations are also stored there; other resources (connections,
+# media cache, threads) are shared. If there is no sub-directory, the files
+# below are used for a single pair of accounts.
+ACCOUNTS_DIRECTORY = ROOT_PATH / 'accounts'
 
 # The files where credentials and other data are stored
 FILES = {
@@ -68,12 +75,141 @@ FILES = {
     'credentials_mastodon_client': ROOT_PATH / 'mtt_mastodon_client.secret',
     'credentials_mastodon_server': ROOT_PATH / 'mtt_mastodon_server.secret',
     'credentials_mastodon_user': ROOT_PATH / 'mtt_mastodon_user.secret',
-    'status_associations': ROOT_PATH / 'mtt_status_associations.json'
+    'status_associations': ROOT_PATH / 'mtt_status_associations.json',
+    'status_associations_journal': ROOT_PATH / 'mtt_status_associations.jsonl',
+    'media_cache': ROOT_PATH / 'mtt_media_cache',
+    'checkpoints': ROOT_PATH / 'mtt_checkpoints.json',
+    'outbox': ROOT_PATH / 'mtt_outbox.jsonl',
+    'startup_cache': ROOT_PATH / 'mtt_startup_cache.json'
 }
 
+# The status associations journal is compacted at startup if it contains
+# more than this many times the number of live associations.
+STATUS_ASSOCIATIONS_COMPACTION_RATIO = 2
+
+# The accounts identities and the Twitter configuration are cached on disk
+# for this long (seconds), so restarts do not wait for them. They are also
+# retrieved again when the credentials change.
+STARTUP_CACHE_TTL = 60 * 60 * 24
+
+# The outbox journal (statuses being sent, resumed if MTT stops meanwhile)
+# is compacted when it contains more than this many lines.
+OUTBOX_COMPACTION_SIZE = 1000
+
 # The delay to wait before a tweet or a toot is processed (seconds).
 # This avoids race conditions.
 # We wait a little bit so tweets sent to Mastodon (or the other way
 # around) can be marked as such before this run, avoiding bouncing
 # tweets/toots
 STATUS_PROCESS_DELAY = 0.6
+
+# How many threads process the received statuses, for each direction.
+# Statuses are received by another thread, so the streams are never
+# blocked by processing. With more than one, statuses may be published
+# out of order (and threads may be broken if a reply is published before
+# the status it replies to).
+STATUS_WORKERS = 1
+
+# When starting, or reconnecting after a stream failure, we fetch the
+# statuses posted since the last one processed (at most this many; the
+# oldest ones are skipped above that), so nothing is lost while MTT is not
+# running. Set to 0 to disable.
+BACKFILL_MAX_STATUSES = 100
+
+# How long to wait for a stream to connect before fetching the statuses
+# posted meanwhile, and before reconnecting a failed stream (seconds).
+STREAM_HANDOFF_DELAY = 2
+STREAM_RECONNECT_DELAY = 10
+
+# The engine running the crossposter:
+# - 'threads': each direction runs in its own threads;
+# - 'asyncio' (experimental): both directions run on a single event loop,
+#   with at most ASYNC_PLATFORM_CONCURRENCY calls at once to each platform,
+#   and ASYNC_STATUS_CONCURRENCY statuses processed at once in each direction
+#   (see STATUS_WORKERS).
+ENGINE = 'threads'
+ASYNC_PLATFORM_CONCURRENCY = {
+    'twitter': 4,
+    'mastodon': 4
+}
+ASYNC_STATUS_CONCURRENCY = 1
+
+# How long we remember the statuses we sent (seconds), to avoid bouncing
+# them back, and how many of them at most. This must be longer than the
+# longest wait for a rate limit reset (the Twitter windows last 15 minutes),
+# as the statuses received during such a wait are only processed after it.
+SENT_STATUS_TTL = 1200
+SENT_STATUS_MAX_SIZE = 1000
+
+# Medias are downloaded by chunks of this size (bytes), and kept in memory
+# until they are larger than MEDIA_SPOOL_MAX_SIZE (bytes), then written
+# to a temporary file.
+MEDIA_CHUNK_SIZE = 64 * 1024
+MEDIA_SPOOL_MAX_SIZE = 5 * 1024 * 1024
+
+# How many medias of a status are transferred at once
+MEDIA_TRANSFER_WORKERS = 4
+
+# Downloaded medias are cached on disk, so a media transferred more than
+# once (reblogged, retried, re-posted…) is not downloaded again. The least
+# recently used medias are removed when the cache is larger than
+# MEDIA_CACHE_MAX_SIZE (bytes), or when unused for MEDIA_CACHE_MAX_AGE
+# (seconds).
+MEDIA_CACHE_ENABLED = True
+MEDIA_CACHE_MAX_SIZE = 200 * 1024 * 1024
+MEDIA_CACHE_MAX_AGE = 60 * 60 * 24
+
+# How long the ID of an uploaded media can be reused for the same media
+# (seconds), per platform. Twitter media IDs can be used for a day; Mastodon
+# medias cannot be attached to more than one status.
+MEDIA_ID_REUSE_TTL = {
+    'twitter': 60 * 60 * 12,
+    'mastodon': 0
+}
+
+# HTTP connections are kept alive and reused. POOL_CONNECTIONS is the number
+# of hosts to keep connections to, POOL_MAXSIZE the number of connections
+# kept for each host. Timeouts are in seconds.
+HTTP_POOL_CONNECTIONS = 10
+HTTP_POOL_MAXSIZE = 10
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 60
+
+# Requests to the APIs are paced from the rate limits they report, instead
+# of being rejected: when less than RATE_LIMIT_PACING_THRESHOLD (a fraction)
+# of a quota remains, the requests left are spread evenly until the quota
+# is reset, and when none remains, requests wait for the reset (and are
+# then spread over the next window).
+RATE_LIMIT_PACING = True
+RATE_LIMIT_PACING_THRESHOLD = 0.25
+
+# An HTTP endpoint exposing metrics (in the Prometheus text format, on
+# /metrics) can be enabled by setting its port: the time spent in each stage
+# of the mirroring of statuses, by direction and outcome, and the state of
+# the queues, outbox, connections, rate limits and media cache.
+METRICS_PORT = None
+METRICS_ADDRESS = '127.0.0.1'
+
+# Logs are written by a background thread, so a slow output never blocks the
+# crossposting. LOG_LEVEL is 'debug' (which also logs the text of the statuses
+# sent), 'info', 'warning' or 'error'; None disables the logs. LOG_FORMAT is
+# 'text', or 'json' for one JSON object per line. When more than
+# LOG_QUEUE_SIZE messages are waiting to be written, debug and info messages
+# are dropped (and their number logged).
+LOG_LEVEL = 'info'
+LOG_FORMAT = 'text'
+LOG_QUEUE_SIZE = 10000
+
+# To see where the time goes when mirroring statuses, this fraction of them
+# (between 0 and 1) is profiled: the time spent in each function (cProfile)
+# and, if PROFILING_TRACEMALLOC, the memory allocated (tracemalloc). Can be
+# overridden by the MTT_PROFILING_SAMPLE_RATE environment variable. Profiles
+# are written to PROFILING_DIRECTORY (a .prof file to open with pstats or
+# snakeviz, and a .txt report), keeping the PROFILING_MAX_FILES most recent.
+# Sending PROFILING_SIGNAL to the process (e.g. `kill -USR1 <pid>`) writes a
+# snapshot of the threads stacks there, and profiles the next statuses.
+PROFILING_SAMPLE_RATE = 0
+PROFILING_TRACEMALLOC = True
+PROFILING_DIRECTORY = ROOT_PATH / 'mtt_profiles'
+PROFILING_MAX_FILES = 50
+PROFILING_SIGNAL = 'SIGUSR1'
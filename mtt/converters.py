@@ -0,0 +1,250 @@
+import html
+import re
+
+from urllib.parse import urlparse
+
+from mtt import config
+
+# The tags we convert, in a single pattern so the content is scanned once:
+# links to the instance medias (whose URLs start with {media}), removed with
+# the whitespace, line breaks and tags following them, if followed by
+# whitespace or the end of the content; links with a plain text (group 1,
+# replaced by their target; Mastodon links are not, as their text is split in
+# spans), line breaks (group 2) and paragraphs boundaries (group 3). Any other
+# tag is removed, along with the tags directly following it that are none of
+# those, so e.g. a Mastodon link is a single token.
+_TOOT_TOKENS = (r'<(?:a [^>]*href="{media}\w+"[^>]*>(?:[^<]|<(?!/a>)[^>]*>)*</a>'
+                r'(?=(?:<(?![aA] )[^\n>]*>)*(?:\s|&nbsp;|(?i:<br ?/?>|</p><p>)|$))'
+                r'(?:\s|&nbsp;|<(?![aA] )[^\n>]*>)*'
+                r'|a [^>]*href="([^"]+)">[^<]*</a>'
+                r'|(?i:(br ?/?>)|(/p><p>))'
+                r'|[^\n>]*>(?:<(?![aA] |[bB][rR]|/[pP]>)[^\n>]*>)*)')
+
+
+def _convert_token(token):
+    group = token.lastindex
+
+    if group == 1:
+        return token.group(1)
+    elif group == 2:
+        return '\n'
+    elif group == 3:
+        return '\n\n'
+
+    return ''
+
+
+def tweet_full_text(tweet):
+    """
+    :param tweet: The tweet.
+    :return: The tweet text, in full if it was truncated.
+    """
+    if 'extended_tweet' in tweet:
+        if 'full_text' in tweet['extended_tweet']:
+            return tweet['extended_tweet']['full_text']
+        elif 'text' in tweet['extended_tweet']:
+            return tweet['extended_tweet']['text']
+    elif 'full_text' in tweet:
+        return tweet['full_text']
+    elif 'text' in tweet:
+        return tweet['text']
+    else:
+        return ''
+
+
+def tweet_entities(tweet, kind):
+    """
+    :param tweet: The tweet.
+    :param kind: The entities kind ('user_mentions', 'urls' or 'media').
+    :return: The tweet entities of this kind.
+    """
+    if kind in tweet:
+        return tweet[kind]
+    elif 'entities' in tweet and kind in tweet['entities']:
+        return tweet['entities'][kind]
+    elif 'extended_tweet' in tweet and 'entities' in tweet['extended_tweet'] \
+            and kind in tweet['extended_tweet']['entities']:
+        return tweet['extended_tweet']['entities'][kind]
+    else:
+        return []
+
+
+class TootConverter:
+    """
+    Converts the HTML content of toots to plain text, in a single pass over
+    the content:
+
+    - links with a plain text are replaced by their target;
+    - line breaks become new lines and paragraphs are separated by an
+      empty line;
+    - other tags are removed, and entities unescaped;
+    - the links to the instance medias are removed (with the whitespace
+      following them).
+    """
+    def __init__(self, api_base_url):
+        """
+        :param api_base_url: The Mastodon instance URL, where the medias are.
+        """
+        base_url = api_base_url.rstrip('/')
+
+        self.tokens = re.compile(_TOOT_TOKENS.format(media=re.escape(base_url + '/media/')))
+
+    def convert(self, content):
+        """
+        :param content: The toot content (HTML).
+        :return: The toot text.
+        """
+        # Stripped before unescaping, so escaped spaces (e.g. &nbsp;) are kept.
+        return html.unescape(self.tokens.sub(_convert_token, content).strip())
+
+    def convert_toot(self, toot):
+        """
+        :param toot: The toot.
+        :return: The toot text; for a reblog, the text of the reblogged toot, with
+                 its author and link.
+        """
+        content = toot['content']
+
+        if toot['reblogged'] and 'reblog' in toot:
+            reblog = toot['reblog']
+            reblog_name = f'@{reblog["account"]["username"]}@{urlparse(reblog["account"]["url"]).netloc}'
+            content = f'\U0001f501 RT {reblog_name}\n' \
+                      f'{reblog["content"]}\n\n' \
+                      f'{reblog["url"]}'
+
+        return self.convert(content)
+
+
+class TweetConverter:
+    """
+    Converts the text of tweets to toots, in a single pass over the text,
+    driven by the tweet entities:
+
+    - mentions get the `@twitter.com` domain, so they are not mistaken for
+      local accounts;
+    - t.co links are replaced by their target;
+    - links to the tweet medias are removed;
+    - content warnings (matching `TWEET_CW_REGEXP`) are removed, and
+      returned apart;
+    - entities are unescaped.
+
+    Entities are found from their indices; if the text there is not the
+    expected one (e.g. indices given for the unescaped text), they are
+    searched for after the previous entity of the same kind.
+    """
+    def __init__(self, cw_regexp=None, cw_allow_multi=None, cw_separator=None):
+        self.cw_regexp = cw_regexp if cw_regexp is not None else config.TWEET_CW_REGEXP
+        self.cw_allow_multi = cw_allow_multi if cw_allow_multi is not None else config.TWEET_CW_ALLOW_MULTI
+        self.cw_separator = cw_separator if cw_separator is not None else config.TWEET_CW_SEPARATOR
+
+    @staticmethod
+    def _locate(text, expected, entity, cursor, is_mention=False):
+        """
+        :param text: The tweet text.
+        :param expected: The entity text.
+        :param entity: The entity (with its `indices`, if known).
+        :param cursor: Where to search from, if the indices are wrong.
+        :param is_mention: True to match case-insensitively, and only whole mentions.
+        :return: The entity (start, end), or None if not found.
+        """
+        def is_word(position):
+            return 0 <= position < len(text) and (text[position].isalnum() or text[position] == '_')
+
+        def matches(start):
+            found = text[start:start + len(expected)]
+            if is_mention:
+                return found.lower() == expected.lower() and not is_word(start - 1) \
+                    and not is_word(start + len(expected))
+            return found == expected
+
+        indices = entity.get('indices')
+        if indices and matches(indices[0]):
+            return indices[0], indices[0] + len(expected)
+
+        haystack, needle = (text.lower(), expected.lower()) if is_mention else (text, expected)
+        start = haystack.find(needle, cursor)
+        while start != -1:
+            if matches(start):
+                return start, start + len(expected)
+            start = haystack.find(needle, start + 1)
+
+        return None
+
+    def convert(self, text, mentions=(), urls=(), medias=()):
+        """
+        :param text: The tweet text, as given by Twitter (escaped).
+        :param mentions: The `user_mentions` entities.
+        :param urls: The `urls` entities.
+        :param medias: The `media` entities.
+        :return: A tuple (toot text, content warning or None).
+        """
+        # Edits to make, as (start, end, replacement).
+        edits = []
+
+        cursor = 0
+        for mention in mentions:
+            span = self._locate(text, '@' + mention['screen_name'], mention, cursor, is_mention=True)
+            if span is not None:
+                start, cursor = span
+                edits.append((start, cursor, text[start:cursor] + '@twitter.com'))
+
+        cursor = 0
+        for url in urls:
+            span = self._locate(text, url['url'], url, cursor)
+            if span is not None:
+                start, cursor = span
+                edits.append((start, cursor, url['expanded_url']))
+
+        cursor = 0
+        for media in medias:
+            span = self._locate(text, media['url'], media, cursor)
+            if span is not None:
+                start, cursor = span
+                edits.append((start, cursor, ''))
+
+        warnings = []
+        if self.cw_regexp:
+            for cw in self.cw_regexp.finditer(text):
+                edits.append((cw.start(), cw.end(), ''))
+                warnings.append(html.unescape(cw.group(1).strip()))
+
+                if not self.cw_allow_multi:
+                    break
+
+        pieces = []
+        position = 0
+
+        for start, end, replacement in sorted(edits, key=lambda edit: edit[0]):
+            # Entities in a content warning, or medias sharing the same link, are already handled.
+            if start < position:
+                continue
+
+            pieces.append(html.unescape(text[position:start]))
+            pieces.append(replacement)
+            position = end
+
+        pieces.append(html.unescape(text[position:]))
+
+        return ''.join(pieces).strip(), self.cw_separator.join(warnings) if warnings else None
+
+    def convert_tweet(self, tweet):
+        """
+        :param tweet: The tweet.
+        :return: A tuple (toot text, content warning or None); for a retweet, the
+                 text of the retweeted tweet, with its author and link.
+        """
+        retweet = tweet.get('retweeted_status')
+        if retweet:
+            tweet = retweet
+
+        text, warning = self.convert(tweet_full_text(tweet),
+                                     mentions=tweet_entities(tweet, 'user_mentions'),
+                                     urls=tweet_entities(tweet, 'urls'),
+                                     medias=tweet_entities(tweet, 'media'))
+
+        if retweet:
+            text = f'\U0001f501 RT @{tweet["user"]["screen_name"]}@twitter.com\n\n' \
+                   f'{text}\n\n' \
+                   f'https://twitter.com/{tweet["user"]["screen_name"]}/status/{tweet["id_str"]}'
+
+        return text, warning
@@ -1,20 +1,17 @@
 import getpass
-import twitter
 
 from builtins import input
-from mastodon import Mastodon
-from mastodon.Mastodon import MastodonError
 from path import Path
-from twitter import TwitterError
 
 from mtt import config
 
 
-def check_credentials():
+def check_credentials(files=None):
     """
     Checks if the credentials are available for use.
+    :param files: The files where credentials are stored (defaults to `config.FILES`).
     """
-    for key, file in config.FILES.items():
+    for key, file in (files or config.FILES).items():
         if not key.startswith('credentials_'):
             continue
         if not file.exists() or file.size == 0:
@@ -23,7 +20,16 @@ def check_credentials():
     return True
 
 
-def setup_credentials():
+def setup_credentials(files=None):
+    # Imported here, as they are slow to import, and only needed on the first run.
+    import twitter
+
+    from mastodon import Mastodon
+    from mastodon.Mastodon import MastodonError
+    from twitter import TwitterError
+
+    files = files or config.FILES
+
     print("This appears to be your first time running MastodonToTwitter.")
     print("After some configuration, you'll be up and running in no time.")
     print("First of all, to talk to twitter, you'll need a twitter API key.")
@@ -89,9 +95,9 @@ def setup_credentials():
 
         print("\n")
 
-        credentials_mastodon_server: Path = config.FILES['credentials_mastodon_server']
-        credentials_mastodon_client: Path = config.FILES['credentials_mastodon_client']
-        credentials_mastodon_user: Path = config.FILES['credentials_mastodon_user']
+        credentials_mastodon_server: Path = files['credentials_mastodon_server']
+        credentials_mastodon_client: Path = files['credentials_mastodon_client']
+        credentials_mastodon_user: Path = files['credentials_mastodon_user']
 
         if credentials_mastodon_server.exists() and credentials_mastodon_server.size > 0:
             print("You already have Mastodon server set up, so we're skipping that step.")
@@ -159,7 +165,7 @@ def setup_credentials():
     print("files. Have fun tooting!")
     print("\n")
 
-    with config.FILES['credentials_twitter'].open('w') as secret_file:
+    with files['credentials_twitter'].open('w') as secret_file:
         secret_file.write(TWITTER_CONSUMER_KEY + '\n')
         secret_file.write(TWITTER_CONSUMER_SECRET + '\n')
         secret_file.write(TWITTER_ACCESS_KEY + '\n')
@@ -0,0 +1,202 @@
+import atexit
+import json
+import sys
+import threading
+import time
+
+from datetime import datetime
+from queue import Empty, Full, Queue
+
+from mtt import config
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVEL_NAMES = {level: name for name, level in LEVELS.items()}
+
+# Above all levels: nothing is logged.
+DISABLED = ERROR + 10
+
+# How many messages are written at once, at most.
+WRITE_BATCH_SIZE = 256
+
+
+class Logger:
+    """
+    Writes log messages from a background thread, so a slow output
+    (a terminal, a pipe to journald…) never blocks the threads logging.
+
+    Messages are queued with their time, level, namespace and fields, and
+    formatted by the writer thread, as text or JSON lines (`LOG_FORMAT`).
+    Messages below `LOG_LEVEL` are discarded before anything is done. When
+    more than `LOG_QUEUE_SIZE` messages are waiting, debug and info messages
+    are dropped (and counted), while warnings and errors wait.
+    """
+    def __init__(self, stream=None):
+        """
+        :param stream: Where to write the messages (the standard output at the time of writing by default).
+        """
+        self.stream = stream
+
+        # Everything is enabled until the configuration is read, on the first message.
+        self.level = DEBUG
+        self.format = 'text'
+        self.dropped = 0
+
+        self._records = None
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def configure(self):
+        """
+        Reads the logs configuration (`LOG_LEVEL`, `LOG_FORMAT`, `LOG_QUEUE_SIZE`).
+        """
+        self.level = LEVELS[config.LOG_LEVEL.lower()] if config.LOG_LEVEL else DISABLED
+        self.format = config.LOG_FORMAT
+
+        if self._records is None:
+            self._records = Queue(maxsize=config.LOG_QUEUE_SIZE)
+
+    def start(self):
+        """
+        Starts the writer thread (done on the first message).
+        """
+        with self._lock:
+            if self._writer is not None:
+                return
+
+            self.configure()
+
+            self._writer = threading.Thread(target=self._write_records, name='Logs', daemon=True)
+            self._writer.start()
+            atexit.register(self.stop)
+
+    def stop(self, timeout=5):
+        """
+        Writes the messages waiting, and stops the writer thread.
+        :param timeout: How long to wait for the messages to be written (seconds).
+        """
+        with self._lock:
+            writer, self._writer = self._writer, None
+
+        if writer is not None:
+            self._records.put(None)
+            writer.join(timeout)
+
+    def log(self, level, namespace, message, fields):
+        """
+        Queues a message to be written.
+        :param level: The level (DEBUG, INFO, WARNING or ERROR).
+        :param namespace: A namespace. If None, uses the current thread name.
+        :param message: The message.
+        :param fields: A dict of values logged along with the message.
+        """
+        if self._writer is None:
+            self.start()
+            if level < self.level:
+                return
+
+        if namespace is None:
+            namespace = threading.current_thread().name
+
+        record = (time.time(), level, namespace, message, fields)
+
+        if level >= WARNING:
+            self._records.put(record)
+            return
+
+        try:
+            self._records.put_nowait(record)
+        except Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _write_records(self):
+        dropped = 0
+
+        while True:
+            records = [self._records.get()]
+            try:
+                while len(records) < WRITE_BATCH_SIZE:
+                    records.append(self._records.get_nowait())
+            except Empty:
+                pass
+
+            stop = None in records
+            lines = [self._format(record) for record in records if record is not None]
+
+            with self._lock:
+                newly_dropped, dropped = self.dropped - dropped, self.dropped
+            if newly_dropped:
+                lines.append(self._format((time.time(), WARNING, 'Logs', f'{newly_dropped} message(s) dropped '
+                                           f'(too many messages waiting to be written).', None)))
+
+            stream = self.stream or sys.stdout
+            try:
+                stream.write('\n'.join(lines) + '\n')
+                stream.flush()
+            except (OSError, ValueError):
+                pass
+
+            if stop:
+                return
+
+    def _format(self, record):
+        timestamp, level, namespace, message, fields = record
+
+        if self.format == 'json':
+            entry = {
+                'time': datetime.fromtimestamp(timestamp).isoformat(timespec='milliseconds'),
+                'level': LEVEL_NAMES[level],
+                'namespace': namespace,
+                'message': message,
+            }
+            if fields:
+                entry.update(fields)
+            return json.dumps(entry, ensure_ascii=False, default=str)
+
+        line = f'[{datetime.fromtimestamp(timestamp):%d/%m/%Y %H:%M:%S}] [{namespace}] '
+        if level != INFO:
+            line += LEVEL_NAMES[level].upper() + ': '
+        line += message
+        if fields:
+            line += ''.join(f' {name}={json.dumps(value, ensure_ascii=False, default=str)}'
+                            for name, value in fields.items())
+        return line
+
+
+logger = Logger()
+
+
+def enabled(level):
+    """
+    :param level: A level (DEBUG, INFO, WARNING or ERROR).
+    :return: True if the messages of this level are logged; to avoid building costly messages otherwise.
+    """
+    return level >= logger.level
+
+
+def lg(namespace, message, level=INFO, **fields):
+    """
+    Logs a message.
+    :param namespace: A namespace. If None, uses the current thread name.
+    :param message: A message to be logged.
+    :param level: The level of the message (DEBUG, INFO, WARNING or ERROR).
+    :param fields: Values logged along with the message.
+    """
+    if level >= logger.level:
+        logger.log(level, namespace, message, fields)
+
+
+def lgt(message, level=INFO, **fields):
+    """
+    Logs a message namespaced with the current thread.
+    :param message: A message to be logged.
+    :param level: The level of the message (DEBUG, INFO, WARNING or ERROR).
+    :param fields: Values logged along with the message.
+    """
+    if level >= logger.level:
+        logger.log(level, None, message, fields)
@@ -1,18 +1,23 @@
-import html
-import re
-import time
-
 from mastodon import StreamListener
 from twitter import TwitterError
-from urllib.parse import urlparse
 
-from mtt import config, lock
+from mtt import config, lock, metrics
+from mtt.converters import TootConverter
+from mtt.twitter_configuration import ShortUrlLength
 from mtt.utils import MTTThread, lgt, split_status
 
 
 class TwitterPublisher(MTTThread):
+    source_status = 'toot'
+    destination = 'twitter'
+    destination_status = 'tweet'
+    publish_errors = (TwitterError,)
+    direction = 'm2t'
+
     def __init__(self, mastodon_api, twitter_api, ma_account_id, tw_account_id,
-                 status_associations, sent_status, group=None, target=None, name=None):
+                 status_associations, sent_status, media_cache=None, http_session=None, media_executor=None,
+                 checkpoints=None, outbox=None, mastodon_account=None, startup_cache=None, group=None, target=None,
+                 name=None):
         super(TwitterPublisher, self).__init__(
             group=group,
             target=target,
@@ -22,209 +27,220 @@ class TwitterPublisher(MTTThread):
             ma_account_id=ma_account_id,
             tw_account_id=tw_account_id,
             status_associations=status_associations,
-            sent_status=sent_status
+            sent_status=sent_status,
+            media_cache=media_cache,
+            http_session=http_session,
+            media_executor=media_executor,
+            checkpoints=checkpoints,
+            outbox=outbox
         )
 
-        self.account = mastodon_api.account(ma_account_id)
+        self.account = mastodon_account or mastodon_api.account(ma_account_id)
+
+        # Our identity, computed once, to recognize our toots among the home timeline.
+        self.identity = self._account_identity(self.account)
+        self.raw_identity = f'"{self.account["id"]}"'
 
         self.since_toot_id = 0
-        self.url_length = 24
-        self.last_url_len_update = 0
+        self.short_url_length = ShortUrlLength(twitter_api, startup_cache, name=name)
 
-        self.MEDIA_REGEXP = re.compile(re.escape(self.mastodon_api.api_base_url.rstrip("/")) + "\/media\/(\w)+(\s|$)+")
+        self.toot_converter = TootConverter(self.mastodon_api.api_base_url)
 
     def init_process(self):
         try:
             self.since_toot_id = self.mastodon_api.account_statuses(self.ma_account_id)[0]["id"]
-            lgt(f'Tweeting any toot after toot {self.since_toot_id}')
+            self.checkpoints.setdefault(self.source_status, self.since_toot_id)
+            lgt(f'Tweeting any toot after toot {self.checkpoints.get(self.source_status)}')
         except IndexError:
             lgt('Tweeting any toot (user timeline is empty right now)')
 
-        self.update_twitter_link_length()
+        # From times to times we update the Twitter URL length, in the background.
+        self.short_url_length.start()
 
-    def update_twitter_link_length(self):
-        if time.time() - self.last_url_len_update > 60 * 60 * 24:
-            self.twitter_api._config = None
-            self.url_length = max(self.twitter_api.GetShortUrlLength(False),
-                                  self.twitter_api.GetShortUrlLength(True)) + 1
-            self.last_url_len_update = time.time()
-            lgt(f'Updated expected short URL length - it is now {self.url_length} characters.')
+    @property
+    def url_length(self):
+        """
+        The expected length of URLs on Twitter (after some reduction).
+        """
+        return self.short_url_length.value + 1
 
     @staticmethod
-    def _are_same_accounts(first, other):
+    def _account_identity(account):
         """
-        Checks if the two accounts are the same, i.e.
-        - with the same ID;
-        - from the same instance.
-        :param first: An account (dict-like with at least an 'id' and an 'url' key).
-        :param other: Another account (same).
-        :return: True if both are the same.
+        The identity of an account: two accounts are the same if they have
+        - the same ID;
+        - the same instance.
+        :param account: An account (dict-like with at least an 'id' and an 'url' key).
+        :return: A key, equal for the same accounts.
         """
-        if first['id'] != other['id']:
-            return False
-
         # In case the ID is the same we check the instance
         # (we don't want to check only the profile URL as
         # it would break the sync if the username is changed)
-        if '@' in first['url'] and '@' in other['url']:
-            return first['url'].split('@')[0] == other['url'].split('@')[0]
+        if '@' in account['url']:
+            return account['id'], account['url'].split('@')[0], True
         else:
-            return first['url'] == other['url']
+            return account['id'], account['url'], False
+
+    @classmethod
+    def _are_same_accounts(cls, first, other):
+        """
+        Checks if the two accounts are the same (see `_account_identity`).
+        :param first: An account (dict-like with at least an 'id' and an 'url' key).
+        :param other: Another account (same).
+        :return: True if both are the same.
+        """
+        return cls._account_identity(first) == cls._account_identity(other)
 
     def is_from_us(self, account):
-        return self._are_same_accounts(self.account, account)
+        # Most toots of the home timeline are not ours: their ID is enough to tell.
+        return account['id'] == self.identity[0] and self._account_identity(account) == self.identity
 
-    def run(self):
-        self.init_process()
+    def is_own_status(self, toot):
+        return self.is_from_us(toot['account'])
 
-        lgt('Listening for toots…')
+    def prepare_status(self, toot):
+        """
+        Prepares the tweets to send for a toot.
+        :param toot: The toot.
+        :return: The tweets to send (see MTTThread.prepare_status), or None if
+                 the toot must not be sent.
+        """
+        # We only transfer our own toots, but the streaming endpoint receives the whole
+        # timeline.
+        if not self.is_from_us(toot['account']):
+            return None
+
+        toot_id = toot["id"]
+
+        if self.is_toot_sent_by_us(toot_id):
+            return None
+
+        # Already mirrored (e.g. received again while catching up after a reconnection).
+        with lock:
+            if toot_id in self.status_associations['m2t']:
+                return None
+
+        # We trust mastodon to return valid HTML
+        with metrics.timed('transform', self.direction):
+            content_clean = self.toot_converter.convert_toot(toot)
+
+        if toot['reblogged'] and 'reblog' in toot:
+            toot = toot['reblog']
+
+        media_attachments = toot["media_attachments"]
+
+        # Don't cross-post replies
+        if len(content_clean) != 0 and content_clean[0] == '@':
+            lgt(f'Skipping toot {toot_id} - it\'s a reply.')
+            return None
+
+        if config.TWEET_CW_PREFIX and toot['spoiler_text']:
+            content_clean = config.TWEET_CW_PREFIX.format(toot['spoiler_text']) + content_clean
+
+        with metrics.timed('split', self.direction):
+            content_parts = split_status(
+                status=content_clean,
+                max_length=280,
+                split=config.SPLIT_ON_TWITTER,
+                url=toot['uri'],
+                url_length=self.url_length
+            )
+
+        reply_to = None
+
+        # We check if this toot is a reply to a previously sent toot.
+        # If so, the first corresponding tweet will be a reply to
+        # the stored tweet.
+        # Unlike in the Mastodon API calls, we don't have to handle the
+        # case where the tweet was deleted, as twitter will ignore
+        # the in_reply_to_status_id option if the given tweet
+        # does not exists.
+        with lock:
+            if toot['in_reply_to_id'] in self.status_associations['m2t']:
+                reply_to = self.status_associations['m2t'][toot['in_reply_to_id']]
+
+        return {
+            'status_id': toot_id,
+            'parts': [content_tweet.strip() for content_tweet in content_parts],
+            'media_urls': [attachment['url'] for attachment in media_attachments],
+            'reply_to': reply_to
+        }
+
+    def post_status(self, post, text, media_ids, reply_to):
+        """
+        Sends a tweet.
+        :param post: The prepared toot.
+        :param text: The tweet text.
+        :param media_ids: The medias to attach to the tweet.
+        :param reply_to: The tweet to reply to, if any.
+        :return: The tweet ID.
+        """
+        if len(media_ids) == 0:
+            tweet_id = self.twitter_api.PostUpdate(
+                text,
+                in_reply_to_status_id=reply_to
+            ).id
+        else:
+            tweet_id = self.twitter_api.PostUpdate(
+                text,
+                media=media_ids,
+                in_reply_to_status_id=reply_to
+            ).id
+
+        self.mark_tweet_sent(tweet_id)
+        return tweet_id
+
+    def associate_post(self, post, posted_id):
+        # Every tweet of the thread is linked to the toot, so the intermediate
+        # ones are known as ours (e.g. when catching up after a restart); the
+        # toot is linked to the last one, see comment above the
+        # status_associations declaration
+        self.associate_statuses([(post['status_id'], tweet_id) for tweet_id in post['sent'] if tweet_id != posted_id]
+                                + [(post['status_id'], posted_id)])
+
+    def fetch_statuses_since(self, since_id, limit):
+        toots = []
+        max_id = None
+
+        # Statuses are listed newest first, by pages.
+        while len(toots) < limit:
+            page = self.mastodon_api.account_statuses(
+                self.ma_account_id,
+                since_id=since_id,
+                max_id=max_id,
+                limit=min(40, limit - len(toots))
+            )
+            if not page:
+                break
+
+            toots.extend(page)
+            max_id = page[-1]['id']
+
+        return list(reversed(toots[:limit]))
+
+    def read_stream(self, callback):
+        publisher = self
 
         class TootsListener(StreamListener):
-            def __init__(self, publisher):
-                self.publisher = publisher
+            def _dispatch(self, event):
+                # There is no stream of our own toots only, so the home timeline ones are
+                # pre-filtered before being decoded: a toot whose raw JSON does not contain
+                # our account ID (as a string) is not ours. The other ones are checked
+                # again once decoded, so this only relies on Mastodon.py internals to be faster.
+                data = event.get('data') if event and event.get('event') == 'update' else None
+                if data is not None:
+                    passed = publisher.raw_identity in data
+                    metrics.filtered(publisher.direction, 'raw', passed)
+                    if not passed:
+                        return
+
+                super(TootsListener, self)._dispatch(event)
 
             def on_update(self, toot):
-                # We only transfer our own toots, but the streaming endpoint receives the whole
-                # timeline.
-                if not self.publisher.is_from_us(toot['account']):
-                    return
-
-                # Avoids a race condition.
-                # We wait a little bit so tweets sent to Mastodon
-                # can be marked as such before this run, avoiding
-                # bouncing tweets/toots.
-                time.sleep(config.STATUS_PROCESS_DELAY)
-
-                toot_id = toot["id"]
-
-                if self.publisher.is_toot_sent_by_us(toot_id):
-                    return
-
-                content = toot["content"]
-                media_attachments = toot["media_attachments"]
-
-                if toot['reblogged'] and 'reblog' in toot:
-                    reblog = toot['reblog']
-                    reblog_name = f'@{reblog["account"]["username"]}@{urlparse(reblog["account"]["url"]).netloc}'
-                    content = f'\U0001f501 RT {reblog_name}\n' \
-                              f'{reblog["content"]}\n\n' \
-                              f'{reblog["url"]}'
-                    media_attachments = reblog["media_attachments"]
-
-                    toot = reblog
-
-                # We trust mastodon to return valid HTML
-                content_clean = re.sub(r'<a [^>]*href="([^"]+)">[^<]*</a>', '\g<1>', content)
-
-                # We replace html br with new lines
-                content_clean = "\n".join(re.compile(r'<br ?/?>', re.IGNORECASE).split(content_clean))
-                # We must also replace new paragraphs with double line skips
-                content_clean = "\n\n".join(re.compile(r'</p><p>', re.IGNORECASE).split(content_clean))
-                # Then we can delete the other html contents and unescape the string
-                content_clean = html.unescape(str(re.compile(r'<.*?>').sub("", content_clean).strip()))
-                # Trim out media URLs
-                content_clean = re.sub(self.publisher.MEDIA_REGEXP, "", content_clean)
-
-                # Don't cross-post replies
-                if len(content_clean) != 0 and content_clean[0] == '@':
-                    lgt('Skipping toot "' + content_clean + '" - is a reply.')
-                    return
-
-                if config.TWEET_CW_PREFIX and toot['spoiler_text']:
-                    content_clean = config.TWEET_CW_PREFIX.format(toot['spoiler_text']) + content_clean
-
-                content_parts = split_status(
-                    status=content_clean,
-                    max_length=280,
-                    split=config.SPLIT_ON_TWITTER,
-                    url=toot['uri']
-                )
-
-                # Tweet all the parts. On error, give up and go on with the next toot.
-                try:
-                    reply_to = None
-
-                    # We check if this toot is a reply to a previously sent toot.
-                    # If so, the first corresponding tweet will be a reply to
-                    # the stored tweet.
-                    # Unlike in the Mastodon API calls, we don't have to handle the
-                    # case where the tweet was deleted, as twitter will ignore
-                    # the in_reply_to_status_id option if the given tweet
-                    # does not exists.
-                    if toot['in_reply_to_id'] in self.publisher.status_associations['m2t']:
-                        reply_to = self.publisher.status_associations['m2t'][toot['in_reply_to_id']]
-
-                    for i in range(len(content_parts)):
-                        media_ids = []
-                        content_tweet = content_parts[i]
-
-                        # Last content part: Upload media, no -- at the end
-                        if i == len(content_parts) - 1:
-                            for attachment in media_attachments:
-                                media_ids.append(self.publisher.transfer_media(
-                                    media_url=attachment["url"],
-                                    to='twitter'
-                                ))
-
-                            content_tweet = content_parts[i]
-
-                        # Some final cleaning
-                        content_tweet = content_tweet.strip()
-
-                        # Retry three times before giving up
-                        retry_counter = 0
-                        post_success = False
-
-                        lgt(f'Sending tweet "{content_tweet}"…')
-
-                        while not post_success:
-                            try:
-                                if len(media_ids) == 0:
-                                    reply_to = self.publisher.twitter_api.PostUpdate(
-                                        content_tweet,
-                                        in_reply_to_status_id=reply_to
-                                    ).id
-
-                                    self.publisher.mark_tweet_sent(reply_to)
-                                    since_tweet_id = reply_to
-                                    post_success = True
-
-                                else:
-                                    reply_to = self.publisher.twitter_api.PostUpdate(
-                                        content_tweet,
-                                        media=media_ids,
-                                        in_reply_to_status_id=reply_to
-                                    ).id
-
-                                    self.publisher.mark_tweet_sent(reply_to)
-                                    since_tweet_id = reply_to
-                                    post_success = True
-
-                            except TwitterError:
-                                if retry_counter < config.MASTODON_RETRIES:
-                                    retry_counter += 1
-                                    time.sleep(config.MASTODON_RETRY_DELAY)
-                                else:
-                                    raise
-
-                        lgt('Tweet sent successfully.')
-
-                        # Only the last tweet is linked to the toot, see comment
-                        # above the status_associations declaration
-                        if i == len(content_parts) - 1:
-                            with lock:
-                                self.publisher.associate_status(toot_id, since_tweet_id)
-                                self.publisher.save_status_associations()
-
-                except Exception as e:
-                    lgt("Encountered error after " + str(config.MASTODON_RETRIES) + " retries. Not retrying.")
-                    print(e)
-
-                # From times to times we update the Twitter URL length.
-                self.publisher.update_twitter_link_length()
+                callback(toot)
 
         # Compatibility with multiple versions of Mastodon.py
         try:
-            self.mastodon_api.stream_user(TootsListener(self), async=False)
+            self.mastodon_api.stream_user(TootsListener())
         except AttributeError:
-            self.mastodon_api.user_stream(TootsListener(self), async=False)
+            self.mastodon_api.user_stream(TootsListener())
@@ -0,0 +1,233 @@
+import io
+import mimetypes
+import os
+import shutil
+import tempfile
+import time
+
+from collections import OrderedDict
+from threading import Lock
+
+from mtt import config
+
+
+class CachedMedia(io.FileIO):
+    """
+    A media read from the cache, usable as a `MediaSpool`.
+    """
+    def __init__(self, path, content_type):
+        super(CachedMedia, self).__init__(path, 'rb')
+
+        self.content_type = content_type
+        self.size = os.path.getsize(path)
+        self.peak_memory = 0
+
+
+class MediaCache:
+    """
+    A cache of downloaded medias, on disk, keyed by content hash (SHA-256).
+
+    Source URLs are mapped to the hash of their content, so a media
+    already downloaded is not downloaded again. The media IDs obtained
+    when uploading a media are also remembered for `MEDIA_ID_REUSE_TTL`
+    seconds, so the same content is not uploaded twice to an account of a
+    platform allowing to reuse them. Media IDs are only reused for the
+    account that uploaded the media: the cache can be shared by several
+    accounts, but a media ID belongs to the account it was uploaded by.
+
+    Medias are evicted, least recently used first, when the cache is
+    larger than `MEDIA_CACHE_MAX_SIZE` bytes or when they were not used
+    for `MEDIA_CACHE_MAX_AGE` seconds.
+
+    This is thread-safe. Hits, misses, evictions and media IDs reuses
+    are counted in `stats`.
+    """
+    def __init__(self, directory=None, max_size=None, max_age=None):
+        self.directory = directory or config.FILES['media_cache']
+        self.max_size = max_size if max_size is not None else config.MEDIA_CACHE_MAX_SIZE
+        self.max_age = max_age if max_age is not None else config.MEDIA_CACHE_MAX_AGE
+
+        # hash -> (file name, content type, size); least recently used first
+        self._entries = OrderedDict()
+        self._last_use = {}
+        self._size = 0
+
+        self._urls = {}
+        self._media_ids = {}
+
+        self._lock = Lock()
+
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'media_id_reuses': 0}
+
+    @property
+    def hit_rate(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups else 0.0
+
+    def load(self):
+        """
+        Creates the cache directory, or indexes the medias already in it.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+
+        files = [entry for entry in os.scandir(self.directory) if entry.is_file() and not entry.name.endswith('.tmp')]
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+
+        with self._lock:
+            for entry in files:
+                media_hash = os.path.splitext(entry.name)[0]
+                content_type = mimetypes.guess_type(entry.name)[0] or ''
+
+                self._entries[media_hash] = (entry.name, content_type, entry.stat().st_size)
+                self._last_use[media_hash] = entry.stat().st_mtime
+                self._size += entry.stat().st_size
+
+            self._evict()
+
+        return self
+
+    def _evict(self):
+        now = time.time()
+
+        while self._entries:
+            media_hash = next(iter(self._entries))
+            if self._size <= self.max_size and now - self._last_use[media_hash] < self.max_age:
+                break
+
+            file_name, _, size = self._entries.pop(media_hash)
+            del self._last_use[media_hash]
+            self._size -= size
+
+            for key in [key for key in self._media_ids if key[0] == media_hash]:
+                del self._media_ids[key]
+            for url in [url for url, url_hash in self._urls.items() if url_hash == media_hash]:
+                del self._urls[url]
+
+            try:
+                os.unlink(os.path.join(self.directory, file_name))
+            except OSError:
+                pass
+
+            self.stats['evictions'] += 1
+
+    def _touch(self, media_hash):
+        self._entries.move_to_end(media_hash)
+        self._last_use[media_hash] = time.time()
+
+    def lookup(self, media_url):
+        """
+        :param media_url: The source URL of a media.
+        :return: The hash of the media content, if the media is in the cache; else None.
+        """
+        with self._lock:
+            self._evict()
+
+            media_hash = self._urls.get(media_url)
+            if media_hash not in self._entries:
+                self._urls.pop(media_url, None)
+                self.stats['misses'] += 1
+                return None
+
+            self._touch(media_hash)
+            self.stats['hits'] += 1
+            return media_hash
+
+    def open(self, media_hash):
+        """
+        :param media_hash: The hash of a media in the cache.
+        :return: The media, as a CachedMedia; or None if it was evicted meanwhile.
+        """
+        with self._lock:
+            if media_hash not in self._entries:
+                return None
+
+            file_name, content_type, _ = self._entries[media_hash]
+
+            try:
+                return CachedMedia(os.path.join(self.directory, file_name), content_type)
+            except OSError:
+                return None
+
+    def store(self, media_url, media):
+        """
+        Stores a downloaded media in the cache. If the same content is
+        already there, it is not stored twice.
+
+        :param media_url: The source URL of the media.
+        :param media: The media, as a MediaSpool (rewound after that).
+        :return: The hash of the media content.
+        """
+        media_hash = media.sha256.hexdigest()
+        file_name = media_hash + (mimetypes.guess_extension(media.content_type) or '')
+
+        # Too large to be cached; it would only evict everything else.
+        if media.size > self.max_size:
+            return media_hash
+
+        with self._lock:
+            known = media_hash in self._entries
+
+        path = os.path.join(self.directory, file_name)
+
+        # If the file exists, the same content was just stored by another thread: it is only indexed.
+        if not known and not os.path.exists(path):
+            # Each store writes its own temporary file, so concurrent stores of the same content do not collide.
+            fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+            try:
+                with open(fd, 'wb') as f:
+                    shutil.copyfileobj(media, f)
+                os.replace(temp_path, path)
+            except BaseException:
+                try:
+                    os.unlink(temp_path)
+                except OSError:
+                    pass
+                raise
+
+            media.seek(0)
+
+        with self._lock:
+            if media_hash not in self._entries:
+                if known:
+                    # Evicted while we were looking elsewhere; not worth storing again.
+                    return media_hash
+
+                self._entries[media_hash] = (file_name, media.content_type, media.size)
+                self._size += media.size
+
+            self._urls[media_url] = media_hash
+            self._touch(media_hash)
+            self._evict()
+
+        return media_hash
+
+    def get_media_id(self, media_hash, platform, account):
+        """
+        :param media_hash: The hash of a media content.
+        :param platform: The platform the media was uploaded to ('twitter' or 'mastodon').
+        :param account: The ID of the account the media was uploaded by.
+        :return: The media ID of this account, if it can be reused; else None.
+        """
+        with self._lock:
+            media_id, uploaded_at = self._media_ids.get((media_hash, platform, account), (None, 0))
+
+            if media_id is None or time.time() - uploaded_at >= config.MEDIA_ID_REUSE_TTL.get(platform, 0):
+                return None
+
+            self.stats['media_id_reuses'] += 1
+            return media_id
+
+    def set_media_id(self, media_hash, platform, account, media_id):
+        """
+        Remembers the media ID of an uploaded media.
+        :param media_hash: The hash of the media content.
+        :param platform: The platform the media was uploaded to ('twitter' or 'mastodon').
+        :param account: The ID of the account the media was uploaded by.
+        :param media_id: The media ID.
+        """
+        if not config.MEDIA_ID_REUSE_TTL.get(platform, 0):
+            return
+
+        with self._lock:
+            if media_hash in self._entries:
+                self._media_ids[(media_hash, platform, account)] = (media_id, time.time())
@@ -0,0 +1,359 @@
+import bisect
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from mtt import config
+
+# The upper bounds of the histograms buckets (seconds).
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    A value that only goes up, per set of labels.
+    """
+    type = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[label] for label in self.labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        """
+        :return: The samples, as (name, labels, value) tuples.
+        """
+        with self._lock:
+            values = list(self._values.items())
+
+        return [(self.name + '_total', dict(zip(self.labels, key)), value) for key, value in values]
+
+
+class Histogram:
+    """
+    The distribution of observed values (durations), per set of labels:
+    how many values are below each bucket bound, their count and their sum.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+
+        # For each set of labels: [count per bucket (and above the last one), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[label] for label in self.labels)
+        bucket = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+
+            counts[0][bucket] += 1
+            counts[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+
+        samples = []
+        for key, counts, total in values:
+            labels = dict(zip(self.labels, key))
+
+            cumulated = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulated += count
+                samples.append((self.name + '_bucket', {**labels, 'le': _format_value(bound)}, cumulated))
+
+            samples.append((self.name + '_count', labels, cumulated))
+            samples.append((self.name + '_sum', labels, total))
+
+        return samples
+
+
+class Registry:
+    """
+    The metrics exposed by the endpoint: counters and histograms updated as
+    statuses are processed, and collectors reading the state of other
+    components (queues, caches, rate limits…) when the metrics are read.
+    """
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, documentation, labels=()):
+        metric = Counter(name, documentation, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labels=(), buckets=DURATION_BUCKETS):
+        metric = Histogram(name, documentation, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """
+        :param collector: A function returning metrics read when the metrics are exposed, as
+                          (name, type, documentation, samples) tuples, samples being (labels, value)
+                          tuples.
+        """
+        self.collectors.append(collector)
+
+    def render(self):
+        """
+        :return: The metrics, in the Prometheus text format.
+        """
+        lines = []
+
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(f'{name}{_format_labels(labels)} {_format_value(value)}'
+                         for name, labels, value in metric.samples())
+
+        for collector in self.collectors:
+            try:
+                collected = list(collector())
+            except Exception:
+                continue
+
+            for name, metric_type, documentation, samples in collected:
+                lines.append(f'# HELP {name} {documentation}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                lines.extend(f'{name}{_format_labels(labels)} {_format_value(value)}' for labels, value in samples)
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+STAGE_DURATION = registry.histogram(
+    'mtt_stage_duration_seconds',
+    'Time spent in each stage of the mirroring of statuses.',
+    labels=('stage', 'direction', 'outcome')
+)
+RETRIES = registry.counter('mtt_retries', 'Statuses publications retried.', labels=('direction',))
+STREAM_FILTER = registry.counter(
+    'mtt_stream_statuses',
+    'Statuses received from the streams, passed on or dropped (not ours) by the pre-filter, '
+    'before (raw) or after (decoded) being decoded.',
+    labels=('direction', 'stage', 'outcome')
+)
+
+
+def enabled():
+    """
+    :return: True if the metrics are recorded (when the endpoint is enabled).
+    """
+    return config.METRICS_PORT is not None
+
+
+def observe(stage, direction, duration, outcome='ok'):
+    """
+    Records the duration of a stage of the mirroring of a status.
+    :param stage: The stage (see `timed`).
+    :param direction: 'm2t' (Mastodon to Twitter) or 't2m' (Twitter to Mastodon).
+    :param duration: The duration (seconds).
+    :param outcome: How the stage ended.
+    """
+    if enabled():
+        STAGE_DURATION.observe(duration, stage=stage, direction=direction, outcome=outcome)
+
+
+def retried(direction):
+    """
+    Counts a status publication retried.
+    :param direction: 'm2t' or 't2m'.
+    """
+    if enabled():
+        RETRIES.inc(direction=direction)
+
+
+def filtered(direction, stage, passed):
+    """
+    Counts a status passed on or dropped by the pre-filter of the streams.
+    :param direction: 'm2t' or 't2m'.
+    :param stage: 'raw' (before the status is decoded) or 'decoded'.
+    :param passed: False if the status was dropped.
+    """
+    if enabled():
+        STREAM_FILTER.inc(direction=direction, stage=stage, outcome='passed' if passed else 'dropped')
+
+
+class timed:
+    """
+    Times a stage of the mirroring of a status, as a context manager:
+
+        with metrics.timed('post', 'm2t') as stage:
+            ...
+            stage.outcome = 'skipped'
+
+    The outcome is 'ok', unless set otherwise or an exception is raised
+    ('error').
+
+    The stages are: 'receive' (a status received from a stream, queued or
+    ignored as a duplicate), 'wait' (queued before being processed, including
+    `STATUS_PROCESS_DELAY`), 'filter' (checking if the status must be
+    mirrored, 'accepted' or 'skipped', including 'transform' and 'split'),
+    'transform' (converting its text), 'split' (splitting a toot in tweets),
+    'media_download', 'media_upload', 'post' (each status published) and
+    'associate' (saving the association).
+    """
+    __slots__ = ('stage', 'direction', 'outcome', 'start')
+
+    def __init__(self, stage, direction, outcome='ok'):
+        self.stage = stage
+        self.direction = direction
+        self.outcome = outcome
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        observe(self.stage, self.direction, time.perf_counter() - self.start,
+                'error' if exc_type is not None else self.outcome)
+        return False
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = registry.render().encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a log line.
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    # As http.server.ThreadingHTTPServer, which requires Python 3.7.
+    daemon_threads = True
+
+
+def start_server(port=None, address=None):
+    """
+    Serves the metrics over HTTP (on `/metrics`), from a background thread.
+    :param port: The port (`METRICS_PORT` by default).
+    :param address: The address to listen on (`METRICS_ADDRESS` by default).
+    :return: The server.
+    """
+    server = MetricsServer((address or config.METRICS_ADDRESS,
+                            port if port is not None else config.METRICS_PORT), MetricsRequestHandler)
+
+    threading.Thread(target=server.serve_forever, name='Metrics', daemon=True).start()
+    return server
+
+
+def collect_resources(publishers=(), http_session=None, media_cache=None):
+    """
+    Exposes the state of the crossposter components along with the metrics:
+    the statuses waiting in the queues and the outboxes, the connections
+    reuse, the rate limits and the media cache.
+    :param publishers: The publishers.
+    :param http_session: The HTTP session (a PooledSession).
+    :param media_cache: The media cache.
+    """
+    if publishers:
+        def collect_publishers():
+            queued = []
+            pending = []
+            retrying = []
+
+            for publisher in publishers:
+                labels = {'publisher': publisher.name, 'direction': publisher.direction}
+                queued.append((labels, publisher.statuses.qsize()))
+                pending.append((labels, len(publisher.outbox.pending(publisher.source_status))))
+                retrying.append((labels, len(publisher.retry_scheduler)))
+
+            outboxes = {id(publisher.outbox): publisher.outbox for publisher in publishers}
+
+            return [
+                ('mtt_queued_statuses', 'gauge', 'Statuses waiting to be processed (threads engine).', queued),
+                ('mtt_outbox_statuses', 'gauge', 'Statuses being sent (in the outbox).', pending),
+                ('mtt_retrying_statuses', 'gauge', 'Statuses waiting for a retry (threads engine).', retrying),
+                ('mtt_outbox_records_total', 'counter', 'Records written to the outboxes.',
+                 [({}, sum(outbox.stats['records'] for outbox in outboxes.values()))]),
+                ('mtt_outbox_fsyncs_total', 'counter', 'Outboxes syncs to disk.',
+                 [({}, sum(outbox.stats['fsyncs'] for outbox in outboxes.values()))]),
+            ]
+
+        registry.add_collector(collect_publishers)
+
+    if http_session is not None:
+        def collect_http_session():
+            stats = http_session.stats()
+            hosts = [({'host': f'{scheme}://{host}:{port}'}, host_stats)
+                     for (scheme, host, port), host_stats in stats.items()]
+
+            rate_limiter = http_session.rate_limiter
+            quotas = [({'host': host, 'account': account or '', 'endpoint': endpoint}, quota)
+                      for (host, account, endpoint), quota in rate_limiter.stats().items()]
+
+            return [
+                ('mtt_http_requests_total', 'counter', 'HTTP requests sent, per host.',
+                 [(labels, host_stats['requests']) for labels, host_stats in hosts]),
+                ('mtt_http_connections_total', 'counter', 'HTTP connections opened, per host.',
+                 [(labels, host_stats['connections']) for labels, host_stats in hosts]),
+                ('mtt_rate_limit_remaining', 'gauge', 'Requests left before the rate limit reset.',
+                 [(labels, quota['remaining']) for labels, quota in quotas]),
+                ('mtt_rate_limit_reset_seconds', 'gauge', 'Time until the rate limit reset.',
+                 [(labels, quota['reset_in']) for labels, quota in quotas]),
+                ('mtt_rate_limit_paced_total', 'counter', 'Requests delayed not to exceed a rate limit.',
+                 [({}, rate_limiter.counters['paced'])]),
+                ('mtt_rate_limit_paced_seconds_total', 'counter', 'Time requests were delayed for.',
+                 [({}, rate_limiter.counters['paced_seconds'])]),
+                ('mtt_rate_limit_rejected_total', 'counter', 'Requests rejected by a rate limit.',
+                 [({}, rate_limiter.counters['rejected'])]),
+            ]
+
+        registry.add_collector(collect_http_session)
+
+    if media_cache is not None:
+        def collect_media_cache():
+            return [('mtt_media_cache_' + name + '_total', 'counter', f'Media cache {name.replace("_", " ")}.',
+                     [({}, value)]) for name, value in media_cache.stats.items()]
+
+        registry.add_collector(collect_media_cache)
@@ -0,0 +1,217 @@
+import json
+import os
+
+from collections import OrderedDict
+from threading import Condition
+
+from mtt import config
+
+
+class Outbox:
+    """
+    A write-ahead journal of the statuses to send.
+
+    A prepared status is written to the journal before anything is sent for
+    it, then each part sent, then its completion. The statuses not completed
+    when the process stopped are sent again at startup, starting after the
+    last part sent.
+
+    Planned and sent parts are synced to disk before being acknowledged, but
+    concurrent writers share fsyncs: a writer syncs everything written so
+    far, and the writers waiting meanwhile are acknowledged by the next sync.
+    Completions are not waited for (if lost, the status is only associated
+    again at startup).
+
+    The journal is rewritten with the pending statuses only at startup, and
+    when it holds more than `OUTBOX_COMPACTION_SIZE` lines.
+    """
+    def __init__(self, path=None):
+        """
+        :param path: The journal path; None to only keep the statuses in memory.
+        """
+        self.path = path
+
+        self._pending = OrderedDict()
+        self._journal = None
+        self._journal_lines = 0
+
+        # Records written and synced so far, to share fsyncs between writers.
+        self._written = 0
+        self._synced = 0
+        self._syncing = False
+        self._condition = Condition()
+
+        self.stats = {'records': 0, 'fsyncs': 0}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def load(self):
+        """
+        Loads the pending statuses from the journal, and opens it for appending.
+        """
+        if self.path is None:
+            return self
+
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        self._apply(json.loads(line))
+                    except (ValueError, TypeError, KeyError):
+                        # Torn write: the process died while appending this line.
+                        continue
+        except FileNotFoundError:
+            pass
+
+        with self._condition:
+            self._compact()
+
+        return self
+
+    def _apply(self, record):
+        operation, direction, status_id = record[:3]
+        key = (direction, status_id)
+
+        if operation == 'plan':
+            post = record[3]
+            post['sent'] = []
+            self._pending[key] = post
+        elif operation == 'sent' and key in self._pending:
+            self._pending[key]['sent'].append(record[3])
+        elif operation == 'done':
+            self._pending.pop(key, None)
+
+    def pending(self, direction):
+        """
+        :param direction: The direction (the source status type, 'toot' or 'tweet').
+        :return: The statuses planned and not completed, oldest first.
+        """
+        with self._condition:
+            return [post for (post_direction, _), post in self._pending.items() if post_direction == direction]
+
+    def plan(self, direction, post):
+        """
+        Records a prepared status before sending it.
+        :param direction: The direction.
+        :param post: The prepared status (see MTTThread.prepare_status). Its
+                     `sent` key will list the IDs of the parts sent.
+        :return: False if this status is already planned.
+        """
+        key = (direction, post['status_id'])
+
+        with self._condition:
+            if key in self._pending:
+                return False
+
+            post['sent'] = []
+            self._pending[key] = post
+            record = self._write(['plan', direction, post['status_id'], post])
+
+        self._sync(record)
+        return True
+
+    def sent(self, direction, post, posted_id):
+        """
+        Records a part of a status as sent.
+        :param direction: The direction.
+        :param post: The planned status.
+        :param posted_id: The ID of the sent part.
+        """
+        with self._condition:
+            post['sent'].append(posted_id)
+            record = self._write(['sent', direction, post['status_id'], posted_id])
+
+        self._sync(record)
+
+    def done(self, direction, post):
+        """
+        Records a status as completed (sent, or given up on).
+        :param direction: The direction.
+        :param post: The planned status.
+        """
+        with self._condition:
+            if self._pending.pop((direction, post['status_id']), None) is None:
+                return
+
+            self._write(['done', direction, post['status_id']])
+
+            if self._journal_lines > config.OUTBOX_COMPACTION_SIZE:
+                self._compact()
+
+    def _write(self, record):
+        # Called with the condition held.
+        if self._journal is None:
+            return 0
+
+        self._journal.write(json.dumps(record) + '\n')
+        self._journal.flush()
+        self._journal_lines += 1
+        self._written += 1
+        self.stats['records'] += 1
+
+        return self._written
+
+    def _sync(self, record):
+        """
+        Waits until a record is synced to disk, syncing it if no other writer is.
+        :param record: The record number, as returned by `_write`.
+        """
+        with self._condition:
+            while self._synced < record:
+                if self._syncing:
+                    self._condition.wait()
+                    continue
+
+                self._syncing = True
+                written = self._written
+                journal = self._journal
+
+                self._condition.release()
+                try:
+                    os.fsync(journal.fileno())
+                finally:
+                    self._condition.acquire()
+                    self._syncing = False
+
+                self._synced = max(self._synced, written)
+                self.stats['fsyncs'] += 1
+                self._condition.notify_all()
+
+    def _compact(self):
+        # Called with the condition held.
+        while self._syncing:
+            self._condition.wait()
+
+        temp_path = str(self.path) + '.tmp'
+
+        with open(temp_path, 'w') as f:
+            lines = 0
+            for (direction, status_id), post in self._pending.items():
+                f.write(json.dumps(['plan', direction, status_id, dict(post, sent=[])]) + '\n')
+                lines += 1
+
+                for posted_id in post['sent']:
+                    f.write(json.dumps(['sent', direction, status_id, posted_id]) + '\n')
+                    lines += 1
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        if self._journal is not None:
+            self._journal.close()
+
+        os.replace(temp_path, self.path)
+
+        self._journal = open(self.path, 'a')
+        self._journal_lines = lines
+        self._synced = self._written
+
+    def close(self):
+        with self._condition:
+            while self._syncing:
+                self._condition.wait()
+
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
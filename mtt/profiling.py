@@ -0,0 +1,301 @@
+import cProfile
+import io
+import os
+import pstats
+import random
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+import traceback
+
+from datetime import datetime
+
+from path import Path
+
+from mtt import config
+from mtt.logs import WARNING, lg
+
+# The environment variable overriding PROFILING_SAMPLE_RATE.
+SAMPLE_RATE_VARIABLE = 'MTT_PROFILING_SAMPLE_RATE'
+
+# How many functions and allocations sites are listed in the reports.
+REPORT_FUNCTIONS = 40
+REPORT_ALLOCATIONS = 20
+
+
+class _NotProfiled:
+    """
+    Stands for the profile of a status not sampled: does nothing.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NOT_PROFILED = _NotProfiled()
+
+
+class Profiler:
+    """
+    Profiles a fraction of the statuses processed (`PROFILING_SAMPLE_RATE`):
+    the time spent in each function (with cProfile) and the memory
+    allocated (with tracemalloc). Each profile is written to
+    `PROFILING_DIRECTORY`, as a pstats file and a text report; only the
+    `PROFILING_MAX_FILES` most recent ones are kept.
+
+    A single status is profiled at once, as the Python profilers are
+    process-wide; statuses sampled meanwhile are not profiled. cProfile
+    only sees the thread processing the status, so the medias transfers
+    (made by other threads) appear as the time waiting for them.
+
+    When profiling is disabled, `profiled` only makes a comparison.
+    """
+    def __init__(self):
+        # Read from the configuration on first use.
+        self.sample_rate = None
+        self.directory = None
+
+        # The directions whose next status is profiled, whatever the sample rate.
+        self.forced = set()
+
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    def configure(self):
+        """
+        Reads the profiling configuration, and the `MTT_PROFILING_SAMPLE_RATE`
+        environment variable.
+        """
+        sample_rate = os.environ.get(SAMPLE_RATE_VARIABLE)
+
+        try:
+            self.sample_rate = float(sample_rate) if sample_rate else float(config.PROFILING_SAMPLE_RATE or 0)
+        except ValueError:
+            lg('Profiling', f'Invalid profiling sample rate {sample_rate!r} (should be a number between 0 and 1): '
+                            f'profiling disabled.', level=WARNING)
+            self.sample_rate = 0
+
+        self.directory = Path(config.PROFILING_DIRECTORY)
+
+    def profiled(self, direction, status_id):
+        """
+        Profiles the processing of a status, if sampled, as a context manager:
+
+            with profiling.profiler.profiled('m2t', toot['id']):
+                ...
+
+        :param direction: 'm2t' or 't2m'.
+        :param status_id: The ID of the status.
+        """
+        if self.sample_rate is None:
+            self.configure()
+
+        if not self.sample_rate and not self.forced:
+            return NOT_PROFILED
+
+        if direction in self.forced:
+            self.forced.discard(direction)
+        elif self._random.random() >= self.sample_rate:
+            return NOT_PROFILED
+
+        if not self._lock.acquire(blocking=False):
+            return NOT_PROFILED
+
+        return StatusProfile(self, direction, status_id)
+
+    def file_path(self, name, extension):
+        """
+        :return: The path of a new file in the profiles directory, whose name starts with the current time.
+        """
+        self.directory.makedirs_p()
+        return self.directory / f'{datetime.now():%Y%m%d-%H%M%S-%f}-{name}.{extension}'
+
+    def rotate(self):
+        """
+        Removes the oldest profiles, above `PROFILING_MAX_FILES`.
+        """
+        profiles = {}
+        for file in self.directory.files():
+            profiles.setdefault(file.stem, []).append(file)
+
+        for name in sorted(profiles)[:-config.PROFILING_MAX_FILES or None]:
+            for file in profiles[name]:
+                file.remove_p()
+
+    def install_signal_handler(self):
+        """
+        Takes a snapshot when the process receives `PROFILING_SIGNAL` (see
+        `snapshot`). Only from the main thread, on platforms with this signal.
+        """
+        signal_number = getattr(signal, config.PROFILING_SIGNAL or '', None)
+        if signal_number is None or threading.current_thread() is not threading.main_thread():
+            return
+
+        # The snapshot is taken from another thread, as the main one may be holding locks
+        # the snapshot needs (logs, files…) when interrupted.
+        signal.signal(signal_number, lambda *_: threading.Thread(target=self.snapshot, name='Profiling').start())
+
+    def snapshot(self):
+        """
+        Writes a report of what every thread is doing, and of the memory
+        allocated if tracemalloc is tracing; and profiles the next status of
+        each direction.
+        """
+        if self.sample_rate is None:
+            self.configure()
+
+        frames = sys._current_frames()
+        report = io.StringIO()
+
+        for thread in threading.enumerate():
+            frame = frames.get(thread.ident)
+            if frame is None:
+                continue
+
+            report.write(f'Thread {thread.name} ({thread.ident}):\n')
+            report.write(''.join(traceback.format_stack(frame)))
+            report.write('\n')
+
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            report.write(f'Memory traced: {current} bytes (peak {peak} bytes)\n\n')
+            for stat in tracemalloc.take_snapshot().statistics('lineno')[:REPORT_ALLOCATIONS]:
+                report.write(f'{stat}\n')
+
+        try:
+            path = self.file_path('snapshot', 'txt')
+            path.write_text(report.getvalue(), encoding='utf-8')
+            self.rotate()
+        except OSError as e:
+            lg('Profiling', f'Unable to write the snapshot: {e!r}', level=WARNING)
+            return
+
+        self.forced.update(('m2t', 't2m'))
+        lg('Profiling', f'Snapshot written to {path}; profiling the next statuses.')
+
+
+class StatusProfile:
+    """
+    The profile of the processing of a status (see `Profiler.profiled`).
+    """
+    def __init__(self, profiler, direction, status_id):
+        self.profiler = profiler
+        self.direction = direction
+        self.status_id = status_id
+
+        self.profile = None
+        self.memory_before = None
+        self.tracing = False
+        self.peak = False
+        self.start = None
+
+    def __enter__(self):
+        # Profiling must never prevent the status from being processed: if it
+        # cannot be set up, the status is simply not profiled.
+        try:
+            if config.PROFILING_TRACEMALLOC:
+                self.tracing = not tracemalloc.is_tracing()
+                if self.tracing:
+                    tracemalloc.start()
+                else:
+                    self.memory_before = tracemalloc.take_snapshot()
+
+                # Else (before Python 3.9) the peak is only known if we started tracing.
+                if hasattr(tracemalloc, 'reset_peak'):
+                    tracemalloc.reset_peak()
+                self.peak = self.tracing or hasattr(tracemalloc, 'reset_peak')
+
+            self.profile = cProfile.Profile()
+            try:
+                self.profile.enable()
+            except ValueError:
+                # Another profiler (or debugger) is active.
+                self.profile = None
+
+        except Exception as e:
+            self.stop()
+            self.start = None
+            lg('Profiling', f'Unable to profile the status: {e!r}', level=WARNING)
+            return self
+
+        self.start = time.perf_counter()
+        return self
+
+    def stop(self):
+        """
+        Stops the profilers started, and lets another status be profiled.
+        """
+        try:
+            if self.profile is not None:
+                self.profile.disable()
+            if self.tracing and tracemalloc.is_tracing():
+                tracemalloc.stop()
+        finally:
+            self.profiler._lock.release()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.start is None:
+            # Not profiled (see __enter__).
+            return False
+
+        duration = time.perf_counter() - self.start
+
+        if self.profile is not None:
+            self.profile.disable()
+
+        # Broad exception, as profiling must never fail the processing of the status.
+        try:
+            try:
+                memory = None
+                if config.PROFILING_TRACEMALLOC and tracemalloc.is_tracing():
+                    memory = tracemalloc.get_traced_memory()[1] if self.peak else None, tracemalloc.take_snapshot()
+            finally:
+                self.stop()
+
+            self.write(duration, memory, exc_value)
+        except Exception as e:
+            lg('Profiling', f'Unable to write the profile: {e!r}', level=WARNING)
+
+        return False
+
+    def write(self, duration, memory, error):
+        """
+        Writes the profile (a pstats file) and its report (a text file).
+        """
+        name = f'{self.direction}-{self.status_id}'
+        report = io.StringIO()
+
+        report.write(f'Status {self.status_id} ({self.direction}) processed in {duration:.3f} seconds'
+                     f'{f" (failed: {error!r})" if error is not None else ""}.\n')
+
+        if memory is not None:
+            peak, snapshot = memory
+            if peak is not None:
+                report.write(f'\nMemory peak: {peak} bytes.')
+            report.write('\nMemory allocated and not freed:\n')
+
+            statistics = (snapshot.compare_to(self.memory_before, 'lineno') if self.memory_before is not None
+                          else snapshot.statistics('lineno'))
+            for stat in statistics[:REPORT_ALLOCATIONS]:
+                report.write(f'{stat}\n')
+
+        if self.profile is not None:
+            path = self.profiler.file_path(name, 'prof')
+            self.profile.dump_stats(path)
+
+            report.write('\n')
+            pstats.Stats(self.profile, stream=report).sort_stats('cumulative').print_stats(REPORT_FUNCTIONS)
+        else:
+            path = self.profiler.file_path(name, 'txt')
+
+        path.with_suffix('.txt').write_text(report.getvalue(), encoding='utf-8')
+        self.profiler.rotate()
+
+        lg('Profiling', f'Profile of {name} written to {path.with_suffix(".txt")}.')
+
+
+profiler = Profiler()
@@ -0,0 +1,204 @@
+import hashlib
+import re
+import time
+
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from threading import Lock
+from urllib.parse import urlparse
+
+from mtt import config
+from mtt.logs import WARNING, lgt
+
+# Path segments identifying a resource, so requests on different resources
+# (e.g. the statuses of different users) share the endpoint bucket.
+_ID_SEGMENT = re.compile(r'/\d+(?=/|\.json$|$)')
+
+
+class TokenBucket:
+    """
+    The quota of an endpoint for an account, as reported by the API: `limit`
+    requests per window, `remaining` of them left until `reset_at`
+    (monotonic time), when the bucket is refilled.
+
+    The length of the window is estimated as the longest time until a reset
+    seen, to spread the requests waiting for a reset over the next window.
+    """
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset_at = None
+        self.next_at = 0.0
+        self.window = 0.0
+
+    def update(self, limit, remaining, reset_at, now):
+        self.limit = limit
+        self.remaining = remaining
+        self.reset_at = reset_at
+        self.window = max(self.window, reset_at - now)
+
+    def spacing(self):
+        """
+        :return: The interval between requests spreading the quota evenly over a window (seconds).
+        """
+        return self.window / self.limit if self.limit else 0.0
+
+    def reserve(self, now, threshold):
+        """
+        Takes a token for a request.
+        :param now: The current monotonic time.
+        :param threshold: The fraction of the quota below which requests are spread
+                          evenly until the reset.
+        :return: How long to wait before sending the request (seconds).
+        """
+        at = max(now, self.next_at)
+
+        if self.reset_at is None or now >= self.reset_at:
+            # The window ended: the quota is unknown until the next response, but the
+            # requests still waiting for the reset keep being spread.
+            self.reset_at = None
+            if at > now:
+                self.next_at = at + self.spacing()
+            return at - now
+
+        if self.remaining <= 0:
+            # Each request waiting for the reset is given its own slot in the next window,
+            # rather than all of them being sent at the reset.
+            at = max(at, self.reset_at)
+            self.next_at = at + self.spacing()
+            return at - now
+
+        if self.remaining < self.limit * threshold:
+            self.next_at = at + (self.reset_at - at) / self.remaining
+
+        self.remaining -= 1
+        return at - now
+
+
+class RateLimiter:
+    """
+    Paces the requests to the APIs from the rate limits they report in their
+    responses headers (`X-RateLimit-*` for Mastodon, `x-rate-limit-*` for
+    Twitter), so quotas are not exceeded.
+
+    There is a bucket per account and endpoint on Twitter, and per account on
+    Mastodon (where the limit is global, except for medias). When less than
+    `RATE_LIMIT_PACING_THRESHOLD` of a quota remains, the requests left are
+    spread evenly until the reset; when none remains, requests wait for it,
+    and are spread over the next window.
+
+    The remaining quotas are available through `stats()`, and the requests
+    paced and rejected are counted in `counters`.
+    """
+    def __init__(self):
+        self._buckets = {}
+        self._lock = Lock()
+
+        self.counters = {'requests': 0, 'paced': 0, 'paced_seconds': 0.0, 'rejected': 0}
+
+    @staticmethod
+    def bucket_key(method, url, headers=None, auth=None):
+        """
+        :return: The key of the bucket of a request: (host, account, endpoint).
+        """
+        parsed = urlparse(url)
+        host = parsed.netloc
+
+        # The account is identified by a hash of its token, not to expose it.
+        token = (headers or {}).get('Authorization') or \
+            getattr(getattr(auth, 'client', None), 'resource_owner_key', None)
+        account = hashlib.sha1(token.encode()).hexdigest()[:8] if token else None
+
+        # The Twitter API paths start with its version, wherever it is served from.
+        if parsed.path.startswith('/1.1/'):
+            endpoint = f'{method.upper()} {_ID_SEGMENT.sub("/:id", parsed.path)}'
+        elif '/media' in parsed.path:
+            endpoint = 'media'
+        else:
+            endpoint = '*'
+
+        return host, account, endpoint
+
+    def acquire(self, key):
+        """
+        Waits until a request can be sent without exceeding its quota.
+        :param key: The bucket key.
+        """
+        with self._lock:
+            self.counters['requests'] += 1
+
+            bucket = self._buckets.get(key)
+            delay = bucket.reserve(time.monotonic(), config.RATE_LIMIT_PACING_THRESHOLD) if bucket else 0
+
+            if delay > 0:
+                self.counters['paced'] += 1
+                self.counters['paced_seconds'] += delay
+
+        if delay >= 1:
+            lgt(f'Rate limit almost reached on {key[0]} ({key[2]}): waiting {delay:.0f} seconds…', level=WARNING)
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def update(self, key, response):
+        """
+        Updates a bucket from the rate limit headers of a response.
+        :param key: The bucket key.
+        :param response: The response.
+        """
+        headers = response.headers
+
+        if response.status_code == 429:
+            with self._lock:
+                self.counters['rejected'] += 1
+
+        try:
+            limit = int(headers.get('X-RateLimit-Limit') or headers['x-rate-limit-limit'])
+            remaining = int(headers.get('X-RateLimit-Remaining') or headers['x-rate-limit-remaining'])
+            reset_at = time.monotonic() + self._seconds_until(headers.get('X-RateLimit-Reset')
+                                                              or headers['x-rate-limit-reset'],
+                                                              headers.get('Date'))
+        except (KeyError, TypeError, ValueError):
+            if response.status_code == 429 and headers.get('Retry-After', '').isdigit():
+                limit, remaining = 1, 0
+                reset_at = time.monotonic() + int(headers['Retry-After'])
+            else:
+                return
+
+        if response.status_code == 429:
+            remaining = 0
+
+        with self._lock:
+            self._buckets.setdefault(key, TokenBucket()).update(limit, remaining, reset_at, time.monotonic())
+
+    @staticmethod
+    def _seconds_until(reset, date=None):
+        """
+        :param reset: The reset time, as a timestamp (Twitter) or an ISO 8601 date (Mastodon).
+        :param date: The server date (HTTP format), to avoid depending on the clocks being in sync.
+        :return: The number of seconds until the reset.
+        """
+        try:
+            reset = float(reset)
+        except ValueError:
+            reset = datetime.strptime(reset[:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+
+        try:
+            now = parsedate_to_datetime(date).timestamp()
+        except (TypeError, ValueError):
+            now = time.time()
+
+        return max(0.0, reset - now)
+
+    def stats(self):
+        """
+        The remaining quotas.
+        :return: A dict mapping each bucket key (host, account, endpoint) to a dict with
+                 the limit, the remaining requests and the seconds until the reset.
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            return {key: {'limit': bucket.limit, 'remaining': bucket.remaining,
+                          'reset_in': max(0.0, bucket.reset_at - now)}
+                    for key, bucket in self._buckets.items() if bucket.reset_at is not None}
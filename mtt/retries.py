@@ -0,0 +1,81 @@
+import heapq
+import itertools
+import random
+import time
+
+from threading import Condition, Thread
+
+from mtt import config
+
+
+def backoff_delay(attempt, base_delay, max_delay):
+    """
+    Computes the delay before a retry: the base delay, multiplied by
+    `RETRY_BACKOFF_FACTOR` for each previous retry, up to the maximal delay,
+    and randomly shortened by up to `RETRY_JITTER` (so statuses failing
+    together are not retried together).
+    :param attempt: The number of retries already made.
+    :param base_delay: The delay before the first retry (seconds).
+    :param max_delay: The maximal delay (seconds).
+    :return: The delay (seconds).
+    """
+    delay = min(max_delay, base_delay * config.RETRY_BACKOFF_FACTOR ** attempt)
+    return delay * (1 - config.RETRY_JITTER * random.random())
+
+
+class RetryScheduler:
+    """
+    Calls functions after a delay, from a single thread, the earliest first.
+
+    Statuses waiting to be retried are parked here instead of holding a
+    worker, so the other statuses keep flowing meanwhile.
+    """
+    def __init__(self, name=None):
+        """
+        :param name: The name of the scheduler thread (used in logs).
+        """
+        self.name = name
+
+        # Heap of (time due, insertion order, function, args)
+        self._timers = []
+        self._counter = itertools.count()
+        self._condition = Condition()
+        self._thread = None
+
+    def __len__(self):
+        with self._condition:
+            return len(self._timers)
+
+    def schedule(self, delay, function, *args):
+        """
+        Calls a function after a delay.
+        :param delay: The delay (seconds).
+        :param function: The function.
+        :param args: The function arguments.
+        """
+        with self._condition:
+            heapq.heappush(self._timers, (time.monotonic() + delay, next(self._counter), function, args))
+
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if not self._timers:
+                        self._condition.wait()
+                        continue
+
+                    delay = self._timers[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+
+                    self._condition.wait(delay)
+
+                _, _, function, args = heapq.heappop(self._timers)
+
+            function(*args)
@@ -0,0 +1,76 @@
+import requests
+
+from requests.adapters import HTTPAdapter
+
+from mtt import config
+from mtt.ratelimits import RateLimiter
+
+
+class PooledSession(requests.Session):
+    """
+    A requests session keeping connections alive in per-host pools, to be
+    shared by all threads (requests sessions are safe to use from multiple
+    threads as long as they are not reconfigured).
+
+    Requests without explicit timeout use `HTTP_CONNECT_TIMEOUT` and
+    `HTTP_READ_TIMEOUT`; streamed requests only get the connect timeout,
+    as streams may stay silent for a while.
+
+    Requests are paced by `rate_limiter` (unless `RATE_LIMIT_PACING` is
+    disabled), except streamed ones.
+    """
+    def __init__(self, pool_connections=None, pool_maxsize=None, connect_timeout=None, read_timeout=None,
+                 rate_limiter=None):
+        super(PooledSession, self).__init__()
+
+        self.connect_timeout = connect_timeout if connect_timeout is not None else config.HTTP_CONNECT_TIMEOUT
+        self.read_timeout = read_timeout if read_timeout is not None else config.HTTP_READ_TIMEOUT
+        self.rate_limiter = rate_limiter or RateLimiter()
+
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections or config.HTTP_POOL_CONNECTIONS,
+            pool_maxsize=pool_maxsize or config.HTTP_POOL_MAXSIZE
+        )
+
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = (self.connect_timeout, None if kwargs.get('stream') else self.read_timeout)
+
+        if kwargs.get('stream') or not config.RATE_LIMIT_PACING:
+            return super(PooledSession, self).request(method, url, **kwargs)
+
+        key = self.rate_limiter.bucket_key(method, url, kwargs.get('headers'), kwargs.get('auth'))
+        self.rate_limiter.acquire(key)
+
+        response = super(PooledSession, self).request(method, url, **kwargs)
+        self.rate_limiter.update(key, response)
+
+        return response
+
+    def stats(self):
+        """
+        Connection reuse statistics, per host.
+        :return: A dict mapping each host (scheme, host, port) to a dict with the number
+                 of requests sent, connections opened and connections reused.
+        """
+        stats = {}
+
+        for adapter in set(self.adapters.values()):
+            pools = adapter.poolmanager.pools
+
+            for key in list(pools.keys()):
+                try:
+                    pool = pools[key]
+                except KeyError:
+                    continue
+
+                host = (pool.scheme, pool.host, pool.port)
+                host_stats = stats.setdefault(host, {'requests': 0, 'connections': 0, 'reused': 0})
+                host_stats['requests'] += pool.num_requests
+                host_stats['connections'] += pool.num_connections
+                host_stats['reused'] += max(0, pool.num_requests - pool.num_connections)
+
+        return stats
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+import time
+
+from contextlib import contextmanager
+from threading import Lock
+
+from mtt import config
+from mtt.logs import WARNING, lgt
+
+
+def credentials_fingerprint(files):
+    """
+    :param files: The account files (same keys as `config.FILES`).
+    :return: A hash of the credentials files contents, changing when the credentials do.
+    """
+    digest = hashlib.sha256()
+
+    for key in sorted(files):
+        if key.startswith('credentials_'):
+            try:
+                digest.update(files[key].read_bytes())
+            except OSError:
+                pass
+
+    return digest.hexdigest()
+
+
+class StartupCache:
+    """
+    The values retrieved from the APIs at startup that rarely change (the
+    accounts identities, the Twitter configuration), kept on disk so
+    restarts do not wait for them.
+
+    Each value expires after `STARTUP_CACHE_TTL` seconds, and all of them
+    are discarded when the credentials change. The cache is saved, if a
+    path is given, after each update (by writing a new file and atomically
+    swapping it in).
+    """
+    def __init__(self, path=None, fingerprint=None):
+        """
+        :param path: The cache file.
+        :param fingerprint: The credentials fingerprint (see `credentials_fingerprint`).
+        """
+        self.path = path
+        self.fingerprint = fingerprint
+
+        self._entries = {}
+        self._lock = Lock()
+
+    def load(self):
+        if self.path is None:
+            return self
+
+        try:
+            with open(self.path, 'r') as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            return self
+
+        if cache.get('fingerprint') == self.fingerprint:
+            self._entries = cache.get('entries', {})
+
+        return self
+
+    def get(self, key, expired=False):
+        """
+        :param key: The value key.
+        :param expired: If True, expired values are returned too.
+        :return: The value, or None if it is not cached (or expired).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+
+        if entry is None or (not expired and time.time() - entry['time'] > config.STARTUP_CACHE_TTL):
+            return None
+
+        return entry['value']
+
+    def expires_in(self, key):
+        """
+        :param key: The value key.
+        :return: How long until the value expires (seconds); 0 if it is not cached or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+
+        if entry is None:
+            return 0
+
+        return max(0, entry['time'] + config.STARTUP_CACHE_TTL - time.time())
+
+    def set(self, key, value):
+        """
+        :param key: The value key.
+        :param value: The value (JSON-serializable).
+        """
+        with self._lock:
+            self._entries[key] = {'time': time.time(), 'value': value}
+            self._save()
+
+    def fetch(self, key, retrieve):
+        """
+        :param key: The value key.
+        :param retrieve: A function retrieving the value, called if it is not cached or expired.
+        :return: The value.
+        """
+        value = self.get(key)
+
+        if value is None:
+            value = retrieve()
+            self.set(key, value)
+
+        return value
+
+    def _save(self):
+        if self.path is None:
+            return
+
+        try:
+            temp_path = str(self.path) + '.tmp'
+
+            with open(temp_path, 'w') as f:
+                json.dump({'fingerprint': self.fingerprint, 'entries': self._entries}, f)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(temp_path, self.path)
+        except OSError:
+            lgt('Encountered error while saving startup cache file. The next startup will be slower. '
+                'Check files permissions.', level=WARNING)
+
+
+class StartupTimer:
+    """
+    Times the phases of the startup, to report where the time goes.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Times a phase, as a context manager.
+        :param name: The phase name.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def report(self):
+        """
+        Logs the startup duration, and the duration of each phase.
+        """
+        phases = ', '.join(f'{name}: {duration:.2f} s' for name, duration in self.phases)
+        lgt(f'Started in {time.perf_counter() - self.start:.2f} s ({phases}).')
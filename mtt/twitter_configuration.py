@@ -0,0 +1,74 @@
+import time
+
+from threading import Thread
+
+from mtt.logs import WARNING, lgt
+from mtt.startup import StartupCache
+
+# The length of the links shortened by Twitter, until it is known.
+DEFAULT_SHORT_URL_LENGTH = 23
+
+# How long to wait before retrying when the configuration cannot be retrieved (seconds).
+RETRY_DELAY = 10 * 60
+
+
+class ShortUrlLength:
+    """
+    The length of the links shortened by Twitter (t.co), from the Twitter
+    configuration.
+
+    It is kept in the startup cache, so it survives restarts, and refreshed
+    from a background thread when it expires from it: reading it never
+    waits for the API. Until it is refreshed, or if the API fails, the last
+    known length is used (`DEFAULT_SHORT_URL_LENGTH` if there is none).
+    """
+    key = 'twitter_short_url_length'
+
+    def __init__(self, twitter_api, startup_cache=None, name=None):
+        """
+        :param twitter_api: The Twitter API.
+        :param startup_cache: The startup cache of the account.
+        :param name: The name of the refreshing thread (used in logs).
+        """
+        self.twitter_api = twitter_api
+        self.startup_cache = startup_cache if startup_cache is not None else StartupCache()
+        self.name = name
+
+        self.value = self.startup_cache.get(self.key, expired=True) or DEFAULT_SHORT_URL_LENGTH
+        self._thread = None
+
+    def start(self):
+        """
+        Starts refreshing the length in the background (right away if it expired).
+        """
+        if self._thread is None:
+            self._thread = Thread(target=self._refresh_forever, name=self.name, daemon=True)
+            self._thread.start()
+
+    def refresh(self):
+        """
+        Retrieves the length from the Twitter configuration, and stores it.
+        """
+        # Else python-twitter keeps returning the configuration it retrieved before.
+        self.twitter_api._config = None
+        length = max(self.twitter_api.GetShortUrlLength(False), self.twitter_api.GetShortUrlLength(True))
+
+        self.startup_cache.set(self.key, length)
+        self.value = length
+
+        lgt(f'Updated expected short URL length - it is now {length + 1} characters.')
+
+    def _refresh_forever(self):
+        while True:
+            delay = self.startup_cache.expires_in(self.key)
+            if delay > 0:
+                time.sleep(delay)
+
+            try:
+                self.refresh()
+
+            # Broad exception to keep refreshing in case of network problems or anything else.
+            except Exception as e:
+                lgt(f'Unable to update the short URL length, still using {self.value + 1} characters '
+                    f'(retrying in {RETRY_DELAY} seconds): {e!r}', level=WARNING)
+                time.sleep(RETRY_DELAY)
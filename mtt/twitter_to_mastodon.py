@@ -1,16 +1,20 @@
-import html
-import re
-import time
-
 from mastodon.Mastodon import MastodonError, MastodonAPIError
 
-from mtt import config, lock
+from mtt import config, lock, metrics
+from mtt.converters import TweetConverter, tweet_entities
 from mtt.utils import MTTThread, lgt
 
 
 class MastodonPublisher(MTTThread):
+    source_status = 'tweet'
+    destination = 'mastodon'
+    destination_status = 'toot'
+    publish_errors = (MastodonError,)
+    direction = 't2m'
+
     def __init__(self, mastodon_api, twitter_api, ma_account_id, tw_account_id,
-                 status_associations, sent_status, group=None, target=None, name=None):
+                 status_associations, sent_status, media_cache=None, http_session=None, media_executor=None,
+                 checkpoints=None, outbox=None, group=None, target=None, name=None):
         super(MastodonPublisher, self).__init__(
             group=group,
             target=target,
@@ -20,224 +24,188 @@ class MastodonPublisher(MTTThread):
             ma_account_id=ma_account_id,
             tw_account_id=tw_account_id,
             status_associations=status_associations,
-            sent_status=sent_status
+            sent_status=sent_status,
+            media_cache=media_cache,
+            http_session=http_session,
+            media_executor=media_executor,
+            checkpoints=checkpoints,
+            outbox=outbox
         )
 
         self.since_tweet_id = 0
+        self.tweet_converter = TweetConverter()
+
+        # Our identity, computed once, to recognize our tweets.
+        self.identity = str(tw_account_id)
 
     def init_process(self):
         try:
             self.since_tweet_id = self.twitter_api.GetUserTimeline()[0].id
-            lgt('Tooting any tweet after tweet {}'.format(self.since_tweet_id))
+            self.checkpoints.setdefault(self.source_status, self.since_tweet_id)
+            lgt('Tooting any tweet after tweet {}'.format(self.checkpoints.get(self.source_status)))
         except IndexError:
             lgt('Tooting any tweet (user timeline is empty right now)')
 
-    @staticmethod
-    def _get_tweet_full_text(tweet):
-        if 'extended_tweet' in tweet:
-            if 'full_text' in tweet['extended_tweet']:
-                return tweet['extended_tweet']['full_text']
-            elif 'text' in tweet['extended_tweet']:
-                return tweet['extended_tweet']['text']
-        elif 'full_text' in tweet:
-            return tweet['full_text']
-        elif 'text' in tweet:
-            return tweet['text']
-        else:
-            return ''
-
-    def run(self):
-        self.init_process()
-
-        lgt('Listening for tweets…')
+    def prepare_status(self, tweet):
+        """
+        Prepares the toot to send for a tweet.
+        :param tweet: The tweet.
+        :return: The toot to send (see MTTThread.prepare_status), or None if
+                 the tweet must not be sent.
+        """
+        tweet_id = tweet['id']
+
+        if self.is_tweet_sent_by_us(tweet_id):
+            return None
+
+        if not self.is_own_status(tweet):
+            return None
+
+        # Already mirrored (e.g. received again while catching up after a reconnection),
+        # or sent by us from a toot (including the intermediate tweets of a thread).
+        with lock:
+            if tweet_id in self.status_associations['t2m']:
+                return None
+
+        original_tweet = tweet
+        is_retweet = False
+
+        if 'retweeted_status' in tweet:
+            tweet = tweet['retweeted_status']
+            is_retweet = True
+
+        reply_to = None
+
+        with lock:
+            if 'in_reply_to_user_id' in tweet and 'in_reply_to_status_id' in tweet and tweet['in_reply_to_user_id']:
+                # If it's a reply, we keep the tweet if:
+                # 1. it's a reply from us (in a thread);
+                # 2. it's a reply from a previously transmitted tweet, so we don't sync
+                #    if someone replies to someone in two or more tweets (because in this
+                #    case the 2nd tweet and the ones after are replying to us);
+                # 3. it's a reply from another one but we retweeted it.
+
+                # If it's not a tweet in reply to us
+                if ((tweet['in_reply_to_user_id'] != self.tw_account_id
+                     # or if it's a reply to us but not in our threads association
+                     or tweet['in_reply_to_status_id'] not in self.status_associations['t2m'])
+                    # or if it's a tweet from us but not a retweet
+                   and not is_retweet):
+
+                    # ... in all these cases, we don't want to transfer the tweet.
+                    lgt(f'Skipping tweet {tweet_id} - it\'s a reply.')
+                    return None
+
+                # A tweet can be a reply without previous tweet if we directly mentioned someone
+                # (starting the tweet with the mention).
+                if tweet['in_reply_to_status_id'] is not None:
+                    reply_to = self.status_associations['t2m'].get(tweet['in_reply_to_status_id'])
+
+        media_attachments = tweet_entities(tweet, 'media')
+
+        sensitive = tweet['possibly_sensitive'] if 'possibly_sensitive' in tweet else False
+
+        # Mentions get an equivalent clearly signaling their origin on Twitter, URLs
+        # are un-shortened, t.co links to medias removed and content warnings extracted.
+        with metrics.timed('transform', self.direction):
+            content_toot, warning = self.tweet_converter.convert_tweet(original_tweet)
+
+        return {
+            'status_id': tweet_id,
+            'parts': [content_toot],
+            'media_urls': [attachment['media_url_https'] if 'media_url_https' in attachment
+                           else attachment['media_url'] for attachment in media_attachments],
+            'reply_to': reply_to,
+            'warning': warning,
+            'sensitive': sensitive
+        }
+
+    def post_status(self, post, text, media_ids, reply_to):
+        """
+        Sends a toot.
+        :param post: The prepared tweet.
+        :param text: The toot text.
+        :param media_ids: The medias to attach to the toot.
+        :param reply_to: The toot to reply to, if any.
+        :return: The toot ID.
+        """
+        if len(media_ids) == 0:
+            try:
+                toot = self.mastodon_api.status_post(
+                    text,
+                    visibility=config.TOOT_VISIBILITY,
+                    spoiler_text=post['warning'],
+                    in_reply_to_id=reply_to
+                )
+                self.mark_toot_sent(toot['id'])
+
+            except MastodonAPIError:
+                # If the toot we are replying to has been deleted while we were processing it
+                toot = self.mastodon_api.status_post(
+                    text,
+                    visibility=config.TOOT_VISIBILITY,
+                    spoiler_text=post['warning']
+                )
+                self.mark_toot_sent(toot['id'])
 
+        else:
+            try:
+                toot = self.mastodon_api.status_post(
+                    text,
+                    media_ids=media_ids,
+                    visibility=config.TOOT_VISIBILITY,
+                    sensitive=post['sensitive'],
+                    spoiler_text=post['warning'],
+                    in_reply_to_id=reply_to
+                )
+                self.mark_toot_sent(toot['id'])
+
+            except MastodonAPIError:
+                # If the toot we are replying to has been deleted (same as before)
+                toot = self.mastodon_api.status_post(
+                    text,
+                    media_ids=media_ids,
+                    visibility=config.TOOT_VISIBILITY,
+                    sensitive=post['sensitive'],
+                    spoiler_text=post['warning']
+                )
+                self.mark_toot_sent(toot['id'])
+
+        return toot['id']
+
+    def associate_post(self, post, posted_id):
+        self.associate_status(posted_id, post['status_id'])
+
+    def is_own_status(self, tweet):
+        return tweet['user']['id_str'] == self.identity
+
+    def fetch_statuses_since(self, since_id, limit):
+        tweets = []
+        max_id = None
+
+        # Statuses are listed newest first, by pages.
+        while len(tweets) < limit:
+            page = self.twitter_api.GetUserTimeline(
+                user_id=self.tw_account_id,
+                since_id=since_id,
+                max_id=max_id,
+                count=min(200, limit - len(tweets)),
+                include_rts=True
+            )
+            if not page:
+                break
+
+            tweets.extend(page)
+            max_id = page[-1].id - 1
+
+        # The stream gives raw tweets, not python-twitter models.
+        return [getattr(tweet, '_json', None) or tweet.AsDict() for tweet in reversed(tweets[:limit])]
+
+    def read_stream(self, callback):
+        # By default (withuser='user'), the user stream does not deliver the tweets
+        # of the accounts we follow; the others it does (e.g. mentions) are dropped by listen.
         for tweet in self.twitter_api.GetUserStream():
             if 'text' not in tweet and 'full_text' not in tweet:
                 continue
 
-            # Avoids a race condition.
-            # We wait a little bit so toots sent to Twitter
-            # can be marked as such before this run, avoiding
-            # bouncing tweets/toots.
-            time.sleep(config.STATUS_PROCESS_DELAY)
-
-            tweet_id = tweet['id']
-
-            if self.is_tweet_sent_by_us(tweet_id):
-                continue
-
-            if tweet['user']['id_str'] != str(self.tw_account_id):
-                continue
-
-            is_retweet = False
-
-            content = MastodonPublisher._get_tweet_full_text(tweet)
-
-            if 'retweeted_status' in tweet:
-                rt = tweet['retweeted_status']
-                rt_content = MastodonPublisher._get_tweet_full_text(rt)
-
-                content = f'\U0001f501 RT @{rt["user"]["screen_name"]}\n\n' \
-                          f'{rt_content}\n\n' \
-                          f'https://twitter.com/{rt["user"]["screen_name"]}/status/{rt["id_str"]}'
-
-                tweet = rt
-                is_retweet = True
-
-            reply_to = None
-
-            with lock:
-                if 'in_reply_to_user_id' in tweet and 'in_reply_to_status_id' in tweet and tweet['in_reply_to_user_id']:
-                    # If it's a reply, we keep the tweet if:
-                    # 1. it's a reply from us (in a thread);
-                    # 2. it's a reply from a previously transmitted tweet, so we don't sync
-                    #    if someone replies to someone in two or more tweets (because in this
-                    #    case the 2nd tweet and the ones after are replying to us);
-                    # 3. it's a reply from another one but we retweeted it.
-
-                    # If it's not a tweet in reply to us
-                    if ((tweet['in_reply_to_user_id'] != self.tw_account_id
-                         # or if it's a reply to us but not in our threads association
-                         or tweet['in_reply_to_status_id'] not in self.status_associations['t2m'])
-                        # or if it's a tweet from us but not a retweet
-                       and not is_retweet):
-
-                        # ... in all these cases, we don't want to transfer the tweet.
-                        lgt(f'Skipping tweet {tweet_id} - it\'s a reply.')
-                        continue
-
-                    # A tweet can be a reply without previous tweet if we directly mentioned someone
-                    # (starting the tweet with the mention).
-                    if tweet['in_reply_to_status_id'] is not None:
-                        reply_to = self.status_associations['t2m'].get(tweet['in_reply_to_status_id'])
-
-            media_attachments = (tweet['media'] if 'media' in tweet
-                                 else tweet['entities']['media'] if 'entities' in tweet and 'media' in tweet['entities']
-                                 else tweet['extended_tweet']['entities']['media']
-                                     if 'extended_tweet' in tweet and 'entities' in tweet['extended_tweet']
-                                     and 'media' in tweet['extended_tweet']['entities']
-                                 else [])
-
-            urls = (tweet['urls'] if 'urls' in tweet
-                    else tweet['entities']['urls'] if 'entities' in tweet and 'urls' in tweet['entities']
-                    else tweet['extended_tweet']['entities']['urls']
-                        if 'extended_tweet' in tweet and 'entities' in tweet['extended_tweet']
-                        and 'urls' in tweet['extended_tweet']['entities']
-                    else [])
-
-            sensitive = tweet['possibly_sensitive'] if 'possibly_sensitive' in tweet else False
-
-            content_toot = html.unescape(content)
-            mentions = re.findall(r'@[a-zA-Z0-9_]*', content_toot)
-            cws = config.TWEET_CW_REGEXP.findall(content) if config.TWEET_CW_REGEXP else []
-            warning = None
-            media_ids = []
-
-            if mentions:
-                for mention in mentions:
-                    # Replace all mentions for an equivalent to clearly signal their origin on Twitter
-                    content_toot = re.sub(mention, mention + '@twitter.com', content_toot)
-
-            if urls:
-                for url in urls:
-                    # Un-shorten URLs
-                    content_toot = re.sub(url['url'], url['expanded_url'], content_toot)
-
-            if cws:
-                warning = (config.TWEET_CW_SEPARATOR.join([cw.strip() for cw in cws]) if config.TWEET_CW_ALLOW_MULTI
-                           else cws[0].strip())
-                content_toot = config.TWEET_CW_REGEXP.sub('', content_toot, count=(0 if config.TWEET_CW_ALLOW_MULTI
-                                                                                   else 1)).strip()
-
-            if media_attachments:
-                for attachment in media_attachments:
-                    # Remove the t.co link to the media
-                    content_toot = re.sub(attachment['url'], '', content_toot)
-
-                    attachment_url = (attachment['media_url_https'] if 'media_url_https' in attachment
-                                      else attachment['media_url'])
-
-                    media_ids.append(self.transfer_media(
-                        media_url=attachment_url,
-                        to='mastodon'
-                    ))
-
-            # Now that the toot is ready, we send it.
-            try:
-                retry_counter = 0
-                post_success = False
-
-                lgt(f'Sending toot "{content_toot.strip()}"…')
-
-                while not post_success:
-                    try:
-                        if len(media_ids) == 0:
-                            try:
-                                post = self.mastodon_api.status_post(
-                                    content_toot,
-                                    visibility=config.TOOT_VISIBILITY,
-                                    spoiler_text=warning,
-                                    in_reply_to_id=reply_to
-                                )
-                                self.mark_toot_sent(post['id'])
-
-                            except MastodonAPIError:
-                                # If the toot we are replying to has been deleted while we were processing it
-                                post = self.mastodon_api.status_post(
-                                    content_toot,
-                                    visibility=config.TOOT_VISIBILITY,
-                                    spoiler_text=warning
-                                )
-                                self.mark_toot_sent(post['id'])
-
-                            since_toot_id = post['id']
-                            post_success = True
-
-                        else:
-                            try:
-                                post = self.mastodon_api.status_post(
-                                    content_toot,
-                                    media_ids=media_ids,
-                                    visibility=config.TOOT_VISIBILITY,
-                                    sensitive=sensitive,
-                                    spoiler_text=warning,
-                                    in_reply_to_id=reply_to
-                                )
-                                self.mark_toot_sent(post['id'])
-
-                            except MastodonAPIError:
-                                # If the toot we are replying to has been deleted (same as before)
-                                post = self.mastodon_api.status_post(
-                                    content_toot,
-                                    media_ids=media_ids,
-                                    visibility=config.TOOT_VISIBILITY,
-                                    sensitive=sensitive,
-                                    spoiler_text=warning
-                                )
-                                self.mark_toot_sent(post['id'])
-
-                            since_toot_id = post['id']
-                            post_success = True
-
-                    except MastodonError:
-                        if retry_counter < config.TWITTER_RETRIES:
-                            lgt('We were unable to send the toot. '
-                                f'Retrying… ({retry_counter+1}/{config.TWITTER_RETRIES})')
-                            retry_counter += 1
-                            time.sleep(config.TWITTER_RETRY_DELAY)
-                        else:
-                            raise
-
-                lgt('Toot sent successfully.')
-
-                with lock:
-                    self.associate_status(since_toot_id, tweet_id)
-                    self.save_status_associations()
-
-            except MastodonError:
-                lgt(f'Encountered error after {config.TWITTER_RETRIES} retries. Not retrying.')
-
-            # Broad exception to avoid thread interruption in case of network problems or anything else.
-            except Exception as e:
-                lgt('Unhandled exception happened - giving up on this toot.')
-                lgt(e)
+            callback(tweet)
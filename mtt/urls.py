@@ -0,0 +1,145 @@
+import re
+
+from threading import Lock
+
+from mtt import config
+
+__all__ = ['find_urls']
+
+
+# Some helpers copied out from python-twitter, because they're broken there.
+# The TLDs are not in the pattern: it stops after the dot preceding one (or
+# at a port number), and the TLD is checked apart.
+_URL_CANDIDATE_REGEXP = re.compile(
+    r'(?!(https?://|www\.)?\.|ftps?://|([0-9]+\.){1,3}\d+)'  # exclude urls that start with "."
+    r'(?:https?://|www\.)*(?!.*@)(?:[\w+-_]+[.])'              # beginning of url
+    r'(?:(?P<tld>(?=[^\W\d_]))|'                               # a TLD (checked apart)
+    r'(?:[:0-9]))',                                            # port numbers & close off TLDs
+    re.U | re.I | re.X)
+
+_URL_PATH_REGEXP = re.compile(
+    r'(?:[\w+\/]?[a-z0-9!\*\'\(\);:&=\+\$/%#\[\]\-_\.,~?])*',  # path/query params
+    re.U | re.I | re.X)
+
+# The characters a URL host can be made of (before its TLD).
+_URL_HOST_REGEXP = re.compile(r'[\w+-_]+', re.U | re.I)
+
+_WORD_REGEXP = re.compile(r'\w+', re.U)
+
+# Matches the URLs found, so they are returned as matches.
+_URL_SPAN_REGEXP = re.compile(r'.+', re.S)
+
+_tlds = None
+_tlds_lock = Lock()
+
+
+def _load_tlds():
+    """
+    :return: A tuple (the known TLDs as a frozenset, the lengths of those which are
+             not a single word, from the longest, and the other characters they contain).
+    """
+    global _tlds
+
+    if _tlds is None:
+        with _tlds_lock:
+            if _tlds is None:
+                import twitter
+
+                tlds = frozenset(tld.lower() for tld in twitter.twitter_utils.TLDS)
+                split = [tld for tld in tlds if not _WORD_REGEXP.fullmatch(tld)]
+                _tlds = (tlds, sorted({len(tld) for tld in split}, reverse=True),
+                         frozenset(char for tld in split for char in tld if not _WORD_REGEXP.match(char)))
+
+    return _tlds
+
+
+def _is_word(text, position):
+    return 0 <= position < len(text) and (text[position].isalnum() or text[position] == '_')
+
+
+def _tld_end(text, start):
+    """
+    :return: The end of the known TLD followed by a word boundary at `start`, or None.
+    """
+    tlds, split_lengths, split_chars = _load_tlds()
+
+    # Most TLDs are a single word, so they are the whole word there.
+    end = _WORD_REGEXP.match(text, start).end()
+    if text[start:end].lower() in tlds:
+        return end
+
+    if end < len(text) and text[end] in split_chars:
+        for length in split_lengths:
+            end = start + length
+            if end <= len(text) and text[start:end].lower() in tlds \
+                    and _is_word(text, end - 1) != _is_word(text, end):
+                return end
+
+    return None
+
+
+def _url_at(text, start, candidate):
+    """
+    Finds the URL starting at a position, as the regex with all TLDs would:
+    if the TLD after the last dot is unknown, the previous dots are tried.
+
+    :param text: The text.
+    :param start: The position.
+    :param candidate: The candidate match at this position.
+    :return: The URL end, or None if there is none at this position.
+    """
+    while candidate is not None:
+        if candidate.group('tld') is None:
+            return _URL_PATH_REGEXP.match(text, candidate.end()).end()
+
+        tld_end = _tld_end(text, candidate.end())
+        if tld_end is not None:
+            return _URL_PATH_REGEXP.match(text, tld_end).end()
+
+        # Only the dots before this one remain: they are all before it, and
+        # what follows them is not changed by ending the text there.
+        candidate = _URL_CANDIDATE_REGEXP.match(text, start, candidate.end() - 1)
+
+    return None
+
+
+def _find_urls(text):
+    position = 0
+
+    while True:
+        candidate = _URL_CANDIDATE_REGEXP.search(text, position)
+        if candidate is None:
+            return
+
+        start = candidate.start()
+        end = _url_at(text, start, candidate)
+        if end is None:
+            # None of the dots up to the end of the host has a known TLD (or a
+            # port number) after it, so no URL starts before that.
+            position = _URL_HOST_REGEXP.match(text, start).end()
+        else:
+            yield _URL_SPAN_REGEXP.match(text, start, end)
+            position = end
+
+
+def find_urls(text):
+    """
+    Finds the URLs in a text, as a regex matching all the known TLDs (those
+    of python-twitter) would, unless one is set in the configuration
+    (`URL_REGEXP`).
+
+    Such a regex is slow to build and to run, so the URLs are found by a
+    small pattern, stopping before their TLD, which is then looked up in a
+    set. Every URL contains a dot, so texts without any are skipped without
+    running the pattern.
+
+    :param text: The text to search.
+    :return: An iterator over the matches.
+    """
+    if config.URL_REGEXP is not None:
+        return config.URL_REGEXP.finditer(text)
+
+    if '.' not in text:
+        return iter(())
+
+    return _find_urls(text)
@@ -1,21 +1,28 @@
-import json
+import hashlib
 import mimetypes
-import os
-import re
 import requests
 import tempfile
 import threading
-import twitter
+import time
 
-from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
 from threading import Thread
 
-from mtt import config, lock
+from mtt import config, lock, logs, metrics, profiling
+from mtt.checkpoints import Checkpoints
+from mtt.logs import DEBUG, ERROR, WARNING, lg, lgt
+from mtt.outbox import Outbox
+from mtt.retries import RetryScheduler, backoff_delay
+from mtt.sessions import PooledSession
+from mtt.urls import find_urls
 
 
 class MTTThread(Thread):
     def __init__(self, mastodon_api, twitter_api, ma_account_id, tw_account_id,
-                 status_associations, sent_status, group=None, target=None, name=None):
+                 status_associations, sent_status, media_cache=None, http_session=None, media_executor=None,
+                 checkpoints=None, outbox=None, group=None, target=None, name=None):
         super(MTTThread, self).__init__(
             group=group,
             target=target,
@@ -28,14 +35,387 @@ class MTTThread(Thread):
         self.tw_account_id = tw_account_id
         self.status_associations = status_associations
         self.sent_status = sent_status
+        self.media_cache = media_cache
+        self.http_session = http_session or PooledSession()
+        self.checkpoints = checkpoints if checkpoints is not None else Checkpoints()
+        self.outbox = outbox if outbox is not None else Outbox()
+        self.retry_scheduler = RetryScheduler(name=name)
+
+        self.media_executor = media_executor or ThreadPoolExecutor(
+            max_workers=config.MEDIA_TRANSFER_WORKERS,
+            thread_name_prefix=f'{name} (medias)'
+        )
+
+        # Statuses received from the stream (or left unfinished in the outbox),
+        # waiting to be processed, with the time at which they can be and the
+        # time at which they were queued.
+        self.statuses = Queue()
+
+        # Our own statuses received recently, as they can be received both from
+        # the stream and when catching up after a reconnection.
+        self.received = ExpiringSet(ttl=config.SENT_STATUS_TTL, max_size=config.SENT_STATUS_MAX_SIZE)
+
+    def enqueue_status(self, status):
+        """
+        Queues a status received from the stream, to be processed by the
+        workers after `STATUS_PROCESS_DELAY`.
+
+        This avoids a race condition: we wait a little bit so statuses sent
+        by the other direction can be marked as such before being processed,
+        avoiding bouncing tweets/toots.
+
+        :param status: The status.
+        """
+        self.queue(self.process_status, status, delay=config.STATUS_PROCESS_DELAY)
+
+    def queue(self, process, item, delay=0):
+        """
+        Queues an item to be processed by the workers.
+        :param process: The function processing the item.
+        :param item: The item.
+        :param delay: How long to wait before processing it (seconds).
+        """
+        now = time.monotonic()
+        self.statuses.put((now + delay, now, process, item))
+
+    def resume_pending(self):
+        """
+        Queues the statuses left unfinished in the outbox when the process
+        stopped, to be sent before the ones received from the stream.
+        """
+        for post in self.outbox.pending(self.source_status):
+            lgt(f'Resuming the {self.destination_status}s of {self.source_status} {post["status_id"]} '
+                f'({len(post["sent"])}/{len(post["parts"])} sent).')
+            self.mark_parts_sent(post)
+            self.queue(self.send_post, post)
+
+    def start_workers(self):
+        """
+        Starts the `STATUS_WORKERS` threads processing the queued statuses.
+        """
+        for _ in range(config.STATUS_WORKERS):
+            Thread(target=self._process_statuses, name=self.name, daemon=True).start()
+
+    def _process_statuses(self):
+        while True:
+            ready_at, queued_at, process, item = self.statuses.get()
+
+            delay = ready_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            metrics.observe('wait', self.direction, time.monotonic() - queued_at)
+
+            try:
+                process(item)
+
+            # Broad exception to avoid thread interruption in case of network problems or anything else.
+            except Exception as e:
+                lgt(f'Unhandled exception while processing a status: {e!r}', level=ERROR)
+
+            finally:
+                self.statuses.task_done()
+
+    def status_processed(self, status):
+        """
+        Moves the checkpoint after a status was processed (successfully or not).
+        :param status: The status.
+        """
+        if self.is_own_status(status):
+            self.checkpoints.update(self.source_status, status['id'])
+
+    def run(self):
+        self.init_process()
+        self.resume_pending()
+        self.start_workers()
+
+        # Statuses are processed by the workers, so the stream is never blocked.
+        self.listen(self.enqueue_status)
+
+    def init_process(self):
+        """
+        Initializes the publisher before listening to the stream.
+        """
+        pass
+
+    def listen(self, callback):
+        """
+        Listens to the source stream, forever: when the stream fails, we
+        reconnect after `STREAM_RECONNECT_DELAY`.
+
+        After (re)connecting, the statuses posted since the last processed one
+        are fetched, and passed before the statuses received from the stream
+        meanwhile. Statuses received twice are only passed once.
+
+        Only our own statuses are passed: the other ones (most of the
+        Mastodon home timeline) are dropped as soon as they are received.
+
+        :param callback: Called with each status.
+        """
+        def receive(status):
+            if not self.is_own_status(status):
+                metrics.filtered(self.direction, 'decoded', passed=False)
+                return
+
+            metrics.filtered(self.direction, 'decoded', passed=True)
+
+            with metrics.timed('receive', self.direction) as stage:
+                with lock:
+                    if str(status['id']) in self.received:
+                        stage.outcome = 'duplicate'
+                        return
+                    self.received.add(str(status['id']))
+
+                callback(status)
+
+        while True:
+            handoff = StreamHandoff(receive)
+
+            reader = Thread(target=self._read_stream, args=(handoff.receive,), name=self.name, daemon=True)
+            reader.start()
+
+            # Gives the stream some time to connect, so nothing is posted between
+            # the statuses we fetch and the ones it receives.
+            time.sleep(config.STREAM_HANDOFF_DELAY)
+
+            self.backfill(receive)
+            handoff.release()
+
+            reader.join()
+
+            lgt(f'Reconnecting in {config.STREAM_RECONNECT_DELAY} seconds…')
+            time.sleep(config.STREAM_RECONNECT_DELAY)
+
+    def _read_stream(self, callback):
+        lgt(f'Listening for {self.source_status}s…')
+
+        try:
+            self.read_stream(callback)
+            lgt('The stream ended.')
+
+        except Exception as e:
+            lgt(f'The stream failed: {e!r}', level=WARNING)
+
+    def backfill(self, callback):
+        """
+        Fetches the statuses posted since the last processed one, up to
+        `BACKFILL_MAX_STATUSES`.
+        :param callback: Called with each status, oldest first.
+        """
+        since_id = self.checkpoints.get(self.source_status)
+        if since_id is None or not config.BACKFILL_MAX_STATUSES:
+            return
+
+        try:
+            statuses = self.fetch_statuses_since(since_id, config.BACKFILL_MAX_STATUSES)
+        except Exception as e:
+            lgt(f'Unable to fetch the {self.source_status}s posted since {since_id}: {e!r}', level=WARNING)
+            return
+
+        if statuses:
+            lgt(f'Catching up on {len(statuses)} {self.source_status}(s) posted since {since_id}.')
+
+        for status in statuses:
+            callback(status)
+
+    def fetch_statuses_since(self, since_id, limit):
+        """
+        Fetches our statuses posted after a given one.
+        :param since_id: The status ID.
+        :param limit: The maximal number of statuses to fetch (the most recent ones).
+        :return: The statuses, oldest first, in the same format as the stream ones.
+        """
+        raise NotImplementedError
+
+    def is_own_status(self, status):
+        """
+        :param status: A status received from the stream.
+        :return: True if the status was posted by our account.
+        """
+        raise NotImplementedError
+
+    def read_stream(self, callback):
+        """
+        Reads the statuses from the source stream. Never returns.
+        :param callback: Called with each status received.
+        """
+        raise NotImplementedError
+
+    def process_status(self, status):
+        """
+        Processes a status received from the stream: prepares it, transfers
+        its medias and publishes it.
+        :param status: The status.
+        """
+        try:
+            with profiling.profiler.profiled(self.direction, status['id']):
+                with metrics.timed('filter', self.direction) as stage:
+                    post = self.prepare_status(status)
+                    stage.outcome = 'skipped' if post is None else 'accepted'
+
+                if post is None:
+                    return
+
+                # Recorded before anything is sent, to be resumed if the process stops.
+                if not self.outbox.plan(self.source_status, post):
+                    return
+
+                self.send_post(post)
+
+        finally:
+            self.status_processed(status)
+
+    def send_post(self, post):
+        """
+        Transfers the medias of a planned status and publishes it, then marks
+        it as done in the outbox. If anything unexpected happens, it stays in
+        the outbox and is resumed on the next start.
+        :param post: The planned status.
+        """
+        try:
+            media_ids = self.transfer_medias(post['media_urls'], to=self.destination)
+        except MediaTransferError as e:
+            self.media_transfer_failed(e)
+            self.outbox.done(self.source_status, post)
+            return
+
+        self.retry_post((post, media_ids, 0))
+
+    def retry_post(self, retry):
+        """
+        Publishes a planned status. If it fails, it is retried later, after a
+        growing delay, up to `retries` times; the parts already sent are not
+        sent again.
+        :param retry: A tuple (planned status, media IDs, number of retries already made).
+        """
+        post, media_ids, attempt = retry
+
+        try:
+            self.publish_status(post, media_ids)
+        except self.publish_errors as e:
+            if attempt < self.retries:
+                delay = self.retry_delay(attempt)
+                lgt(f'We were unable to send the {self.destination_status}. '
+                    f'Retrying in {delay:.0f} seconds… ({attempt + 1}/{self.retries})', level=WARNING)
+
+                # Parked in the scheduler, so the workers can process other statuses meanwhile.
+                self.retry_scheduler.schedule(delay, self.queue, self.retry_post, (post, media_ids, attempt + 1))
+                metrics.retried(self.direction)
+                return
+
+            self.publish_failed(e)
+
+        self.outbox.done(self.source_status, post)
+        self.after_status()
+
+    @property
+    def retries(self):
+        """
+        How many times publishing a status is retried, on the destination platform.
+        """
+        return config[f'{self.destination.upper()}_RETRIES']
+
+    def retry_delay(self, attempt):
+        """
+        :param attempt: The number of retries already made.
+        :return: The delay before the next retry (seconds).
+        """
+        return backoff_delay(attempt, config[f'{self.destination.upper()}_RETRY_DELAY'],
+                             config[f'{self.destination.upper()}_RETRY_MAX_DELAY'])
+
+    def media_transfer_failed(self, error):
+        for media_url, media_error in error.failures:
+            lgt(f'Unable to transfer media {media_url}: {media_error!r}', level=ERROR)
+        lgt(f'Giving up on this {self.destination_status}.', level=ERROR)
+
+    def publish_failed(self, error):
+        lgt(f'Encountered error after {self.retries} retries. Not retrying. ({error!r})', level=ERROR)
+
+    def after_status(self):
+        """
+        Called after a status was processed (successfully or not).
+        """
+        pass
+
+    def prepare_status(self, status):
+        """
+        Prepares the statuses to send on the other network for a status.
+        :param status: The status.
+        :return: None if the status must not be sent; else a dict with at least:
+                 - status_id: the status ID;
+                 - parts: the texts of the statuses to send, each replying to
+                   the previous one;
+                 - media_urls: the URLs of the medias to attach to the last one;
+                 - reply_to: the ID of the status the first one replies to, if any.
+                 It must be serializable to JSON, as it is written to the outbox.
+        """
+        raise NotImplementedError
+
+    def post_status(self, post, text, media_ids, reply_to):
+        """
+        Sends a status on the other network.
+        :param post: The prepared status.
+        :param text: The status text.
+        :param media_ids: The medias to attach to the status.
+        :param reply_to: The status to reply to, if any.
+        :return: The sent status ID.
+        """
+        raise NotImplementedError
+
+    def associate_post(self, post, posted_id):
+        """
+        Associates a prepared status and the last status sent for it.
+        :param post: The prepared status.
+        :param posted_id: The last sent status ID.
+        """
+        raise NotImplementedError
+
+    def publish_status(self, post, media_ids):
+        """
+        Sends all the parts of a planned status not sent yet, and associates it.
+        :param post: The planned status.
+        :param media_ids: The medias to attach to the last part.
+        """
+        posted_id = post['sent'][-1] if post['sent'] else post['reply_to']
+
+        for i, text in enumerate(post['parts']):
+            if i < len(post['sent']):
+                continue
+
+            last = i == len(post['parts']) - 1
+
+            lgt(f'Sending {self.destination_status} {i + 1}/{len(post["parts"])} of {self.source_status} '
+                f'{post["status_id"]}…')
+            if logs.enabled(DEBUG):
+                lgt(f'Text of the {self.destination_status}', level=DEBUG, text=text)
+            with metrics.timed('post', self.direction):
+                posted_id = self.post_status(post, text, media_ids if last else [], posted_id)
+
+            self.outbox.sent(self.source_status, post, posted_id)
+            lgt(f'{self.destination_status.capitalize()} sent successfully.')
+
+        self.associate_post(post, posted_id)
+
+    def mark_parts_sent(self, post):
+        """
+        Marks the parts already sent of a planned status as sent by us, so
+        they are not mirrored back if received (e.g. when catching up after
+        a restart) before the status is completed and associated.
+        :param post: The planned status.
+        """
+        for posted_id in post['sent']:
+            if self.destination == 'twitter':
+                self.mark_tweet_sent(posted_id)
+            else:
+                self.mark_toot_sent(posted_id)
 
     def mark_toot_sent(self, toot_id):
         with lock:
-            self.sent_status['toots'].append(str(toot_id))
+            self.sent_status['toots'].add(str(toot_id))
 
     def mark_tweet_sent(self, tweet_id):
         with lock:
-            self.sent_status['tweets'].append(str(tweet_id))
+            self.sent_status['tweets'].add(str(tweet_id))
 
     def is_toot_sent_by_us(self, toot_id):
         with lock:
@@ -47,88 +427,333 @@ class MTTThread(Thread):
 
     def associate_status(self, toot_id, tweet_id):
         """
-        Associates a tweet and a toot in the associations file.
+        Associates a tweet and a toot in the associations journal.
         :param toot_id: The toot ID
         :param tweet_id: The tweet ID
         """
-        self.status_associations['t2m'][tweet_id] = toot_id
-        self.status_associations['m2t'][toot_id] = tweet_id
+        self.associate_statuses([(toot_id, tweet_id)])
 
-    def save_status_associations(self):
-        try:
-            with open('mtt_status_associations.json', 'w') as f:
-                json.dump(self.status_associations['m2t'], f)
-        except Exception:
-            print('Encountered error while saving status associations file. Threads might be broken after MTT service '
-                  'restarts. Check files permissions.')
+    def associate_statuses(self, associations):
+        """
+        Associates tweets and toots in the associations journal.
+        :param associations: The (toot ID, tweet ID) pairs, in order.
+        """
+        with lock:
+            self.status_associations.add(associations)
+
+        # Synced to disk without holding the global lock, so the other threads are not blocked meanwhile.
+        with metrics.timed('associate', self.direction) as stage:
+            try:
+                self.status_associations.append(associations)
+            except Exception:
+                stage.outcome = 'error'
+                lgt('Encountered error while saving status associations file. Threads might be broken after MTT '
+                    'service restarts. Check files permissions.', level=ERROR)
 
     def transfer_media(self, media_url, to='twitter'):
         """
         Transfers a media from a network to another.
 
+        The media is downloaded by chunks into a spool, kept in memory for
+        small files and moved to disk above `MEDIA_SPOOL_MAX_SIZE`; the
+        upload then reads from this spool.
+
+        If a media cache is set, medias already downloaded are read from it,
+        and medias already uploaded are not uploaded again if their media ID
+        can be reused.
+
         :param media_url: The media URL.
         :param to: The destination ('twitter' or 'mastodon', else ValueError is raised)
         :return: The media ID on the destination platform.
         """
-        lg('Medias', f'Downloading {media_url} from {"Mastodon" if to == "twitter" else "Twitter"}')
+        if to not in ('twitter', 'mastodon'):
+            raise ValueError(f'Unknown platform "{to}"')
 
-        media_file = requests.get(media_url, stream=True)
-        media_file.raw.decode_content = True
+        media = None
+        media_hash = self.media_cache.lookup(media_url) if self.media_cache else None
+        account = self.tw_account_id if to == 'twitter' else self.ma_account_id
+
+        if media_hash:
+            media_id = self.media_cache.get_media_id(media_hash, to, account)
+            if media_id is not None:
+                lg('Medias', f'Reusing already uploaded media {media_url}')
+                return media_id
+
+            media = self.media_cache.open(media_hash)
+
+        if media is None:
+            lg('Medias', f'Downloading {media_url} from {"Mastodon" if to == "twitter" else "Twitter"}')
+            with metrics.timed('media_download', self.direction):
+                media = download_media(media_url, session=self.http_session)
+
+            if self.media_cache:
+                try:
+                    media_hash = self.media_cache.store(media_url, media)
+                except Exception:
+                    media.close()
+                    raise
+
+                media_id = self.media_cache.get_media_id(media_hash, to, account)
+                if media_id is not None:
+                    lg('Medias', f'Reusing already uploaded media with the same content as {media_url}')
+                    media.close()
+                    return media_id
+
+        with media:
+            lg('Medias', f'Uploading {media.name} ({media.size} bytes, peak memory {media.peak_memory} bytes) '
+                         f'to {"Twitter" if to == "twitter" else "Mastodon"}')
+
+            with metrics.timed('media_upload', self.direction):
+                if to == 'twitter':
+                    media_id = self.twitter_api.UploadMediaChunked(media=media)
+                else:
+                    media_id = self.mastodon_api.media_post(media, mime_type=media.content_type)
 
-        temp_file = tempfile.NamedTemporaryFile(delete=False)
-        temp_file.write(media_file.raw.read())
-        temp_file.close()
+        if self.media_cache:
+            self.media_cache.set_media_id(media_hash, to, account, media_id)
 
-        file_extension = mimetypes.guess_extension(media_file.headers['Content-type'])
-        upload_file_name = temp_file.name + file_extension
-        os.rename(temp_file.name, upload_file_name)
+        return media_id
 
-        temp_file_read = open(upload_file_name, 'rb')
-        lg('Medias', f'Uploading {upload_file_name} to {"Twitter" if to == "twitter" else "Mastodon"}')
+    def transfer_medias(self, media_urls, to='twitter'):
+        """
+        Transfers medias from a network to another, in parallel (up to
+        `MEDIA_TRANSFER_WORKERS` at once).
 
-        if to == 'twitter':
-            media_id = self.twitter_api.UploadMediaChunked(media=temp_file_read)
-        elif to == 'mastodon':
-            media_id = self.mastodon_api.media_post(upload_file_name)
-        else:
-            raise ValueError(f'Unknown platform "{to}"')
+        :param media_urls: The medias URLs.
+        :param to: The destination ('twitter' or 'mastodon', else ValueError is raised)
+        :return: The medias IDs on the destination platform, in the same order.
+        :raise MediaTransferError: if any media failed to be transferred, after all
+                                   transfers are done.
+        """
+        futures = [self.media_executor.submit(self.transfer_media, media_url, to) for media_url in media_urls]
 
-        temp_file_read.close()
-        os.unlink(upload_file_name)
+        media_ids = []
+        failures = []
 
-        return media_id
+        for media_url, future in zip(media_urls, futures):
+            try:
+                media_ids.append(future.result())
+            except Exception as e:
+                failures.append((media_url, e))
 
+        if failures:
+            raise MediaTransferError(failures)
 
-def lg(namespace, message):
+        return media_ids
+
+
+class MediaTransferError(Exception):
     """
-    Prints a log message.
-    :param namespace: A namespace. If None, uses the current thread name.
-    :param message: A message to be logged.
+    Raised when some medias of a status could not be transferred.
+    The failures are listed in `failures`, as (media URL, exception) tuples.
     """
-    if namespace is None:
-        namespace = threading.current_thread().name
-    print(f'[{datetime.now():%d/%m/%Y %H:%M:%S}] [{namespace}] {message}')
+    def __init__(self, failures):
+        self.failures = failures
+
+        super(MediaTransferError, self).__init__(
+            f'Unable to transfer {len(failures)} media(s): '
+            + ', '.join(f'{media_url} ({e!r})' for media_url, e in failures)
+        )
 
 
-def lgt(message):
+class MediaSpool(tempfile.SpooledTemporaryFile):
     """
-    Prints a log message namespaced with the current thread.
-    :param message: A message to be logged.
+    A downloaded media, kept in memory until it grows larger than
+    `MEDIA_SPOOL_MAX_SIZE`, then in a temporary file.
+
+    Its name carries an extension matching its content type, as the
+    Twitter API guesses the media type from it.
     """
-    lg(None, message)
+    def __init__(self, content_type):
+        super(MediaSpool, self).__init__(max_size=config.MEDIA_SPOOL_MAX_SIZE, mode='w+b')
+
+        self.content_type = content_type
+        self.size = 0
+        self.peak_memory = 0
+        self.sha256 = hashlib.sha256()
+
+        self._name = 'media' + (mimetypes.guess_extension(content_type) or '')
+
+    @property
+    def name(self):
+        return self._name
+
+    def write(self, chunk):
+        in_memory = not self._rolled
+
+        written = super(MediaSpool, self).write(chunk)
+        self.size += written
+        self.sha256.update(chunk[:written])
+
+        # Memory held for this media: the whole spool until it is moved to
+        # disk (which may happen during this write), then only the chunk.
+        self.peak_memory = max(self.peak_memory, self.size if in_memory else len(chunk))
+
+        return written
+
+
+def download_media(media_url, session=requests):
+    """
+    Downloads a media by chunks of `MEDIA_CHUNK_SIZE` bytes.
+
+    :param media_url: The media URL.
+    :param session: The requests session to use.
+    :return: A MediaSpool, rewound, to be closed by the caller.
+    """
+    with session.get(media_url, stream=True) as response:
+        content_type = response.headers.get('Content-type', '').split(';')[0].strip()
+        media = MediaSpool(content_type)
+
+        try:
+            for chunk in response.iter_content(chunk_size=config.MEDIA_CHUNK_SIZE):
+                media.write(chunk)
+        except Exception:
+            media.close()
+            raise
+
+    media.seek(0)
+    return media
+
+
+class StreamHandoff:
+    """
+    Holds the statuses received from a stream until released, then passes
+    them on, in the order they were received.
+    """
+    def __init__(self, callback):
+        self.callback = callback
+
+        self._held = []
+        self._released = False
+        self._lock = threading.Lock()
+
+    def receive(self, status):
+        with self._lock:
+            if not self._released:
+                self._held.append(status)
+                return
+
+        self.callback(status)
+
+    def release(self):
+        with self._lock:
+            for status in self._held:
+                self.callback(status)
+
+            self._held = []
+            self._released = True
+
+
+class ExpiringSet:
+    """
+    A set whose items expire after some time, and bounded in size (the
+    oldest items are evicted first).
+
+    Membership checks and insertions are O(1) (amortized for evictions).
+    This is not thread-safe by itself; use the global lock.
+
+    Hits, misses and evictions are counted in `stats`.
+    """
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+
+        self._items = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def _evict(self, now):
+        while self._items:
+            item, added_at = next(iter(self._items.items()))
+            if len(self._items) <= self.max_size and now - added_at < self.ttl:
+                break
+
+            del self._items[item]
+            self.stats['evictions'] += 1
+
+    def add(self, item):
+        now = time.monotonic()
+
+        self._items.pop(item, None)
+        self._items[item] = now
+        self._evict(now)
+
+    def __contains__(self, item):
+        self._evict(time.monotonic())
+
+        if item in self._items:
+            self.stats['hits'] += 1
+            return True
+
+        self.stats['misses'] += 1
+        return False
+
+    def __len__(self):
+        return len(self._items)
 
 
 def calc_expected_status_length(status, short_url_length=23):
     status_length = len(status)
-    match = re.findall(config.URL_REGEXP, status)
+    match = [url.group(0) for url in find_urls(status)]
 
     if match:
-        replaced_chars = len(''.join(map(lambda x: x[0], match)))
+        replaced_chars = len(''.join(match))
         status_length = status_length - replaced_chars + (short_url_length * len(match))
 
     return status_length
 
 
+class _StatusLength:
+    """
+    The expected length of a status being built word by word, as computed
+    by `calc_expected_status_length`, but updated incrementally.
+
+    URLs never contain spaces, so each word can be matched on its own.
+    The only context-dependent part of the URL regex is that a URL is not
+    matched if an `@` follows it on the same line; so we also keep the
+    length adjustment of the URLs on the last line, to cancel it if a
+    word containing an `@` is appended to that line.
+    """
+    def __init__(self, short_url_length, length=0, line_adjustment=0):
+        self.short_url_length = short_url_length
+        self.length = length
+        self.line_adjustment = line_adjustment
+
+    def _adjustments(self, text):
+        total = 0
+        last_line = 0
+        last_newline = text.rfind('\n')
+
+        for match in find_urls(text):
+            adjustment = self.short_url_length - len(match.group(0))
+            total += adjustment
+            if match.start() > last_newline:
+                last_line += adjustment
+
+        return total, last_line
+
+    @classmethod
+    def of(cls, text, short_url_length):
+        status_length = cls(short_url_length)
+        total, last_line = status_length._adjustments(text)
+        status_length.length = len(text) + total
+        status_length.line_adjustment = last_line
+        return status_length
+
+    def append(self, word):
+        """
+        :return: the length of the status with ' ' and the word appended.
+        """
+        total, last_line = self._adjustments(word)
+        first_line, newline, _ = word.partition('\n')
+        line_adjustment = 0 if '@' in first_line else self.line_adjustment
+
+        return _StatusLength(
+            short_url_length=self.short_url_length,
+            length=self.length - self.line_adjustment + line_adjustment + 1 + len(word) + total,
+            line_adjustment=last_line if newline else line_adjustment + total
+        )
+
+
 def split_status(status, max_length, split=True, url=None, url_length=None):
     """
     Split toots, if need be, using Many magic numbers.
@@ -148,15 +773,25 @@ def split_status(status, max_length, split=True, url=None, url_length=None):
     max_length -= 6
 
     if calc_expected_status_length(status, short_url_length=url_length) > max_length:
-        current_part = ''
+        # Imported here, as it is slow to import when starting (it is already imported once logged in).
+        from twitter.twitter_utils import is_url
+
+        # The current part is kept as a list of words, and its length is
+        # updated as words are added, so each word is only processed once.
+        current_words = ['']
+        current_length = _StatusLength(url_length)
+
         for next_word in status.split(' '):
+            next_length = current_length.append(next_word)
+
             # Need to split here?
-            if calc_expected_status_length(current_part + ' ' + next_word, short_url_length=url_length) > max_length:
-                space_left = max_length - 5 - calc_expected_status_length(current_part, short_url_length=url_length) - 1
+            if next_length.length > max_length:
+                current_part = ' '.join(current_words)
+                space_left = max_length - 5 - current_length.length - 1
 
                 if split:
                     # Want to split word?
-                    if len(next_word) > 30 and space_left > 5 and not twitter.twitter_utils.is_url(next_word):
+                    if len(next_word) > 30 and space_left > 5 and not is_url(next_word):
                         current_part = current_part + " " + next_word[:space_left]
                         content_parts.append(current_part)
                         current_part = next_word[space_left:]
@@ -168,16 +803,21 @@ def split_status(status, max_length, split=True, url=None, url_length=None):
                     while len(current_part) > max_length - 5:
                         content_parts.append(current_part[:max_length - 5])
                         current_part = current_part[max_length - 5:]
+
+                    current_words = [current_part]
+                    current_length = _StatusLength.of(current_part, url_length)
                 else:
                     space_for_suffix = len('… ') + url_length
                     content_parts.append(current_part[:-space_for_suffix] + '… ' + url)
-                    current_part = ''
+                    current_words = ['']
                     break
             else:
                 # Just plop next word on
-                current_part = current_part + ' ' + next_word
+                current_words.append(next_word)
+                current_length = next_length
 
         # Insert last part
+        current_part = ' '.join(current_words)
         if len(current_part.strip()) != 0 or len(content_parts) == 0:
             content_parts.append(current_part.strip())
 